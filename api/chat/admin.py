@@ -1,8 +1,31 @@
 from django.contrib import admin
-from .models import User, Connection, Message
+from .models import User, Connection, Conversation, GroupMessage, Membership, Message
 
 # Register your models here.
 
 admin.site.register(User)
-admin.site.register(Connection)
-admin.site.register(Message)
+admin.site.register(Conversation)
+
+
+# The changelists below show each row's __str__, which reads related
+# users: join them in instead of a query per row
+
+
+@admin.register(Connection)
+class ConnectionAdmin(admin.ModelAdmin):
+    list_select_related = ("sender", "receiver")
+
+
+@admin.register(Message)
+class MessageAdmin(admin.ModelAdmin):
+    list_select_related = ("user",)
+
+
+@admin.register(Membership)
+class MembershipAdmin(admin.ModelAdmin):
+    list_select_related = ("user", "conversation")
+
+
+@admin.register(GroupMessage)
+class GroupMessageAdmin(admin.ModelAdmin):
+    list_select_related = ("user",)
@@ -0,0 +1,194 @@
+"""
+Helpers for the chat benchmark management commands.
+
+Benchmarks run against a throwaway test database and an in-memory channel
+layer, so they need neither Redis nor the development database.
+"""
+
+import asyncio
+import json
+import os
+import tempfile
+import time
+from contextlib import contextmanager
+
+from channels.layers import channel_layers
+from channels.testing import WebsocketCommunicator
+from django.db import connection
+from django.test.utils import override_settings
+from rest_framework_simplejwt.tokens import AccessToken
+
+from .models import User, Connection
+from .writer import stop_writer
+
+IN_MEMORY_CHANNEL_LAYERS = {
+    "default": {
+        "BACKEND": "channels.layers.InMemoryChannelLayer",
+        "CONFIG": {"capacity": 10_000},
+    },
+}
+
+
+@contextmanager
+def bench_environment(
+    channel_layers_setting=IN_MEMORY_CHANNEL_LAYERS, database="memory", **settings
+):
+    """
+    Create a test database and swap in a local channel layer.
+
+    ``database="file"`` puts the SQLite test database on disk so commit
+    costs are real; extra keyword arguments override settings.
+    """
+    test_settings = connection.settings_dict.setdefault("TEST", {})
+    old_test_name = test_settings.get("NAME")
+    if database == "file":
+        test_settings["NAME"] = os.path.join(tempfile.mkdtemp(), "bench.sqlite3")
+    old_name = connection.creation.create_test_db(verbosity=0, autoclobber=True)
+    try:
+        with override_settings(CHANNEL_LAYERS=channel_layers_setting, **settings):
+            try:
+                yield
+            finally:
+                stop_writer()
+    finally:
+        channel_layers.backends = {}
+        connection.creation.destroy_test_db(old_name, verbosity=0)
+        test_settings["NAME"] = old_test_name
+
+
+def create_friends(count, prefix="bench"):
+    """Create ``count`` users paired into accepted connections."""
+    users = User.objects.bulk_create(
+        User(username=f"{prefix}{i}", first_name=prefix, last_name=str(i))
+        for i in range(count)
+    )
+    # SQLite doesn't return ids from bulk_create on every version
+    users = list(User.objects.filter(username__startswith=prefix).order_by("id"))
+    Connection.objects.bulk_create(
+        Connection(sender=users[i], receiver=users[i + 1], accepted=True)
+        for i in range(0, count - 1, 2)
+    )
+    return users
+
+
+def token_for(user):
+    return str(AccessToken.for_user(user))
+
+
+def percentile(samples, pct):
+    if not samples:
+        return None
+    ordered = sorted(samples)
+    index = min(len(ordered) - 1, int(round(pct / 100 * (len(ordered) - 1))))
+    return ordered[index]
+
+
+def summarize(samples):
+    """Latency summary in milliseconds."""
+    return {
+        "count": len(samples),
+        "p50": _ms(percentile(samples, 50)),
+        "p95": _ms(percentile(samples, 95)),
+        "p99": _ms(percentile(samples, 99)),
+        "max": _ms(max(samples) if samples else None),
+    }
+
+
+def _ms(seconds):
+    return None if seconds is None else round(seconds * 1000, 3)
+
+
+class Client:
+    """A simulated, authenticated websocket client."""
+
+    def __init__(self, application, path, user):
+        self.user = user
+        self.communicator = WebsocketCommunicator(
+            application, f"{path}?token={token_for(user)}"
+        )
+
+    async def connect(self, timeout=10):
+        connected, _ = await self.communicator.connect(timeout)
+        return connected
+
+    async def send(self, source, **data):
+        await self.communicator.send_to(text_data=json.dumps({"source": source, **data}))
+
+    async def receive(self, source=None, timeout=10):
+        """Wait for the next frame, optionally skipping other sources."""
+        while True:
+            frame = json.loads(await self.communicator.receive_from(timeout))
+            if source is None or frame["source"] == source:
+                return frame
+
+    async def request(self, source, reply=None, timeout=10, **data):
+        """Send a frame and return the reply along with its latency."""
+        start = time.perf_counter()
+        await self.send(source, **data)
+        frame = await self.receive(reply or source, timeout)
+        return frame, time.perf_counter() - start
+
+    async def close(self):
+        await self.communicator.disconnect()
+
+
+class LoadClient(Client):
+    """
+    A client with a background reader, for workloads where pushes from
+    other users interleave with replies.
+
+    Only one request may be outstanding at a time; frames that aren't the
+    awaited reply (friends' messages, typing indicators) are counted and
+    dropped.
+    """
+
+    def __init__(self, application, path, user):
+        super().__init__(application, path, user)
+        self.pending = None
+        self.pushes = 0
+        self.reader = None
+
+    def start(self, timeout):
+        self.reader = asyncio.ensure_future(self.read(timeout))
+
+    async def read(self, timeout):
+        while True:
+            frame = json.loads(await self.communicator.receive_from(timeout))
+            if self.pending is not None and self.is_reply(frame):
+                source, future = self.pending
+                if frame["source"] == source and not future.done():
+                    future.set_result(frame)
+                    continue
+            self.pushes += 1
+
+    def is_reply(self, frame):
+        # A friend's message arrives with the same source as our echo
+        if frame["source"] == "message.send":
+            return frame["data"]["message"]["is_me"]
+        return True
+
+    async def request(self, source, reply=None, timeout=10, **data):
+        future = asyncio.get_running_loop().create_future()
+        self.pending = (reply or source, future)
+        start = time.perf_counter()
+        await self.send(source, **data)
+        try:
+            frame = await asyncio.wait_for(future, timeout)
+        finally:
+            self.pending = None
+        return frame, time.perf_counter() - start
+
+    async def close(self):
+        if self.reader is not None:
+            self.reader.cancel()
+            await asyncio.gather(self.reader, return_exceptions=True)
+        await super().close()
+
+
+async def connect_all(clients, timeout=10):
+    results = await asyncio.gather(*(client.connect(timeout) for client in clients))
+    return sum(results)
+
+
+async def close_all(clients):
+    await asyncio.gather(*(client.close() for client in clients), return_exceptions=True)
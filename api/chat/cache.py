@@ -0,0 +1,65 @@
+"""
+Per-user friend list cache.
+
+Uses the ``CACHES["default"]`` backend: Redis when ``CHAT_CACHE_URL`` is
+set, so the entries are shared by every process, otherwise local memory,
+where ``CHAT_FRIEND_CACHE_TIMEOUT`` keeps entries short-lived because other
+processes' invalidations never reach them.
+
+Each user has a generation number, bumped by every invalidation. A list is
+stored with the generation read before it was queried and only served
+while that is still current, so a list queried before an invalidation and
+stored after it is never served.
+"""
+
+import time
+
+from django.conf import settings
+from django.core.cache import cache
+
+from . import metrics
+
+
+def friend_list_key(user_id):
+    return f"chat:friends:{user_id}:list"
+
+
+def generation_key(user_id):
+    return f"chat:friends:{user_id}:generation"
+
+
+def new_generation(user_id):
+    # A fresh start, not 0, in case an evicted generation is recreated
+    cache.add(generation_key(user_id), time.time_ns(), timeout=None)
+    return cache.get(generation_key(user_id))
+
+
+def get_friend_list(user_id):
+    """Return ``(generation, friends)``, friends None when not cached."""
+    keys = [generation_key(user_id), friend_list_key(user_id)]
+    values = cache.get_many(keys)
+    generation = values.get(keys[0])
+    if generation is None:
+        generation = new_generation(user_id)
+    stored_generation, friends = values.get(keys[1], (None, None))
+    if stored_generation != generation:
+        friends = None
+    metrics.increment("friend_cache.misses" if friends is None else "friend_cache.hits")
+    return generation, friends
+
+
+def set_friend_list(user_id, generation, friends):
+    cache.set(
+        friend_list_key(user_id),
+        (generation, friends),
+        settings.CHAT_FRIEND_CACHE_TIMEOUT,
+    )
+
+
+def invalidate_friend_lists(*user_ids):
+    for user_id in user_ids:
+        try:
+            cache.incr(generation_key(user_id))
+        except ValueError:
+            new_generation(user_id)
+    metrics.increment("friend_cache.invalidations", len(user_ids))
@@ -1,22 +1,104 @@
+import asyncio
 import json
-import base64
+import logging
+import time
 from asgiref.sync import async_to_sync
-from channels.generic.websocket import WebsocketConsumer
-from django.core.files.base import ContentFile
-from django.db.models import Q, Exists, OuterRef
-from django.db.models.functions import Coalesce
+from channels.db import database_sync_to_async
+from channels.generic.websocket import AsyncWebsocketConsumer, WebsocketConsumer
+from django.conf import settings
 
-from .models import User, Connection, Message
-from .serializers import (
-    UserSerializer,
-    SearchSerializer,
-    RequestSerializer,
-    FriendSerializer,
-    MessageSerializer,
-)
+from . import metrics, presence, uploads
+from .handlers import ChatHandlers
+from .models import Conversation
+from .throttle import OutboundQueue, TypingCoalescer
 
+logger = logging.getLogger(__name__)
 
-class ChatConsumer(WebsocketConsumer):
+
+def record_frame(source, inbound_bytes, started, layer_calls, replies):
+    metrics.observe("frame.seconds", time.perf_counter() - started, source)
+    metrics.observe("frame.inbound_bytes", inbound_bytes, source)
+    metrics.increment("layer.calls", layer_calls, source)
+    metrics.increment("local.replies", replies, source)
+
+
+# Close code for a socket that fell too far behind: the client should
+# reconnect and sync
+RESYNC_CLOSE_CODE = 4008
+
+# Sources that make the receiving sockets join or leave a conversation group
+MEMBERSHIP_SOURCES = {"group.new": "join", "group.remove": "leave"}
+
+
+# Sources that give the receiving sockets a new friend
+FRIEND_SOURCES = {"friend.new", "request.accept"}
+
+
+def broadcast_events(source, data):
+    """A broadcast's ``(source, data)`` events, unpacking batch.events."""
+    if source == "batch.events":
+        return [(event["source"], event["data"]) for event in data["events"]]
+    return [(source, data)]
+
+
+def friend_changes(source, data):
+    """
+    What a broadcast changes in the receiving sockets' friend maps, for
+    ``ChatHandlers.update_friends``, or False for nothing.
+    """
+    events = broadcast_events(source, data)
+    if any(source in FRIEND_SOURCES for source, _ in events):
+        return None
+    updates = [
+        [data["id"], data["friend"]]
+        for source, data in events
+        if source == "friend.update"
+    ]
+    return updates or False
+
+
+def membership_changes(source, data):
+    """
+    ``[action, group]`` pairs for the conversation groups a broadcast
+    makes the receiving sockets join or leave, in order.
+    """
+    return [
+        [MEMBERSHIP_SOURCES[source], Conversation(pk=data["id"]).group_name]
+        for source, data in broadcast_events(source, data)
+        if source in MEMBERSHIP_SOURCES
+    ]
+
+
+def frame(source, data):
+    """The text frame sent to clients."""
+    return json.dumps({"type": "broadcast_group", "source": source, "data": data})
+
+
+def layer_event(source, data):
+    """
+    Channel layer event for a broadcast. The frame is serialized here,
+    once, however many sockets the group reaches.
+    """
+    event = {"type": "broadcast_group", "source": source, "text": frame(source, data)}
+    memberships = membership_changes(source, data)
+    if memberships:
+        event["memberships"] = memberships
+    friends = friend_changes(source, data)
+    if friends is not False:
+        event["friends"] = friends
+    return event
+
+
+def frame_text(event):
+    # Events published without a serialized frame carry the data instead
+    text = event.get("text")
+    return json.dumps(event) if text is None else text
+
+
+class ChatConsumer(ChatHandlers, WebsocketConsumer):
+    """
+    Thread-per-frame consumer, kept for clients on the ``chat/sync/`` route.
+    """
 
     def connect(self):
         user = self.scope["user"]
@@ -29,299 +111,290 @@ class ChatConsumer(WebsocketConsumer):
         self.username = user.username
         # Join the user to a group with their username
         async_to_sync(self.channel_layer.group_add)(self.username, self.channel_name)
+        # And to each of their group conversations
+        conversations, events = self.connect_state(user)
+        self.conversations = set(conversations)
+        for group in self.conversations:
+            async_to_sync(self.channel_layer.group_add)(group, self.channel_name)
 
         self.accept()
+        presence.get_tracker().connect(user.id)
+        self.present = True
+        # Whatever arrived while the user was offline
+        self.publish(events)
 
     def disconnect(self, close_code):
-        # Leave the group
+        if getattr(self, "present", False):
+            presence.get_tracker().disconnect(self.scope["user"].id)
+        # Leave the groups
         async_to_sync(self.channel_layer.group_discard)(
             self.username, self.channel_name
         )
+        for group in getattr(self, "conversations", ()):
+            async_to_sync(self.channel_layer.group_discard)(group, self.channel_name)
 
     # Handle requests
 
-    def receive(self, text_data):
-        print("Received WebSocket message:", text_data)
+    def receive(self, text_data=None, bytes_data=None):
+        started = time.perf_counter()
+        if bytes_data is not None:
+            # Thumbnail upload chunk
+            events = self.receive_thumbnail_chunk(bytes_data)
+            published = self.publish(events)
+            record_frame(
+                "thumbnail.chunk",
+                len(bytes_data),
+                started,
+                published,
+                len(events) - published,
+            )
+            return
+
+        logger.debug("Received WebSocket message: %s", text_data)
         # Recive message from WebSocket
         data = json.loads(text_data)
-        data_source = data.get("source")
-
-        print("receive", json.dumps(data, indent=2))
+        data_source = self.metric_source(data.get("source"))
 
-        # Get friend list
-        if data_source == "friend.list":
-            self.receive_friend_list(data)
+        events = self.handle_tracked(data_source, data)
+        published = self.publish(events)
 
-        # Message has been sent
-        elif data_source == "message.list":
-            self.receive_message_list(data)
-
-        # Message has been sent
-        elif data_source == "message.send":
-            self.receive_message_send(data)
-
-        # User is typying a message
-        elif data_source == "message.type":
-            self.receive_message_type(data)
+        record_frame(
+            data_source,
+            len(text_data.encode()),
+            started,
+            published,
+            len(events) - published,
+        )
 
-        # Accept friend request
-        elif data_source == "request.accept":
-            self.receive_request_accept(data)
+    def publish(self, events):
+        """Send handler events; returns how many went through the layer."""
+        published = 0
+        for group, source, payload in events:
+            if self.is_reply(group, source):
+                self.reply(source, payload)
+            else:
+                self.send_group(group, source, payload)
+                published += 1
+        return published
+
+    def reply(self, source, data):
+        # Straight to this socket, no channel layer round trip
+        text_data = frame(source, data)
+        metrics.observe("frame.outbound_bytes", len(text_data), source)
+        self.send(text_data=text_data)
 
-        # Make friend request
-        elif data_source == "request.connect":
-            self.receive_request_connect(data)
+    # Catch/all broadcast to client helpers
+    def send_group(self, group, source, data):
+        response = layer_event(source, data)
 
-        # Get request list
-        elif data_source == "request.list":
-            self.receive_request_list(data)
+        async_to_sync(self.channel_layer.group_send)(group, response)
 
-        # Search / filter users
-        elif data_source == "user.search":
-            self.recive_search(data)
+    def broadcast_group(self, data):
+        for action, conversation in data.get("memberships", ()):
+            if action == "join":
+                self.conversations.add(conversation)
+                async_to_sync(self.channel_layer.group_add)(
+                    conversation, self.channel_name
+                )
+            else:
+                self.conversations.discard(conversation)
+                async_to_sync(self.channel_layer.group_discard)(
+                    conversation, self.channel_name
+                )
+        if "friends" in data:
+            self.update_friends(data["friends"])
+        text_data = frame_text(data)
+        metrics.observe("frame.outbound_bytes", len(text_data), data["source"])
+        self.send(text_data=text_data)
+
+
+class AsyncChatConsumer(ChatHandlers, AsyncWebsocketConsumer):
+    """
+    Event-loop consumer speaking the same protocol as ``ChatConsumer``.
+
+    Each frame makes at most one ``database_sync_to_async`` hop for its ORM
+    work; sources listed in ``loop_sources`` never leave the event loop.
+    Outbound frames go through a bounded ``OutboundQueue``.
+    """
+
+    # Handlers that don't touch the database
+    loop_sources = {"message.type"}
+
+    async def connect(self):
+        user = self.scope["user"]
 
-        # Thumbnail upload
-        elif data_source == "user.thumbnail":
-            self.receive_thumbnail(data)
+        if not user.is_authenticated:
+            await self.close()
+            return
 
-    def receive_friend_list(self, data):
-        user = self.scope["user"]
-        # Latest message subquery
-        latest_message = Message.objects.filter(connection=OuterRef("id")).order_by(
-            "-created"
-        )[:1]
-        # Get all accepted connections for the user
-        connections = (
-            Connection.objects.filter(Q(sender=user) | Q(receiver=user), accepted=True)
-            .annotate(
-                latest_text=latest_message.values("text"),
-                latest_created=latest_message.values("created"),
+        # Save the username to use as a group name
+        self.username = user.username
+        # Join the user to a group with their username
+        await self.channel_layer.group_add(self.username, self.channel_name)
+        # And to each of their group conversations
+        conversations, events = await database_sync_to_async(self.connect_state)(
+            user
+        )
+        self.conversations = set(conversations)
+        await asyncio.gather(
+            *(
+                self.channel_layer.group_add(group, self.channel_name)
+                for group in self.conversations
             )
-            .order_by(Coalesce("latest_created", "updated").desc())
         )
-        # Serialize connections
-        serialized = FriendSerializer(connections, context={"user": user}, many=True)
-        # Send friend list back to user
-        self.send_group(user.username, "friend.list", serialized.data)
 
-    def receive_message_list(self, data):
-        user = self.scope["user"]
-        connectionId = data.get("connectionId")
-        page = data.get("page")
-        page_size = 20
-
-        # Attempt to fetch the connection object
-        try:
-            connection = Connection.objects.get(id=connectionId)
-        except Connection.DoesNotExist:
-            print("Error: Connection does not exist")
-            return
-        # Get  messages
-        messages = Message.objects.filter(connection=connection).order_by("-created")[
-            page * page_size : (page + 1) * page_size
-        ]
-        # Serialize messages
-        serialized_message = MessageSerializer(
-            messages, context={"user": user}, many=True
+        self.typing = TypingCoalescer(
+            self.send_typing_stop,
+            window=settings.CHAT_TYPING_WINDOW,
+            timeout=settings.CHAT_TYPING_TIMEOUT,
         )
 
-        # Get recipient friend
-        recipient = connection.sender
-        if connection.sender == user:
-            recipient = connection.receiver
-
-        # Serialize friend
-        serialized_friend = UserSerializer(recipient)
-
-        # Count the total number of messages for this connection
-        messages_count = Message.objects.filter(connection=connection).count()
-
-        next_page = page + 1 if messages_count > (page + 1) * page_size else None
-
-        data = {
-            "messages": serialized_message.data,
-            "next": next_page,
-            "friend": serialized_friend.data,
-        }
-
-        # Send back to user
-        self.send_group(user.username, "message.list", data)
-
-    def receive_message_send(self, data):
-        user = self.scope["user"]
-        connectionId = data.get("connectionId")
-        message_text = data.get("message")
-        # Attempt to fetch the connection object
-        try:
-            connection = Connection.objects.get(id=connectionId)
-        except Connection.DoesNotExist:
-            print("Error: Connection does not exist")
-            return
-        # Create message
-        message = Message.objects.create(
-            connection=connection, user=user, text=message_text
+        await self.accept()
+        self.outbound = OutboundQueue(
+            self.send_text,
+            self.fall_behind,
+            limit=settings.CHAT_OUTBOUND_QUEUE_SIZE,
+            deadline=settings.CHAT_OUTBOUND_DEADLINE,
+            max_frames=settings.CHAT_OUTBOUND_MAX_FRAMES,
         )
+        presence.get_tracker().connect(user.id)
+        self.present = True
+        # Whatever arrived while the user was offline
+        await self.publish(events)
+
+    async def disconnect(self, close_code):
+        if getattr(self, "present", False):
+            presence.get_tracker().disconnect(self.scope["user"].id)
+        # Leave the group (the socket may have been rejected before joining)
+        if hasattr(self, "outbound"):
+            await self.outbound.close()
+        if hasattr(self, "username"):
+            await self.typing.close()
+            await self.channel_layer.group_discard(self.username, self.channel_name)
+            await asyncio.gather(
+                *(
+                    self.channel_layer.group_discard(group, self.channel_name)
+                    for group in self.conversations
+                )
+            )
 
-        # Get recipient friend
-        recipient = connection.sender
-        if connection.sender == user:
-            recipient = connection.receiver
-
-        # Send new message back to sender
-        serialized_message = MessageSerializer(message, context={"user": user})
-        serialized_friend = UserSerializer(recipient)
-
-        data = {
-            "message": serialized_message.data,
-            "friend": serialized_friend.data,
-        }
+    # Handle requests
 
-        self.send_group(user.username, "message.send", data)
+    async def receive(self, text_data=None, bytes_data=None):
+        started = time.perf_counter()
+        if bytes_data is not None:
+            events = await self.receive_thumbnail_chunk(bytes_data)
+            published = await self.publish(events)
+            record_frame(
+                "thumbnail.chunk",
+                len(bytes_data),
+                started,
+                published,
+                len(events) - published,
+            )
+            return
 
-        # Send new message to receiver
-        serialized_message = MessageSerializer(message, context={"user": recipient})
-        serialized_friend = UserSerializer(user)
+        logger.debug("Received WebSocket message: %s", text_data)
+        # Recive message from WebSocket
+        data = json.loads(text_data)
+        data_source = self.metric_source(data.get("source"))
 
-        data = {
-            "message": serialized_message.data,
-            "friend": serialized_friend.data,
-        }
+        if data_source in self.loop_sources:
+            events = self.handle(data_source, data)
+        elif data_source == "user.thumbnail":
+            events = await self.receive_thumbnail(data)
+        else:
+            events = await database_sync_to_async(self.handle_tracked)(
+                data_source, data
+            )
 
-        self.send_group(recipient.username, "message.send", data)
+        published = await self.publish(events)
 
-    def receive_message_type(self, data):
-        user = self.scope["user"]
-        recipient_username = data.get("username")
-
-        data = {
-            "username": user.username,
-        }
-        self.send_group(recipient_username, "message.type", data)
-
-    def receive_request_accept(self, data):
-        username = data.get("username")
-        # Attempt to fetch the connection object
-        try:
-            connection = Connection.objects.get(
-                sender__username=username, receiver=self.scope["user"]
-            )
-        except Connection.DoesNotExist:
-            print("Error: Connection does not exist")
-            return
-        # Update the connection
-        connection.accepted = True
-        connection.save()
-        # Serialize connection
-        serialized = RequestSerializer(connection)
-        # Send accepted request to the sender
-        self.send_group(connection.sender.username, "request.accept", serialized.data)
-        # Send accepted request to the receiver
-        self.send_group(connection.receiver.username, "request.accept", serialized.data)
-
-        # Send new friend object to the sender
-        serialized_friend = FriendSerializer(
-            connection, context={"user": connection.sender}
-        )
-        self.send_group(
-            connection.sender.username, "friend.new", serialized_friend.data
-        )
-        # Send new friend object to the receiver
-        serialized_friend = FriendSerializer(
-            connection, context={"user": connection.receiver}
-        )
-        self.send_group(
-            connection.receiver.username, "friend.new", serialized_friend.data
+        record_frame(
+            data_source,
+            len(text_data.encode()),
+            started,
+            published,
+            len(events) - published,
         )
 
-    def receive_request_connect(self, data):
-        username = data.get("username")
-        # Attempt to fetch the recipient user
-        try:
-            receiver = User.objects.get(username=username)
-        except User.DoesNotExist:
-            print("Error: User does not exist")
-            return
-        # Create connection
-        connection, _ = Connection.objects.get_or_create(
-            sender=self.scope["user"], receiver=receiver
-        )
-        # Serialize connection
-        serialized = RequestSerializer(connection)
-        # Send back to sender
-        self.send_group(connection.sender.username, "request.connect", serialized.data)
-        # Send to receiver
-        self.send_group(
-            connection.receiver.username, "request.connect", serialized.data
-        )
+    def receive_message_type(self, data):
+        # Drop typing frames inside the window before they reach the layer
+        return [
+            event
+            for event in super().receive_message_type(data)
+            if self.typing.typing(event[0])
+        ]
 
-    def receive_request_list(self, data):
-        user = self.scope["user"]
-        # Get all connections for the user
-        connections = Connection.objects.filter(receiver=user, accepted=False)
-        # Serialize connections
-        serialized = RequestSerializer(connections, many=True)
-        # Send request list back to user
-        self.send_group(user.username, "request.list", serialized.data)
-
-    def recive_search(self, data):
-
-        query = data.get("query")
-        # Get users from query search term
-        users = (
-            User.objects.filter(
-                Q(username__istartswith=query)
-                | Q(first_name__istartswith=query)
-                | Q(last_name__istartswith=query)
-            )
-            .exclude(username=self.username)
-            .annotate(
-                pending_them=Exists(
-                    Connection.objects.filter(
-                        sender=self.scope["user"],
-                        receiver=OuterRef("id"),
-                        accepted=False,
-                    )
-                ),
-                pending_me=Exists(
-                    Connection.objects.filter(
-                        sender=OuterRef("id"),
-                        receiver=self.scope["user"],
-                        accepted=False,
-                    )
-                ),
-                connected=Exists(
-                    Connection.objects.filter(
-                        Q(sender=self.scope["user"], receiver=OuterRef("id"))
-                        | Q(sender=OuterRef("id"), receiver=self.scope["user"]),
-                        accepted=True,
-                    )
-                ),
-            )
+    async def receive_thumbnail_chunk(self, chunk):
+        # File writes, decoding and rendering variants go to the upload
+        # pool; only pointing user.thumbnail at the result takes the
+        # database thread
+        upload = await uploads.run(self.write_thumbnail_chunk, chunk)
+        if upload is None:
+            return []
+        name = await uploads.run(self.store_thumbnail, upload)
+        if name is None:
+            return []
+        return await database_sync_to_async(self.commit_thumbnail)(upload, name)
+
+    async def receive_thumbnail(self, data):
+        # Decoding and rendering variants go to the upload pool, as for
+        # binary uploads
+        name = await uploads.run(self.store_base64_thumbnail, data)
+        if name is None:
+            return []
+        return await database_sync_to_async(self.save_thumbnail)(name)
+
+    async def publish(self, events):
+        """Send handler events; returns how many went through the layer."""
+        published = 0
+        for group, source, payload in events:
+            if self.is_reply(group, source):
+                await self.reply(source, payload)
+            else:
+                await self.send_group(group, source, payload)
+                published += 1
+        return published
+
+    async def reply(self, source, data):
+        # Straight to this socket, no channel layer round trip
+        text_data = frame(source, data)
+        metrics.observe("frame.outbound_bytes", len(text_data), source)
+        self.outbound.put(source, text_data)
+
+    async def fall_behind(self):
+        # Whatever it missed is in its outbox, or comes with sync
+        logger.warning("%s fell behind, closing its socket", self.username)
+        await self.outbound.close()
+        await self.close(code=RESYNC_CLOSE_CODE)
+
+    async def send_text(self, text_data):
+        await self.send(text_data=text_data)
+
+    async def send_typing_stop(self, recipient_username):
+        await self.send_group(
+            recipient_username, "message.type.stop", {"username": self.username}
         )
-        # Serialize results
-        serialized = SearchSerializer(users, many=True)
-        # Send the results back to the user
-        self.send_group(self.username, "user.search", serialized.data)
-
-    def receive_thumbnail(self, data):
-        user = self.scope["user"]
-        # Convert base64 to dgango content file
-        img_str = data.get("base64")
-        image = ContentFile(base64.b64decode(img_str))
-        # Update user thumbnail
-        filename = data.get("filename")
-        user.thumbnail.save(filename, image, save=True)
-        # Serialize user
-        serialized = UserSerializer(user)
-        # Send serialized user to the group
-        self.send_group(self.username, "user.thumbnail", serialized.data)
 
     # Catch/all broadcast to client helpers
-    def send_group(self, group, source, data):
-        response = {"type": "broadcast_group", "source": source, "data": data}
-
-        async_to_sync(self.channel_layer.group_send)(group, response)
-
-    def broadcast_group(self, data):
-        # data.pop("type")
-        self.send(text_data=json.dumps(data))
+    async def send_group(self, group, source, data):
+        response = layer_event(source, data)
+
+        await self.channel_layer.group_send(group, response)
+
+    async def broadcast_group(self, data):
+        for action, conversation in data.get("memberships", ()):
+            if action == "join":
+                self.conversations.add(conversation)
+                await self.channel_layer.group_add(conversation, self.channel_name)
+            else:
+                self.conversations.discard(conversation)
+                await self.channel_layer.group_discard(
+                    conversation, self.channel_name
+                )
+        if "friends" in data:
+            self.update_friends(data["friends"])
+        text_data = frame_text(data)
+        metrics.observe("frame.outbound_bytes", len(text_data), data["source"])
+        self.outbound.put(data["source"], text_data)
@@ -0,0 +1,214 @@
+"""
+Hand-written encoders for the websocket hot paths.
+
+Each encoder produces exactly the same data as its counterpart in
+``chat.serializers`` (so ``json.dumps`` of either is byte-identical), but
+works from ``values_list()`` tuples and skips DRF's per-field machinery.
+Queries that feed them select the columns named in the ``*_FIELDS``
+tuples, in order.
+"""
+
+from django.utils import timezone
+
+from .models import User
+from .thumbnails import variant_urls
+
+USER_FIELDS = ("id", "username", "first_name", "last_name", "thumbnail")
+MESSAGE_FIELDS = ("id", "user_id", "text", "created")
+
+_thumbnail_storage = User._meta.get_field("thumbnail").storage
+
+
+def related(prefix, fields=USER_FIELDS):
+    """Field names for a related model, e.g. ``related("sender")``."""
+    return tuple(f"{prefix}__{field}" for field in fields)
+
+
+def datetime(value):
+    """
+    DRF ``DateTimeField`` output: ISO 8601 with UTC written as ``Z``.
+
+    Uses the default time zone; consumers never activate another one, and
+    looking up the current one costs more than the formatting itself.
+    """
+    if not value:
+        return None
+    value = value.astimezone(timezone.get_default_timezone()).isoformat()
+    if value.endswith("+00:00"):
+        value = value[:-6] + "Z"
+    return value
+
+
+def thumbnail(name):
+    return _thumbnail_storage.url(name) if name else None
+
+
+def user_row(id, username, first_name, last_name, thumbnail_name):
+    """``UserSerializer`` output for a ``USER_FIELDS`` row."""
+    return {
+        "id": id,
+        "username": username,
+        "name": f"{first_name.capitalize()} {last_name.capitalize()}",
+        "thumbnail": thumbnail(thumbnail_name),
+        "thumbnails": variant_urls(thumbnail_name),
+    }
+
+
+def user(instance):
+    """``UserSerializer`` output for a model instance."""
+    return user_row(
+        instance.id,
+        instance.username,
+        instance.first_name,
+        instance.last_name,
+        instance.thumbnail.name,
+    )
+
+
+def search_status(pending_them, pending_me, connected):
+    if pending_them:
+        return "pending-them"
+    elif pending_me:
+        return "pending-me"
+    elif connected:
+        return "connected"
+
+    return "no-connection"
+
+
+def search_row(row, status):
+    """``SearchSerializer`` output for a ``USER_FIELDS`` row."""
+    data = user_row(*row)
+    data["status"] = status
+    return data
+
+
+def message_row(row, user_id):
+    """``MessageSerializer`` output for a ``MESSAGE_FIELDS`` row."""
+    id, author_id, text, created = row
+    return {
+        "id": id,
+        "is_me": author_id == user_id,
+        "text": text,
+        "created": datetime(created),
+    }
+
+
+def message(instance, user_id):
+    return message_row(
+        (instance.id, instance.user_id, instance.text, instance.created), user_id
+    )
+
+
+# Connection columns, then the user's unread count and the friend's
+# USER_FIELDS (see ``friend_fields``)
+FRIEND_FIELDS = ("id", "latest_text", "activity")
+
+
+def friend_fields(side):
+    """
+    Columns for ``friend_row`` where the user is the connection's ``side``
+    ("sender" or "receiver").
+    """
+    other = "receiver" if side == "sender" else "sender"
+    return (*FRIEND_FIELDS, f"{side}_unread", *related(other))
+
+
+def friend_row(row):
+    """``FriendSerializer`` output for a ``friend_fields`` row."""
+    id, latest_text, activity, unread = row[:4]
+    return {
+        "id": id,
+        "friend": user_row(*row[4:]),
+        "preview": latest_text or "New connection",
+        "updated": activity.isoformat(),
+        "unread": unread,
+    }
+
+
+def friend(connection, user_id):
+    """``FriendSerializer`` output for a connection, as seen by ``user_id``."""
+    if connection.sender_id == user_id:
+        other, unread = connection.receiver, connection.sender_unread
+    else:
+        other, unread = connection.sender, connection.receiver_unread
+    return friend_summary(connection, user(other), unread)
+
+
+def friend_summary(connection, friend, unread):
+    """``friend`` output with the friend already serialized."""
+    return {
+        "id": connection.id,
+        "friend": friend,
+        "preview": connection.latest_text or "New connection",
+        "updated": connection.activity.isoformat(),
+        "unread": unread,
+    }
+
+
+# Connection columns followed by sender and receiver USER_FIELDS
+REQUEST_FIELDS = ("id", "created", "updated")
+
+
+def request_row(row):
+    """``RequestSerializer`` output for ``REQUEST_FIELDS`` + both user rows."""
+    id, created, updated = row[:3]
+    size = len(USER_FIELDS)
+    return {
+        "id": id,
+        "sender": user_row(*row[3 : 3 + size]),
+        "receiver": user_row(*row[3 + size :]),
+        "created": datetime(created),
+        "updated": datetime(updated),
+    }
+
+
+def request(connection):
+    return {
+        "id": connection.id,
+        "sender": user(connection.sender),
+        "receiver": user(connection.receiver),
+        "created": datetime(connection.created),
+        "updated": datetime(connection.updated),
+    }
+
+
+# Group conversations have no serializer counterpart. Their messages are
+# fanned out as one payload to every member, so they carry the author's
+# id ("user") instead of a per-recipient "is_me".
+CONVERSATION_FIELDS = ("id", "name", "latest_text", "activity")
+
+
+def conversation_row(row, size):
+    """A ``CONVERSATION_FIELDS`` row with its member count."""
+    id, name, latest_text, activity = row
+    return {
+        "id": id,
+        "name": name,
+        "preview": latest_text or "New group",
+        "updated": activity.isoformat(),
+        "size": size,
+    }
+
+
+def conversation(instance, size):
+    return conversation_row(
+        (instance.id, instance.name, instance.latest_text, instance.activity), size
+    )
+
+
+def group_message_row(row):
+    """Group message for a ``MESSAGE_FIELDS`` row, the same for every member."""
+    id, author_id, text, created = row
+    return {
+        "id": id,
+        "user": author_id,
+        "text": text,
+        "created": datetime(created),
+    }
+
+
+def group_message(instance):
+    return group_message_row(
+        (instance.id, instance.user_id, instance.text, instance.created)
+    )
@@ -0,0 +1,1300 @@
+import base64
+import itertools
+import logging
+from django.conf import settings
+from django.core.files.base import ContentFile
+from django.db import transaction
+from django.db.models import Case, Count, F, Q, Value, When
+from django.db.models.functions import Coalesce, Least
+from django.utils import timezone
+from django.utils.dateparse import parse_datetime
+
+from .cache import get_friend_list, invalidate_friend_lists, set_friend_list
+from .models import (
+    User,
+    Connection,
+    Conversation,
+    GroupMessage,
+    Membership,
+    Message,
+    search_prefix,
+)
+from .pagination import (
+    InvalidCursor,
+    decode_cursor,
+    decode_message_cursor,
+    encode_cursor,
+)
+from .uploads import InvalidUpload, ThumbnailUpload, check_image
+from .writer import get_writer, save_messages
+from . import encoders, metrics, outbox, presence, search, thumbnails
+from .encoders import FRIEND_FIELDS, MESSAGE_FIELDS, REQUEST_FIELDS, USER_FIELDS
+
+logger = logging.getLogger(__name__)
+
+
+def is_id(value):
+    # bool is an int too
+    return isinstance(value, int) and not isinstance(value, bool)
+
+
+class ChatHandlers:
+    """
+    Request handlers shared by the sync and async chat consumers.
+
+    Handlers do all of their ORM and serializer work synchronously and
+    return the events to broadcast as ``(group, source, data)`` tuples
+    instead of sending them, so a consumer decides how to get onto a
+    thread (or not) and how to publish the results.
+    """
+
+    # Map each websocket source to its handler
+    sources = {
+        "batch": "receive_batch",
+        "friend.list": "receive_friend_list",
+        "group.add": "receive_group_add",
+        "group.create": "receive_group_create",
+        "group.leave": "receive_group_leave",
+        "group.list": "receive_group_list",
+        "group.members": "receive_group_members",
+        "group.message.list": "receive_group_message_list",
+        "group.message.send": "receive_group_message_send",
+        "message.list": "receive_message_list",
+        "message.read": "receive_message_read",
+        "message.search": "receive_message_search",
+        "message.send": "receive_message_send",
+        "message.type": "receive_message_type",
+        "outbox.ack": "receive_outbox_ack",
+        "presence.query": "receive_presence_query",
+        "request.accept": "receive_request_accept",
+        "request.connect": "receive_request_connect",
+        "request.list": "receive_request_list",
+        "sync": "receive_sync",
+        "thumbnail.begin": "receive_thumbnail_begin",
+        "user.search": "recive_search",
+        "user.thumbnail": "receive_thumbnail",
+    }
+
+    # Events for the requesting user that reach all of their sockets, so
+    # their other devices stay in sync; any other event addressed to the
+    # user only answers the socket that asked
+    synced_sources = {
+        "batch.events",
+        "friend.new",
+        "friend.update",
+        "group.new",
+        "group.remove",
+        "message.read",
+        "message.send",
+        "request.accept",
+        "request.connect",
+        "user.thumbnail",
+    }
+
+    # Most queries each handler runs, however many rows it reads or
+    # writes, counting the statements opening transactions and including
+    # the friend map when a socket hasn't loaded it yet. Inserts a full
+    # group makes may be split in chunks, group.add and group.create
+    # allow for those.
+    query_budgets = {
+        # Recording the merged events, the operations count their own
+        "batch": 2,
+        "friend.list": 1,
+        "group.add": 13,
+        "group.create": 15,
+        "group.leave": 4,
+        "group.list": 1,
+        "group.members": 2,
+        "group.message.list": 2,
+        "group.message.send": 5,
+        "message.list": 2,
+        "message.read": 4,
+        "message.search": 3,
+        "message.send": 8,
+        "message.type": 0,
+        "outbox.ack": 10,
+        "presence.query": 1,
+        "request.accept": 4,
+        "request.connect": 6,
+        "request.list": 1,
+        "sync": 5,
+        "thumbnail.begin": 0,
+        "user.search": 2,
+        "user.thumbnail": 2,
+    }
+
+    # Sources a batch can't carry: batches don't nest, typing is
+    # throttled per socket on the async consumer's event loop and
+    # thumbnails are decoded on the upload pool
+    unbatched_sources = {"batch", "message.type", "user.thumbnail"}
+
+    # Sources whose events the outbox may store (see ``outbox.SOURCES``)
+    recorded_sources = {
+        "batch",
+        "group.add",
+        "group.create",
+        "message.send",
+        "request.accept",
+        "request.connect",
+    }
+
+    # The socket's thumbnail upload in progress
+    upload = None
+
+    # The user's accepted connections (see ``friend_map``), loaded when
+    # the socket connects and kept up to date by the events it receives
+    friends = None
+
+    def handle(self, data_source, data):
+        handler = self.sources.get(data_source)
+        if handler is None:
+            return []
+        if data_source not in self.recorded_sources:
+            # Handlers return None when they reject a frame
+            return getattr(self, handler)(data) or []
+        # One commit for the handler's writes and the outbox rows, no
+        # savepoint as nothing here recovers from a failed write
+        with transaction.atomic(savepoint=False):
+            events = getattr(self, handler)(data) or []
+            # Batches record their operations' events before merging them
+            if data_source != "batch":
+                events = outbox.record(events, self.username)
+        return events
+
+    def handle_tracked(self, data_source, data):
+        """``handle``, recording the queries it runs against its budget."""
+        with metrics.track_queries(data_source) as stats:
+            events = self.handle(data_source, data)
+        budget = self.query_budget(data_source, data)
+        if stats.count > budget:
+            metrics.increment("db.over_budget", 1, data_source)
+            logger.warning(
+                "%s ran %d queries, over its budget of %d",
+                data_source,
+                stats.count,
+                budget,
+            )
+        return events
+
+    def query_budget(self, data_source, data):
+        """
+        Most queries a frame may run. A batch gets the sum of its
+        operations' budgets, a run of message.send counting once per
+        conversation it writes to, plus recording its events.
+        """
+        if data_source != "batch":
+            return self.query_budgets.get(data_source, 0)
+        ops = data.get("ops")
+        if not isinstance(ops, list):
+            return 0
+        budget = self.query_budgets["batch"]
+        for source, run in itertools.groupby(
+            ops, key=lambda op: op.get("source") if isinstance(op, dict) else None
+        ):
+            run = list(run)
+            if source == "message.send":
+                conversations = {
+                    op.get("connectionId")
+                    for op in run
+                    if isinstance(op.get("connectionId"), int)
+                }
+                budget += self.query_budgets[source] + max(len(conversations) - 1, 0)
+            elif source != "batch":
+                budget += self.query_budgets.get(source, 0) * len(run)
+        return budget
+
+    def is_reply(self, group, source):
+        """True for events the consumer should write straight to its socket."""
+        return (
+            settings.CHAT_LOCAL_REPLIES
+            and group == self.username
+            and source not in self.synced_sources
+        )
+
+    def metric_source(self, data_source):
+        # Keep metric labels bounded whatever clients send
+        return data_source if data_source in self.sources else "unknown"
+
+    def friend_rows(self, user, **filters):
+        """
+        Accepted connections for the user, latest activity first, as
+        ``encoders.friend_fields`` rows.
+        """
+        # A union rather than an OR lets each side use its own index
+        return (
+            Connection.objects.filter(sender=user, accepted=True, **filters)
+            .values_list(*encoders.friend_fields("sender"))
+            .union(
+                Connection.objects.filter(
+                    receiver=user, accepted=True, **filters
+                ).values_list(*encoders.friend_fields("receiver"))
+            )
+            .order_by("-activity")
+        )
+
+    def connection_ids(self, user):
+        """Ids of the user's accepted connections, the conversations they can read."""
+        return list(
+            Connection.objects.filter(sender=user, accepted=True)
+            .values_list("id", flat=True)
+            .union(
+                Connection.objects.filter(receiver=user, accepted=True).values_list(
+                    "id", flat=True
+                )
+            )
+        )
+
+    def friend_map(self, user):
+        """
+        The user's accepted connections by id, as ``(sender_id, friend)``
+        with the other party serialized.
+        """
+        rows = (
+            Connection.objects.filter(sender=user, accepted=True)
+            .values_list("id", "sender_id", *encoders.related("receiver"))
+            .union(
+                Connection.objects.filter(receiver=user, accepted=True).values_list(
+                    "id", "sender_id", *encoders.related("sender")
+                )
+            )
+        )
+        return {
+            id: (sender_id, encoders.user_row(*friend))
+            for id, sender_id, *friend in rows
+        }
+
+    def friend_connection(self, connection_id):
+        """
+        ``(connection, friend)`` for one of the user's accepted connections,
+        or None, without a query once the friend map is loaded. The
+        connection only has its id and parties set.
+        """
+        user = self.scope["user"]
+        if self.friends is None:
+            self.friends = self.friend_map(user)
+        entry = None
+        if isinstance(connection_id, int):
+            entry = self.friends.get(connection_id)
+        if entry is None:
+            logger.warning("Not one of the user's connections")
+            return None
+        sender_id, friend = entry
+        receiver_id = friend["id"] if sender_id == user.id else user.id
+        connection = Connection(
+            id=connection_id,
+            sender_id=sender_id,
+            receiver_id=receiver_id,
+            accepted=True,
+        )
+        return connection, friend
+
+    def update_friends(self, updates):
+        """
+        Apply a broadcast's changes to the friend map: None drops it, to be
+        reloaded when next needed, otherwise ``[connection_id, friend]``
+        pairs replace the serialized friends.
+        """
+        if updates is None:
+            self.friends = None
+        elif self.friends is not None:
+            for connection_id, friend in updates:
+                if connection_id in self.friends:
+                    sender_id, _ = self.friends[connection_id]
+                    self.friends[connection_id] = (sender_id, friend)
+
+    def load_unread(self, connections):
+        """Set the current unread counts on ``friend_connection`` connections."""
+        counts = Connection.objects.filter(
+            id__in=[connection.id for connection in connections]
+        ).values_list("id", "sender_unread", "receiver_unread")
+        counts = {id: unread for id, *unread in counts}
+        for connection in connections:
+            connection.sender_unread, connection.receiver_unread = counts.get(
+                connection.id, (0, 0)
+            )
+
+    def receive_batch(self, data):
+        """
+        Run the operations in "ops", each a frame's data with its "source"
+        and a client "id", in order.
+
+        Runs of message.send share one connection lookup and one insert.
+        The requesting socket gets one "batch" frame with a result per
+        operation, along with the replies meant for it; every other
+        recipient gets the operations' events merged into one
+        "batch.events" frame.
+        """
+        ops = data.get("ops")
+        if not isinstance(ops, list) or len(ops) > settings.CHAT_BATCH_MAX_OPS:
+            logger.warning("Invalid batch")
+            return None
+
+        outcomes = []
+        for source, run in itertools.groupby(
+            ops, key=lambda op: op.get("source") if isinstance(op, dict) else None
+        ):
+            run = list(run)
+            if source == "message.send":
+                outcomes.extend(self.send_messages(run))
+            elif source in self.sources and source not in self.unbatched_sources:
+                outcomes.extend(getattr(self, self.sources[source])(op) for op in run)
+            else:
+                logger.warning("Unsupported batch operation %s", source)
+                outcomes.extend(None for op in run)
+
+        # Store the events other users must get, as single operations do
+        events = outbox.record(
+            [event for outcome in outcomes for event in outcome or ()],
+            self.username,
+        )
+        events = iter(events)
+        outcomes = [
+            None if outcome is None else [next(events) for _ in outcome]
+            for outcome in outcomes
+        ]
+
+        results = []
+        merged = {}
+        for op, outcome in zip(ops, outcomes):
+            replies = []
+            for group, source, payload in outcome or ():
+                if self.is_reply(group, source):
+                    replies.append({"source": source, "data": payload})
+                else:
+                    merged.setdefault(group, []).append((source, payload))
+            results.append(
+                {
+                    "id": op.get("id") if isinstance(op, dict) else None,
+                    "ok": outcome is not None,
+                    "events": replies,
+                }
+            )
+
+        batch = [(self.username, "batch", {"results": results})]
+        for group, group_events in merged.items():
+            if len(group_events) == 1:
+                batch.append((group, *group_events[0]))
+                continue
+            # Only the newest friend.update per conversation matters
+            updates = {
+                payload["id"]: index
+                for index, (source, payload) in enumerate(group_events)
+                if source == "friend.update"
+            }
+            group_events = [
+                {"source": source, "data": payload}
+                for index, (source, payload) in enumerate(group_events)
+                if source != "friend.update" or updates[payload["id"]] == index
+            ]
+            batch.append((group, "batch.events", {"events": group_events}))
+        return batch
+
+    def send_messages(self, ops):
+        """
+        message.send for several operations with one connection lookup and
+        one insert; returns each operation's events, None if it failed.
+        """
+        user = self.scope["user"]
+        # One instance per conversation, so unread counts add up
+        connections = {}
+        sends = []
+        for op in ops:
+            connection_id = op.get("connectionId")
+            if not isinstance(connection_id, int):
+                connection_id = None
+            if connection_id not in connections:
+                connections[connection_id] = self.friend_connection(connection_id)
+            text = op.get("message")
+            if connections[connection_id] is None or not isinstance(text, str):
+                logger.warning("Invalid message.send operation")
+                sends.append(None)
+                continue
+            connection, friend = connections[connection_id]
+            sends.append(
+                (Message(connection=connection, user=user, text=text), friend)
+            )
+
+        valid = [message for message, _ in filter(None, sends)]
+        if valid:
+            self.load_unread(
+                [connection for connection, _ in filter(None, connections.values())]
+            )
+        if settings.CHAT_MESSAGE_WRITE_BEHIND:
+            for message in valid:
+                get_writer().submit(message)
+        elif valid:
+            save_messages(valid)
+        return [
+            None if send is None else self.message_send_events(*send) for send in sends
+        ]
+
+    def receive_friend_list(self, data):
+        user = self.scope["user"]
+        generation, serialized = get_friend_list(user.id)
+        if serialized is None:
+            # Serialize connections
+            serialized = [encoders.friend_row(row) for row in self.friend_rows(user)]
+            set_friend_list(user.id, generation, serialized)
+        # Send friend list back to user
+        return [(user.username, "friend.list", serialized)]
+
+    def connect_state(self, user):
+        """
+        What a socket needs when it connects: its friend map, its
+        conversation groups and the events that arrived while the user was
+        offline.
+        """
+        self.friends = self.friend_map(user)
+        events = []
+        batch = outbox.batch(user)
+        if batch is not None:
+            events.append((user.username, "outbox", batch))
+        return self.conversation_groups(user), events
+
+    def conversation_groups(self, user):
+        """Channel layer groups for the user's group conversations."""
+        return [
+            Conversation(pk=pk).group_name
+            for pk in Membership.objects.filter(user=user).values_list(
+                "conversation_id", flat=True
+            )
+        ]
+
+    def member_conversation(self, user, data):
+        """The "groupId" conversation if the user is a member, else None."""
+        try:
+            return Conversation.objects.get(
+                id=data.get("groupId"), memberships__user=user
+            )
+        except (Conversation.DoesNotExist, ValueError, TypeError):
+            logger.warning("Not a member of the conversation")
+            return None
+
+    def friends_named(self, user, usernames):
+        """The user's friends among ``usernames``."""
+        if not isinstance(usernames, list):
+            return User.objects.none()
+        return User.objects.filter(
+            Q(sent_connections__receiver=user, sent_connections__accepted=True)
+            | Q(received_connections__sender=user, received_connections__accepted=True),
+            username__in=[name for name in usernames if isinstance(name, str)],
+        ).distinct()
+
+    def add_members(self, user, conversation, usernames):
+        """
+        Add the user's friends among ``usernames`` to the conversation;
+        returns the usernames added and the conversation as serialized
+        afterwards.
+        """
+        size = Membership.objects.filter(conversation=conversation).count()
+        added = list(
+            self.friends_named(user, usernames)
+            .exclude(memberships__conversation=conversation)
+            .values_list("id", "username")[
+                : max(settings.CHAT_GROUP_MAX_MEMBERS - size, 0)
+            ]
+        )
+        Membership.objects.bulk_create(
+            Membership(conversation=conversation, user_id=pk) for pk, _ in added
+        )
+        size += len(added)
+        return [username for _, username in added], encoders.conversation(
+            conversation, size
+        )
+
+    def receive_group_add(self, data):
+        user = self.scope["user"]
+        conversation = self.member_conversation(user, data)
+        if conversation is None:
+            return None
+        added, serialized = self.add_members(user, conversation, data.get("usernames"))
+        if not added:
+            return []
+        # Existing members hear about it in one fan-out; new members get
+        # group.new, their sockets join the conversation group on receipt
+        update = {"group": serialized, "added": added, "removed": []}
+        return [(conversation.group_name, "group.update", update)] + [
+            (username, "group.new", serialized) for username in added
+        ]
+
+    def receive_group_create(self, data):
+        """Create a group conversation with the user and friends in "usernames"."""
+        user = self.scope["user"]
+        name = data.get("name")
+        if not isinstance(name, str) or not name.strip():
+            logger.warning("Group name missing")
+            return None
+        with transaction.atomic():
+            conversation = Conversation.objects.create(
+                name=name.strip()[:100], created_by=user
+            )
+            Membership.objects.create(conversation=conversation, user=user)
+            added, serialized = self.add_members(
+                user, conversation, data.get("usernames")
+            )
+        return [
+            (username, "group.new", serialized)
+            for username in [user.username, *added]
+        ]
+
+    def receive_group_leave(self, data):
+        user = self.scope["user"]
+        conversation = self.member_conversation(user, data)
+        if conversation is None:
+            return None
+        Membership.objects.filter(conversation=conversation, user=user).delete()
+        size = Membership.objects.filter(conversation=conversation).count()
+        update = {
+            "group": encoders.conversation(conversation, size),
+            "added": [],
+            "removed": [user.username],
+        }
+        return [
+            # Every socket of the user leaves the conversation group
+            (user.username, "group.remove", {"id": conversation.id}),
+            (conversation.group_name, "group.update", update),
+        ]
+
+    def receive_group_list(self, data):
+        user = self.scope["user"]
+        # Filtered through a subquery so the count joins all memberships,
+        # not just the user's
+        conversations = (
+            Conversation.objects.filter(
+                id__in=Membership.objects.filter(user=user).values("conversation_id")
+            )
+            .annotate(size=Count("memberships"))
+            .order_by("-activity")
+            .values_list(*encoders.CONVERSATION_FIELDS, "size")
+        )
+        serialized = [
+            encoders.conversation_row(row[:4], row[4]) for row in conversations
+        ]
+        return [(user.username, "group.list", serialized)]
+
+    def receive_group_members(self, data):
+        user = self.scope["user"]
+        conversation = self.member_conversation(user, data)
+        if conversation is None:
+            return None
+        members = (
+            User.objects.filter(memberships__conversation=conversation)
+            .order_by("username")
+            .values_list(*USER_FIELDS)
+        )
+        data = {
+            "id": conversation.id,
+            "members": [encoders.user_row(*row) for row in members],
+        }
+        return [(user.username, "group.members", data)]
+
+    def receive_group_message_list(self, data):
+        """A page of group messages, newest first, continued with "before"."""
+        user = self.scope["user"]
+        conversation = self.member_conversation(user, data)
+        if conversation is None:
+            return None
+        page_size = 20
+        messages = GroupMessage.objects.filter(conversation=conversation).order_by(
+            "-created", "-id"
+        )
+        if data.get("before"):
+            try:
+                created, pk = decode_message_cursor(data["before"])
+            except InvalidCursor:
+                logger.warning("Invalid message cursor")
+                return None
+            messages = messages.filter(
+                Q(created__lt=created) | Q(created=created, id__lt=pk)
+            )
+
+        # Fetch one extra row to know if there is a next page
+        messages = list(messages.values_list(*MESSAGE_FIELDS)[: page_size + 1])
+        has_more = len(messages) > page_size
+        messages = messages[:page_size]
+
+        next_page = None
+        if has_more:
+            last_id, _, _, last_created = messages[-1]
+            next_page = encode_cursor(last_created, last_id)
+        data = {
+            "id": conversation.id,
+            "messages": [encoders.group_message_row(row) for row in messages],
+            "next": next_page,
+        }
+        return [(user.username, "group.message.list", data)]
+
+    def receive_group_message_send(self, data):
+        user = self.scope["user"]
+        conversation = self.member_conversation(user, data)
+        if conversation is None:
+            return None
+        text = data.get("message")
+        if not isinstance(text, str) or not text:
+            logger.warning("Empty group message")
+            return None
+        message = GroupMessage(conversation=conversation, user=user, text=text)
+        with transaction.atomic():
+            message.save()
+            # Queryset update, the summary is all that changes
+            Conversation.objects.filter(pk=conversation.pk).update(
+                latest_text=message.text, activity=message.created
+            )
+        data = {"id": conversation.id, "message": encoders.group_message(message)}
+        # One event for every member, including the sender's other sockets
+        return [(conversation.group_name, "group.message.send", data)]
+
+    def receive_message_list(self, data):
+        user = self.scope["user"]
+        page_size = 20
+
+        friend_connection = self.friend_connection(data.get("connectionId"))
+        if friend_connection is None:
+            return None
+        connection, friend = friend_connection
+        # Get  messages, newest first
+        messages = Message.objects.filter(connection_id=connection.id).order_by(
+            "-created", "-id"
+        )
+
+        # Clients sending "before" (null for the first page) get keyset
+        # pagination, older clients keep using the "page" offset
+        cursor_mode = "before" in data
+        if cursor_mode:
+            before = data.get("before")
+            if before:
+                try:
+                    created, pk = decode_message_cursor(before)
+                except InvalidCursor:
+                    logger.warning("Invalid message cursor")
+                    return None
+                messages = messages.filter(
+                    Q(created__lt=created) | Q(created=created, id__lt=pk)
+                )
+            page = None
+            offset = 0
+        else:
+            page = data.get("page") or 0
+            offset = page * page_size
+
+        # Fetch one extra row to know if there is a next page
+        messages = list(
+            messages.values_list(*MESSAGE_FIELDS)[offset : offset + page_size + 1]
+        )
+        has_more = len(messages) > page_size
+        messages = messages[:page_size]
+
+        # Serialize messages
+        serialized_message = [encoders.message_row(row, user.id) for row in messages]
+
+        next_page = None
+        if has_more:
+            if cursor_mode:
+                last_id, _, _, last_created = messages[-1]
+                next_page = encode_cursor(last_created, last_id)
+            else:
+                next_page = page + 1
+
+        data = {
+            "messages": serialized_message,
+            "next": next_page,
+            "friend": friend,
+        }
+
+        # Send back to user
+        return [(user.username, "message.list", data)]
+
+    def receive_message_read(self, data):
+        """
+        Mark a conversation read up to "messageId" (default: its latest
+        message) and send a read receipt to both parties.
+        """
+        user = self.scope["user"]
+        friend_connection = self.friend_connection(data.get("connectionId"))
+        if friend_connection is None:
+            return None
+        connection, friend = friend_connection
+        side = "sender" if user.id == connection.sender_id else "receiver"
+
+        if "messageId" in data:
+            read_up_to = data["messageId"]
+            if not is_id(read_up_to) or not (
+                Message.objects.filter(
+                    pk=read_up_to, connection_id=connection.id
+                ).exists()
+            ):
+                logger.warning("Invalid message id")
+                return None
+        else:
+            read_up_to = (
+                Connection.objects.filter(pk=connection.pk)
+                .values_list("latest_message_id", flat=True)
+                .first()
+            )
+            if read_up_to is None:
+                # No messages yet
+                return []
+        # Never past the latest message, so later ones still count
+        read = Least(Value(read_up_to), Coalesce(F("latest_message_id"), 0))
+        read_field = f"{side}_read_up_to"
+        unread_field = f"{side}_unread"
+        # In one statement, so a message saved meanwhile is either counted
+        # after the reset or keeps the count: fully read only if nothing
+        # newer arrived, otherwise only the marker moves. Never backwards.
+        unread = Case(
+            When(latest_message_id__lte=read_up_to, then=Value(0)),
+            default=F(unread_field),
+        )
+        Connection.objects.filter(
+            pk=connection.pk, **{f"{read_field}__lt": read}
+        ).update(**{read_field: read, unread_field: unread})
+        invalidate_friend_lists(user.id)
+
+        receipt = {
+            "connectionId": connection.id,
+            "username": user.username,
+            "messageId": read_up_to,
+        }
+        return [
+            (user.username, "message.read", receipt),
+            (friend["username"], "message.read", receipt),
+        ]
+
+    def receive_message_search(self, data):
+        """
+        Full-text search over the user's conversations, best matches
+        first, pages continued with "cursor".
+        """
+        user = self.scope["user"]
+        query = (data.get("query") or "").strip()
+        if not search.available():
+            logger.warning("Message search needs SQLite FTS5")
+            return None
+        page_size = settings.CHAT_MESSAGE_SEARCH_PAGE_SIZE
+
+        after = None
+        if data.get("cursor"):
+            try:
+                after = decode_cursor(data["cursor"])
+                rank, pk = after
+            except (InvalidCursor, TypeError, ValueError):
+                logger.warning("Invalid search cursor")
+                return None
+            if not isinstance(rank, (int, float)) or not isinstance(pk, int):
+                logger.warning("Invalid search cursor")
+                return None
+
+        # Fetch one extra row to know if there is a next page
+        rows = search.search_messages(
+            query,
+            self.connection_ids(user),
+            page_size + 1,
+            after=after,
+            highlight=settings.CHAT_MESSAGE_SEARCH_HIGHLIGHT,
+        )
+        has_more = len(rows) > page_size
+        rows = rows[:page_size]
+
+        results = [
+            {
+                "connectionId": row[4],
+                "message": encoders.message_row(row[:4], user.id),
+                "snippet": row[5],
+            }
+            for row in rows
+        ]
+        next_cursor = None
+        if has_more:
+            last = rows[-1]
+            next_cursor = encode_cursor(last[-1], last[0])
+        return [
+            (
+                self.username,
+                "message.search",
+                {"query": query, "results": results, "next": next_cursor},
+            )
+        ]
+
+    def receive_message_send(self, data):
+        user = self.scope["user"]
+        message_text = data.get("message")
+        friend_connection = self.friend_connection(data.get("connectionId"))
+        if friend_connection is None:
+            return None
+        if not isinstance(message_text, str):
+            logger.warning("Invalid message.send operation")
+            return None
+        connection, friend = friend_connection
+        # Create message, along with the summary shown in friend.list
+        message = Message(connection=connection, user=user, text=message_text)
+        self.load_unread([connection])
+        if settings.CHAT_MESSAGE_WRITE_BEHIND:
+            get_writer().submit(message)
+        else:
+            save_messages([message])
+        return self.message_send_events(message, friend)
+
+    def message_send_events(self, message, friend):
+        """
+        Events for a saved message: the message to both parties and the
+        moved conversation in both friend lists. The message's connection
+        has the unread counts from before it.
+        """
+        user = self.scope["user"]
+        connection = message.connection
+        serialized_user = encoders.user(user)
+
+        # Send new message back to sender
+        sender_data = {
+            "message": encoders.message(message, user.id),
+            "friend": friend,
+        }
+
+        # Send new message to receiver
+        recipient_data = {
+            "message": encoders.message(message, friend["id"]),
+            "friend": serialized_user,
+        }
+
+        # The conversation moved, update it in both friend lists
+        connection.latest_text = message.text
+        connection.activity = message.created
+        if user.id == connection.sender_id:
+            connection.receiver_unread += 1
+            unread, recipient_unread = (
+                connection.sender_unread,
+                connection.receiver_unread,
+            )
+        else:
+            connection.sender_unread += 1
+            unread, recipient_unread = (
+                connection.receiver_unread,
+                connection.sender_unread,
+            )
+
+        return [
+            (user.username, "message.send", sender_data),
+            (friend["username"], "message.send", recipient_data),
+            (
+                user.username,
+                "friend.update",
+                encoders.friend_summary(connection, friend, unread),
+            ),
+            (
+                friend["username"],
+                "friend.update",
+                encoders.friend_summary(connection, serialized_user, recipient_unread),
+            ),
+        ]
+
+    def receive_message_type(self, data):
+        # No database access, so this is safe to call from the event loop
+        user = self.scope["user"]
+        recipient_username = data.get("username")
+
+        data = {
+            "username": user.username,
+        }
+        return [(recipient_username, "message.type", data)]
+
+    def receive_outbox_ack(self, data):
+        """
+        Acknowledge outbox events up to "upTo" and group messages up to the
+        "upTo" of each of "groups", ``{"id", "upTo"}`` objects as in the
+        outbox batch; with "next", reply with the next batch.
+        """
+        user = self.scope["user"]
+        up_to = data.get("upTo")
+        groups = data.get("groups", [])
+        valid_groups = isinstance(groups, list) and all(
+            isinstance(group, dict)
+            and is_id(group.get("id"))
+            and is_id(group.get("upTo"))
+            for group in groups
+        )
+        # Either or both
+        if not valid_groups or not (is_id(up_to) or up_to is None and groups):
+            logger.warning("Invalid outbox ack")
+            return None
+        if up_to is not None:
+            outbox.ack(user.username, up_to)
+        if groups:
+            outbox.ack_groups(user, {group["id"]: group["upTo"] for group in groups})
+        if data.get("next"):
+            batch = outbox.batch(user)
+            if batch is not None:
+                return [(user.username, "outbox", batch)]
+        return []
+
+    def receive_presence_query(self, data):
+        """
+        Online state and last seen time of the user's friends, or of the
+        friends among "usernames".
+        """
+        user = self.scope["user"]
+        usernames = data.get("usernames")
+        friends = [
+            (friend_id, username, last_seen)
+            for _, friend_id, username, last_seen in presence.friend_presence(
+                {user.id}
+            )
+            if not isinstance(usernames, list) or username in usernames
+        ]
+        online = presence.online_ids({friend_id for friend_id, _, _ in friends})
+        data = {
+            "users": [
+                presence.presence_row(username, last_seen, friend_id in online)
+                for friend_id, username, last_seen in friends
+            ]
+        }
+        return [(user.username, "presence.query", data)]
+
+    def receive_request_accept(self, data):
+        username = data.get("username")
+        # Attempt to fetch the connection object
+        try:
+            connection = Connection.objects.select_related("sender", "receiver").get(
+                sender__username=username, receiver=self.scope["user"]
+            )
+        except Connection.DoesNotExist:
+            logger.warning("Connection does not exist")
+            return None
+        # Update the connection
+        connection.accepted = True
+        if connection.latest_message_id is None:
+            connection.activity = timezone.now()
+        # Only the changed fields, the unread counters move concurrently
+        connection.save(update_fields=["accepted", "activity", "updated"])
+        invalidate_friend_lists(connection.sender_id, connection.receiver_id)
+        # New friend, reload the map when next needed
+        self.friends = None
+        # Serialize connection
+        serialized = encoders.request(connection)
+        # Send new friend object to each side of the connection
+        serialized_sender_friend = encoders.friend(connection, connection.sender_id)
+        serialized_receiver_friend = encoders.friend(
+            connection, connection.receiver_id
+        )
+        return [
+            # Send accepted request to the sender
+            (connection.sender.username, "request.accept", serialized),
+            # Send accepted request to the receiver
+            (connection.receiver.username, "request.accept", serialized),
+            (connection.sender.username, "friend.new", serialized_sender_friend),
+            (connection.receiver.username, "friend.new", serialized_receiver_friend),
+        ]
+
+    def receive_request_connect(self, data):
+        username = data.get("username")
+        # Attempt to fetch the recipient user
+        try:
+            receiver = User.objects.get(username=username)
+        except User.DoesNotExist:
+            logger.warning("User does not exist")
+            return None
+        # Create connection
+        connection, _ = Connection.objects.select_related(
+            "sender", "receiver"
+        ).get_or_create(sender=self.scope["user"], receiver=receiver)
+        # Serialize connection
+        serialized = encoders.request(connection)
+        return [
+            # Send back to sender
+            (connection.sender.username, "request.connect", serialized),
+            # Send to receiver
+            (connection.receiver.username, "request.connect", serialized),
+        ]
+
+    def receive_request_list(self, data):
+        user = self.scope["user"]
+        # Get all connections for the user
+        connections = Connection.objects.filter(
+            receiver=user, accepted=False
+        ).values_list(
+            *REQUEST_FIELDS, *encoders.related("sender"), *encoders.related("receiver")
+        )
+        # Serialize connections
+        serialized = [encoders.request_row(row) for row in connections]
+        # Send request list back to user
+        return [(user.username, "request.list", serialized)]
+
+    def receive_sync(self, data):
+        """
+        Everything since a watermark, for clients catching up after a
+        reconnect: new messages across all conversations, oldest first,
+        plus friends with newer activity and pending requests.
+
+        The watermark is "cursor" (from a previous sync), "after" (the id
+        of the last message seen) or "since" (an ISO 8601 time). While
+        "more" is true, sync again from the returned "cursor".
+        """
+        user = self.scope["user"]
+        max_messages = settings.CHAT_SYNC_MAX_MESSAGES
+
+        connection_ids = self.connection_ids(user)
+
+        # Resolve the watermark to a (created, id) position
+        try:
+            if data.get("cursor"):
+                created, pk = decode_message_cursor(data["cursor"])
+            elif data.get("after") is not None:
+                created, pk = (
+                    Message.objects.filter(
+                        id=data["after"], connection_id__in=connection_ids
+                    )
+                    .values_list("created", "id")
+                    .get()
+                )
+            else:
+                created = parse_datetime(data.get("since") or "")
+                pk = 0
+                if created is None:
+                    raise InvalidCursor(data.get("since"))
+                if timezone.is_naive(created):
+                    created = timezone.make_aware(created)
+        except (InvalidCursor, ValueError, Message.DoesNotExist):
+            logger.warning("Invalid sync watermark")
+            return None
+
+        # Walks the (connection, created) index of each conversation;
+        # fetch one extra row to know if there is more
+        messages = list(
+            Message.objects.filter(
+                connection_id__in=connection_ids, created__gte=created
+            )
+            .exclude(created=created, id__lte=pk)
+            .order_by("created", "id")
+            .values_list("connection_id", *MESSAGE_FIELDS)[: max_messages + 1]
+        )
+        has_more = len(messages) > max_messages
+        messages = messages[:max_messages]
+
+        friends = self.friend_rows(user, activity__gt=created)
+        requests = Connection.objects.filter(
+            receiver=user, accepted=False, created__gt=created
+        ).values_list(
+            *REQUEST_FIELDS, *encoders.related("sender"), *encoders.related("receiver")
+        )
+
+        # The next sync starts after the last message returned
+        watermark = (created, pk)
+        if messages:
+            _, last_id, _, _, last_created = messages[-1]
+            watermark = (last_created, last_id)
+
+        data = {
+            "messages": [
+                {
+                    "connectionId": row[0],
+                    "message": encoders.message_row(row[1:], user.id),
+                }
+                for row in messages
+            ],
+            "friends": [encoders.friend_row(row) for row in friends],
+            "requests": [encoders.request_row(row) for row in requests],
+            "cursor": encode_cursor(*watermark),
+            "more": has_more,
+        }
+        return [(self.username, "sync", data)]
+
+    def recive_search(self, data):
+        user = self.scope["user"]
+        query = (data.get("query") or "").strip()
+
+        # Clients sending "cursor" (null for the first page) get a page
+        # object back, older clients get a plain, capped list
+        cursor_mode = "cursor" in data
+        limit = data.get("limit")
+        if not isinstance(limit, int) or limit < 1:
+            limit = settings.CHAT_SEARCH_PAGE_SIZE
+        limit = min(limit, settings.CHAT_SEARCH_MAX_PAGE_SIZE)
+
+        # Get users from query search term, by username
+        users = (
+            User.objects.filter(search_prefix(query))
+            .exclude(username=self.username)
+            .order_by("username")
+        )
+        if cursor_mode and data.get("cursor"):
+            try:
+                [after] = decode_cursor(data["cursor"])
+            except (InvalidCursor, ValueError):
+                logger.warning("Invalid search cursor")
+                return None
+            users = users.filter(username__gt=after)
+
+        rows = []
+        if len(query) >= settings.CHAT_SEARCH_MIN_LENGTH:
+            # Fetch one extra row to know if there is a next page
+            rows = list(users.values_list(*USER_FIELDS)[: limit + 1])
+        has_more = len(rows) > limit
+        rows = rows[:limit]
+
+        # Relationship status for the whole page in one query
+        ids = [row[0] for row in rows]
+        pending_them, pending_me, connected = set(), set(), set()
+        pairs = Connection.objects.filter(
+            Q(sender=user, receiver__in=ids) | Q(sender__in=ids, receiver=user)
+        ).values_list("sender_id", "receiver_id", "accepted")
+        for sender_id, receiver_id, accepted in pairs:
+            if accepted:
+                connected.update((sender_id, receiver_id))
+            elif sender_id == user.id:
+                pending_them.add(receiver_id)
+            else:
+                pending_me.add(sender_id)
+
+        # Serialize results
+        serialized = [
+            encoders.search_row(
+                row,
+                encoders.search_status(
+                    row[0] in pending_them, row[0] in pending_me, row[0] in connected
+                ),
+            )
+            for row in rows
+        ]
+        if cursor_mode:
+            serialized = {
+                "results": serialized,
+                "next": encode_cursor(rows[-1][1]) if has_more else None,
+            }
+        # Send the results back to the user
+        return [(self.username, "user.search", serialized)]
+
+    def receive_thumbnail(self, data):
+        name = self.store_base64_thumbnail(data)
+        if name is None:
+            return None
+        return self.save_thumbnail(name)
+
+    def store_base64_thumbnail(self, data):
+        """
+        Decode a "base64" thumbnail and store it with its variants; returns
+        the stored name, or None if it was rejected. No database access.
+        """
+        # Convert base64 to dgango content file
+        try:
+            image = ContentFile(base64.b64decode(data.get("base64")))
+        except (TypeError, ValueError):
+            logger.warning("Invalid thumbnail: not base64")
+            return None
+        try:
+            extension = check_image(image, settings.CHAT_THUMBNAIL_MAX_PIXELS)
+        except InvalidUpload as error:
+            logger.warning("Invalid thumbnail: %s", error)
+            return None
+        return thumbnails.store(image, extension)
+
+    def receive_thumbnail_begin(self, data):
+        """
+        Open a binary upload of "size" bytes, or resume "uploadId" from
+        the returned offset.
+        """
+        user = self.scope["user"]
+        # A new begin replaces any upload in progress, whose part file is
+        # removed unless this resumes it
+        self.upload = None
+        try:
+            self.upload = ThumbnailUpload.open(
+                user.id, data.get("filename"), data.get("size"), data.get("uploadId")
+            )
+        except InvalidUpload as error:
+            logger.warning("Invalid thumbnail upload: %s", error)
+            return None
+        data = {
+            "uploadId": self.upload.upload_id,
+            "offset": self.upload.offset,
+            "size": self.upload.size,
+        }
+        return [(self.username, "thumbnail.begin", data)]
+
+    def receive_thumbnail_chunk(self, chunk):
+        """Handle a binary frame from start to finish, on the calling thread."""
+        upload = self.write_thumbnail_chunk(chunk)
+        if upload is None:
+            return []
+        name = self.store_thumbnail(upload)
+        if name is None:
+            return []
+        return self.commit_thumbnail(upload, name)
+
+    def write_thumbnail_chunk(self, chunk):
+        """Append a binary frame to the upload; returns it once complete."""
+        upload = self.upload
+        if upload is None:
+            logger.warning("Binary frame without thumbnail.begin")
+            return None
+        try:
+            complete = upload.write(chunk)
+        except InvalidUpload as error:
+            logger.warning("Invalid thumbnail upload: %s", error)
+            self.upload = None
+            upload.discard()
+            return None
+        if not complete:
+            return None
+        self.upload = None
+        return upload
+
+    def store_thumbnail(self, upload):
+        """
+        Decode a complete upload and store it with its variants; returns
+        the stored name, or None if it was rejected. No database access.
+        """
+        try:
+            with open(upload.path, "rb") as image:
+                extension = check_image(image, settings.CHAT_THUMBNAIL_MAX_PIXELS)
+                return thumbnails.store(image, extension)
+        except InvalidUpload as error:
+            logger.warning("Invalid thumbnail upload: %s", error)
+            upload.discard()
+            return None
+
+    def commit_thumbnail(self, upload, name):
+        """Point the user's thumbnail at a stored upload."""
+        events = self.save_thumbnail(name)
+        upload.discard()
+        return events
+
+    def save_thumbnail(self, name):
+        """Point the user's thumbnail at a stored image."""
+        user = self.scope["user"]
+        with metrics.track_queries("thumbnail.commit"):
+            user.thumbnail.name = name
+            user.save(update_fields=["thumbnail"])
+            return self.thumbnail_events(user)
+
+    def thumbnail_events(self, user):
+        """Push a new thumbnail to the user and every friend list showing it."""
+        # Serialize user
+        serialized = encoders.user(user)
+
+        # Every friend list showing the user is out of date; select each
+        # conversation as the friend sees it
+        friends = list(
+            Connection.objects.filter(sender=user, accepted=True)
+            .values_list(
+                *FRIEND_FIELDS, "receiver_unread", "receiver_id", "receiver__username"
+            )
+            .union(
+                Connection.objects.filter(receiver=user, accepted=True).values_list(
+                    *FRIEND_FIELDS, "sender_unread", "sender_id", "sender__username"
+                )
+            )
+        )
+        invalidate_friend_lists(*(row[4] for row in friends))
+
+        # Send serialized user to the group
+        events = [(self.username, "user.thumbnail", serialized)]
+        # Update the conversation in each friend's list
+        for id, latest_text, activity, unread, _, username in friends:
+            friend = {
+                "id": id,
+                "friend": serialized,
+                "preview": latest_text or "New connection",
+                "updated": activity.isoformat(),
+                "unread": unread,
+            }
+            events.append((username, "friend.update", friend))
+        return events
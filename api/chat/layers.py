@@ -0,0 +1,58 @@
+"""
+A Redis channel layer sharded across several servers.
+
+``channels_redis`` already spreads groups and channels over every host in
+"hosts", but by ranges of a CRC32, so adding a host moves most of them to
+another server. ``ShardedRedisChannelLayer`` places them with a jump
+consistent hash instead: appending a host moves about ``1/n`` of the
+groups and channels, all of them onto the new host. Hosts may only ever
+be appended; reordering or removing one remaps everything after it.
+
+Every process must use the same host list. Sockets already in a group
+that moved keep missing its events until they reconnect and join it
+again, so add hosts while traffic is low.
+
+Group sends are counted and timed per shard in ``chat.metrics``, labelled
+with the shard's position in the host list.
+"""
+
+import hashlib
+import time
+
+from channels_redis.core import RedisChannelLayer
+
+from . import metrics
+
+
+def jump_hash(key, buckets):
+    """Lamping and Veach's jump consistent hash of a 64-bit ``key``."""
+    bucket, jump = -1, 0
+    while jump < buckets:
+        bucket = jump
+        key = (key * 2862933555777941757 + 1) & 0xFFFFFFFFFFFFFFFF
+        jump = int((bucket + 1) * ((1 << 31) / ((key >> 33) + 1)))
+    return bucket
+
+
+def shard_for(name, shards):
+    """The shard, out of ``shards``, a group or channel name lives on."""
+    if isinstance(name, str):
+        name = name.encode("utf8")
+    digest = hashlib.blake2b(name, digest_size=8).digest()
+    return jump_hash(int.from_bytes(digest, "big"), shards)
+
+
+class ShardedRedisChannelLayer(RedisChannelLayer):
+    """``RedisChannelLayer`` placing keys with ``shard_for``."""
+
+    def consistent_hash(self, value):
+        return shard_for(value, self.ring_size)
+
+    async def group_send(self, group, message):
+        shard = str(self.consistent_hash(group))
+        started = time.perf_counter()
+        await super().group_send(group, message)
+        metrics.observe(
+            "layer.shard.group_send_seconds", time.perf_counter() - started, shard
+        )
+        metrics.increment("layer.shard.group_sends", 1, shard)
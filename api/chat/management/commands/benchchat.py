@@ -0,0 +1,253 @@
+import asyncio
+import json
+import platform
+import random
+import subprocess
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+
+from chat.benchmark import (
+    LoadClient,
+    bench_environment,
+    close_all,
+    connect_all,
+    create_friends,
+    summarize,
+)
+from chat import metrics
+from chat.models import Message
+
+# Relative frequency of each source in the replayed traffic
+DEFAULT_MIX = {
+    "message.type": 40,
+    "message.send": 25,
+    "message.list": 15,
+    "friend.list": 10,
+    "user.search": 10,
+}
+
+# Sources that get no reply to the sender; only their send is timed
+FIRE_AND_FORGET = {"message.type"}
+
+
+class Command(BaseCommand):
+    help = (
+        "Replay a mix of chat frames from simulated users against "
+        "core.asgi.application, using a test database and the in-memory "
+        "channel layer, and report throughput and latency per source."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--users", type=int, default=100)
+        parser.add_argument(
+            "--duration", type=float, default=10.0, help="Seconds of load."
+        )
+        parser.add_argument(
+            "--history",
+            type=int,
+            default=200,
+            help="Messages preloaded into each conversation.",
+        )
+        parser.add_argument(
+            "--mix",
+            type=json.loads,
+            default=DEFAULT_MIX,
+            help='JSON weights per source, e.g. \'{"message.send": 1}\'.',
+        )
+        parser.add_argument("--path", default="/chat/", help="Websocket route.")
+        parser.add_argument(
+            "--database",
+            choices=["memory", "file"],
+            default="memory",
+            help="Where the SQLite test database lives; use file to count fsyncs.",
+        )
+        parser.add_argument(
+            "--write-behind",
+            action="store_true",
+            help="Persist message.send through the background writer.",
+        )
+        parser.add_argument(
+            "--no-local-replies",
+            dest="local_replies",
+            action="store_false",
+            help="Send replies through the channel layer too, for comparison.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--output", help="Write the JSON results to this file.")
+        parser.add_argument(
+            "--compare", help="Earlier JSON results to print deltas against."
+        )
+
+    def handle(self, *args, **options):
+        # Imported late so Django is fully configured first
+        from core.asgi import application
+
+        unknown = set(options["mix"]) - set(DEFAULT_MIX)
+        if unknown:
+            raise CommandError(f"Unsupported sources in --mix: {sorted(unknown)}")
+
+        users = options["users"] + options["users"] % 2
+        with bench_environment(
+            database=options["database"],
+            CHAT_MESSAGE_WRITE_BEHIND=options["write_behind"],
+            CHAT_LOCAL_REPLIES=options["local_replies"],
+        ):
+            friends = create_friends(users)
+            self.preload(options["history"])
+            results = asyncio.run(self.run(application, friends, options))
+
+        results["config"] = {
+            key: options[key]
+            for key in (
+                "users",
+                "duration",
+                "history",
+                "mix",
+                "path",
+                "seed",
+                "database",
+                "write_behind",
+                "local_replies",
+            )
+        }
+        results["environment"] = {
+            "commit": self.commit(),
+            "python": platform.python_version(),
+            "machine": platform.machine(),
+        }
+
+        output = json.dumps(results, indent=2)
+        if options["output"]:
+            with open(options["output"], "w") as f:
+                f.write(output)
+        self.stdout.write(output)
+
+        if options["compare"]:
+            with open(options["compare"]) as f:
+                self.compare(json.load(f), results)
+
+    def preload(self, history):
+        from chat.models import Connection
+
+        messages = []
+        for connection in Connection.objects.all():
+            messages.extend(
+                Message(connection=connection, user_id=connection.sender_id, text=f"{i}")
+                for i in range(history)
+            )
+        Message.objects.bulk_create(messages, batch_size=5000)
+
+    async def run(self, application, users, options):
+        clients = [LoadClient(application, options["path"], user) for user in users]
+        connected = await connect_all(clients)
+        if connected != len(clients):
+            raise CommandError(f"Only {connected}/{len(clients)} sockets connected")
+
+        timeout = options["duration"] + 30
+        for client in clients:
+            client.start(timeout)
+
+        # Each client learns its conversation before the clock starts
+        for client in clients:
+            frame, _ = await client.request("friend.list")
+            client.connection_id = frame["data"][0]["id"]
+            client.friend = frame["data"][0]["friend"]["username"]
+
+        # Only count layer traffic from the timed load
+        metrics.reset()
+        samples = {source: [] for source in options["mix"]}
+        errors = {source: 0 for source in options["mix"]}
+        deadline = time.perf_counter() + options["duration"]
+        started = time.perf_counter()
+        await asyncio.gather(
+            *(
+                self.drive(client, options, samples, errors, deadline, index)
+                for index, client in enumerate(clients)
+            )
+        )
+        elapsed = time.perf_counter() - started
+        await close_all(clients)
+
+        sources = {}
+        for source, latencies in samples.items():
+            sources[source] = {
+                **summarize(latencies),
+                "errors": errors[source],
+                "throughput": round(len(latencies) / elapsed, 2),
+            }
+        total = sum(len(latencies) for latencies in samples.values())
+        counters = metrics.snapshot()["counters"]
+        publishes = sum(counters.get("layer.calls", {}).values())
+        return {
+            "elapsed": round(elapsed, 3),
+            "throughput": round(total / elapsed, 2),
+            "sources": sources,
+            # Channel layer publishes (Redis traffic in production) and the
+            # replies written straight to the requesting socket instead
+            "layer": {
+                "publishes": publishes,
+                "local_replies": sum(counters.get("local.replies", {}).values()),
+                "publishes_per_frame": round(publishes / total, 3) if total else None,
+            },
+        }
+
+    async def drive(self, client, options, samples, errors, deadline, index):
+        rng = random.Random(options["seed"] + index)
+        sources = list(options["mix"])
+        weights = [options["mix"][source] for source in sources]
+
+        while time.perf_counter() < deadline:
+            source = rng.choices(sources, weights)[0]
+            try:
+                samples[source].append(await self.step(client, source, rng))
+            except asyncio.TimeoutError:
+                errors[source] += 1
+
+    async def step(self, client, source, rng):
+        if source in FIRE_AND_FORGET:
+            start = time.perf_counter()
+            await client.send(source, username=client.friend)
+            # Yield so a closed loop of sends doesn't starve everyone else
+            await asyncio.sleep(0)
+            return time.perf_counter() - start
+
+        if source == "message.send":
+            data = {"connectionId": client.connection_id, "message": "load test"}
+        elif source == "message.list":
+            data = {"connectionId": client.connection_id, "before": None}
+        elif source == "user.search":
+            data = {"query": "bench" + str(rng.randrange(10))}
+        else:
+            data = {}
+
+        _, latency = await client.request(source, **data)
+        return latency
+
+    def commit(self):
+        try:
+            return subprocess.run(
+                ["git", "rev-parse", "--short", "HEAD"],
+                capture_output=True,
+                text=True,
+                check=True,
+            ).stdout.strip()
+        except (OSError, subprocess.CalledProcessError):
+            return None
+
+    def compare(self, before, after):
+        self.stderr.write(
+            f"{'source':<14}{'p99 before':>12}{'p99 after':>12}"
+            f"{'ops/s before':>14}{'ops/s after':>14}"
+        )
+        for source, now in after["sources"].items():
+            then = before.get("sources", {}).get(source, {})
+            self.stderr.write(
+                f"{source:<14}{str(then.get('p99')):>12}{str(now['p99']):>12}"
+                f"{str(then.get('throughput')):>14}{str(now['throughput']):>14}"
+            )
+        self.stderr.write(
+            "layer publishes per frame: "
+            f"{before.get('layer', {}).get('publishes_per_frame')} -> "
+            f"{after['layer']['publishes_per_frame']}"
+        )
@@ -0,0 +1,164 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.benchmark import (
+    Client,
+    bench_environment,
+    close_all,
+    connect_all,
+    create_friends,
+    summarize,
+)
+
+ROUTES = {
+    "sync": "/chat/sync/",
+    "async": "/chat/",
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare the sync and async chat consumers: open increasing numbers "
+        "of sockets per process and measure message.send/message.type latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--sockets",
+            type=int,
+            nargs="+",
+            default=[50, 200, 500],
+            help="Socket counts to step through (each rounded up to even).",
+        )
+        parser.add_argument(
+            "--consumer",
+            choices=sorted(ROUTES),
+            nargs="+",
+            default=["sync", "async"],
+        )
+        parser.add_argument(
+            "--rounds",
+            type=int,
+            default=3,
+            help="message.send frames sent per socket; typing is timed once.",
+        )
+        parser.add_argument(
+            "--target-p99",
+            type=float,
+            default=250.0,
+            help="p99 budget in ms used to report sustainable sockets per process.",
+        )
+        parser.add_argument("--json", action="store_true", help="Emit JSON only.")
+
+    def handle(self, *args, **options):
+        # Imported late so Django is fully configured first
+        from core.asgi import application
+
+        sockets = sorted(n + n % 2 for n in options["sockets"])
+        results = []
+        with bench_environment():
+            users = create_friends(sockets[-1])
+            for consumer in options["consumer"]:
+                for count in sockets:
+                    result = asyncio.run(
+                        self.run_step(
+                            application,
+                            ROUTES[consumer],
+                            users[:count],
+                            options["rounds"],
+                        )
+                    )
+                    result.update(consumer=consumer, sockets=count)
+                    results.append(result)
+                    if not options["json"]:
+                        self.report(result)
+
+        summary = {}
+        for consumer in options["consumer"]:
+            within = [
+                r["sockets"]
+                for r in results
+                if r["consumer"] == consumer
+                and r["connected"] == r["sockets"]
+                and r["message.send"]["p99"] is not None
+                and r["message.send"]["p99"] <= options["target_p99"]
+            ]
+            summary[consumer] = max(within, default=0)
+
+        if options["json"]:
+            self.stdout.write(
+                json.dumps({"steps": results, "sockets_within_p99": summary})
+            )
+        else:
+            for consumer, count in summary.items():
+                self.stdout.write(
+                    f"{consumer}: {count} sockets within "
+                    f"p99 <= {options['target_p99']}ms"
+                )
+
+    async def run_step(self, application, path, users, rounds):
+        clients = [Client(application, path, user) for user in users]
+
+        start = time.perf_counter()
+        connected = await connect_all(clients)
+        connect_time = time.perf_counter() - start
+
+        # Even clients talk, odd clients are their friends
+        pairs = list(zip(clients[0::2], clients[1::2]))
+        connection_ids = await self.connection_ids(pairs)
+        latencies = {"message.send": [], "message.type": []}
+
+        for _ in range(rounds):
+            sends = await asyncio.gather(
+                *(
+                    self.send_message(sender, friend, connection_id)
+                    for (sender, friend), connection_id in zip(pairs, connection_ids)
+                )
+            )
+            latencies["message.send"].extend(sends)
+
+        # The async consumer forwards one typing frame per recipient every
+        # CHAT_TYPING_WINDOW, so only a pair's first one is sure to arrive
+        types = await asyncio.gather(
+            *(self.send_typing(sender, friend) for sender, friend in pairs)
+        )
+        latencies["message.type"].extend(types)
+
+        await close_all(clients)
+
+        return {
+            "connected": connected,
+            "connect_seconds": round(connect_time, 3),
+            **{source: summarize(samples) for source, samples in latencies.items()},
+        }
+
+    async def connection_ids(self, pairs):
+        ids = []
+        for sender, _ in pairs:
+            frame, _ = await sender.request("friend.list")
+            ids.append(frame["data"][0]["id"])
+        return ids
+
+    async def send_message(self, sender, friend, connection_id):
+        _, latency = await sender.request(
+            "message.send", connectionId=connection_id, message="hello"
+        )
+        await friend.receive("message.send")
+        return latency
+
+    async def send_typing(self, sender, friend):
+        start = time.perf_counter()
+        await sender.send("message.type", username=friend.user.username)
+        await friend.receive("message.type")
+        return time.perf_counter() - start
+
+    def report(self, result):
+        self.stdout.write(
+            "{consumer:>5} sockets={sockets:<5} connected={connected:<5} "
+            "connect={connect_seconds}s".format(**result)
+        )
+        for source in ("message.send", "message.type"):
+            self.stdout.write(f"      {source:<13} {result[source]}")
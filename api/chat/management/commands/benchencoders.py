@@ -0,0 +1,150 @@
+import json
+import time
+
+from django.core.management.base import BaseCommand
+from django.db.models import Value
+
+from chat import encoders
+from chat.benchmark import bench_environment
+from chat.models import User, Connection, Message
+from chat.serializers import (
+    UserSerializer,
+    SearchSerializer,
+    RequestSerializer,
+    FriendSerializer,
+    MessageSerializer,
+)
+
+
+class Command(BaseCommand):
+    help = (
+        "Compare DRF serializers with chat.encoders for every websocket shape, "
+        "fetching and encoding 1, 100 and 10k rows."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument("--rows", type=int, nargs="+", default=[1, 100, 10_000])
+        parser.add_argument(
+            "--min-time",
+            type=float,
+            default=0.5,
+            help="Seconds to spend timing each case.",
+        )
+        parser.add_argument("--json", action="store_true", help="Emit JSON only.")
+
+    def handle(self, *args, **options):
+        results = []
+        with bench_environment():
+            owner = self.populate(max(options["rows"]))
+            for rows in options["rows"]:
+                for shape, serializer, encoder in self.cases(owner, rows):
+                    # Both sides have to agree before timing means anything
+                    if json.dumps(serializer()) != json.dumps(encoder()):
+                        raise AssertionError(f"{shape} output differs at {rows} rows")
+                    result = {
+                        "shape": shape,
+                        "rows": rows,
+                        "serializer_ms": self.time(serializer, options["min_time"]),
+                        "encoder_ms": self.time(encoder, options["min_time"]),
+                    }
+                    result["speedup"] = round(
+                        result["serializer_ms"] / result["encoder_ms"], 2
+                    )
+                    results.append(result)
+                    if not options["json"]:
+                        self.stdout.write(
+                            "{shape:<8} rows={rows:<6} serializer={serializer_ms}ms "
+                            "encoder={encoder_ms}ms x{speedup}".format(**result)
+                        )
+        if options["json"]:
+            self.stdout.write(json.dumps(results))
+
+    def populate(self, count):
+        owner = User.objects.create_user("owner", first_name="bench", last_name="owner")
+        User.objects.bulk_create(
+            User(username=f"user{i}", first_name="bench", last_name=str(i))
+            for i in range(count)
+        )
+        others = User.objects.exclude(pk=owner.pk).order_by("id")
+        Connection.objects.bulk_create(
+            Connection(sender=owner, receiver=other, accepted=True, latest_text="hi")
+            for other in others
+        )
+        first = Connection.objects.order_by("id").first()
+        Message.objects.bulk_create(
+            Message(connection=first, user=owner, text=f"message {i}")
+            for i in range(count)
+        )
+        return owner
+
+    def cases(self, owner, rows):
+        # Callables so every run builds a fresh, uncached queryset
+        def users():
+            return User.objects.exclude(pk=owner.pk).order_by("id")[:rows]
+
+        def connections():
+            return Connection.objects.order_by("id")[:rows]
+
+        def messages():
+            return Message.objects.order_by("id")[:rows]
+
+        flags = {"pending_them": False, "pending_me": False, "connected": True}
+
+        yield (
+            "user",
+            lambda: UserSerializer(users(), many=True).data,
+            lambda: [
+                encoders.user_row(*row)
+                for row in users().values_list(*encoders.USER_FIELDS)
+            ],
+        )
+        yield (
+            "search",
+            lambda: SearchSerializer(
+                users().annotate(**{k: Value(v) for k, v in flags.items()}), many=True
+            ).data,
+            lambda: [
+                encoders.search_row(row, encoders.search_status(*flags.values()))
+                for row in users().values_list(*encoders.USER_FIELDS)
+            ],
+        )
+        yield (
+            "message",
+            lambda: MessageSerializer(messages(), context={"user": owner}, many=True).data,
+            lambda: [
+                encoders.message_row(row, owner.id)
+                for row in messages().values_list(*encoders.MESSAGE_FIELDS)
+            ],
+        )
+        yield (
+            "friend",
+            lambda: FriendSerializer(
+                connections(), context={"user": owner}, many=True
+            ).data,
+            lambda: [
+                encoders.friend_row(row)
+                for row in connections().values_list(*encoders.friend_fields("sender"))
+            ],
+        )
+        yield (
+            "request",
+            lambda: RequestSerializer(connections(), many=True).data,
+            lambda: [
+                encoders.request_row(row)
+                for row in connections().values_list(
+                    *encoders.REQUEST_FIELDS,
+                    *encoders.related("sender"),
+                    *encoders.related("receiver"),
+                )
+            ],
+        )
+
+    def time(self, func, min_time):
+        runs = 0
+        start = time.perf_counter()
+        while True:
+            func()
+            runs += 1
+            elapsed = time.perf_counter() - start
+            if elapsed >= min_time:
+                return round(elapsed / runs * 1000, 3)
@@ -0,0 +1,102 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat.benchmark import (
+    Client,
+    bench_environment,
+    close_all,
+    connect_all,
+    summarize,
+)
+from chat.models import Conversation, Membership, User
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure group.message.send fan-out: time from sending a message to "
+        "its delivery to the first and to every member of a group."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--members",
+            type=int,
+            nargs="+",
+            default=[10, 100, 1000],
+            help="Group sizes to step through.",
+        )
+        parser.add_argument(
+            "--rounds", type=int, default=10, help="Messages sent per group size."
+        )
+        parser.add_argument("--json", action="store_true", help="Emit JSON only.")
+
+    def handle(self, *args, **options):
+        # Imported late so Django is fully configured first
+        from core.asgi import application
+
+        results = []
+        with bench_environment(CHAT_GROUP_MAX_MEMBERS=max(options["members"])):
+            for size in options["members"]:
+                users, conversation = self.create_group(size)
+                result = asyncio.run(
+                    self.run_step(application, users, conversation, options["rounds"])
+                )
+                result["members"] = size
+                results.append(result)
+                if not options["json"]:
+                    self.report(result)
+        if options["json"]:
+            self.stdout.write(json.dumps({"steps": results}))
+
+    def create_group(self, size):
+        prefix = f"fanout{size}-"
+        User.objects.bulk_create(
+            User(username=f"{prefix}{i}", first_name="fanout", last_name=str(i))
+            for i in range(size)
+        )
+        users = list(User.objects.filter(username__startswith=prefix).order_by("id"))
+        conversation = Conversation.objects.create(
+            name=f"fanout {size}", created_by=users[0]
+        )
+        Membership.objects.bulk_create(
+            Membership(conversation=conversation, user=user) for user in users
+        )
+        return users, conversation
+
+    async def run_step(self, application, users, conversation, rounds):
+        clients = [Client(application, "/chat/", user) for user in users]
+        connected = await connect_all(clients)
+        sender = clients[0]
+        first, last = [], []
+
+        for i in range(rounds):
+            start = time.perf_counter()
+            await sender.send(
+                "group.message.send", groupId=conversation.id, message=f"hello {i}"
+            )
+            delivered = await asyncio.gather(
+                *(self.delivered(client, start) for client in clients)
+            )
+            first.append(min(delivered))
+            last.append(max(delivered))
+
+        await close_all(clients)
+        return {
+            "connected": connected,
+            "first": summarize(first),
+            "all": summarize(last),
+        }
+
+    async def delivered(self, client, start):
+        await client.receive("group.message.send")
+        return time.perf_counter() - start
+
+    def report(self, result):
+        self.stdout.write(
+            "members={members:<5} connected={connected:<5}".format(**result)
+        )
+        for key in ("first", "all"):
+            self.stdout.write(f"      {key:<5} {result[key]}")
@@ -0,0 +1,116 @@
+import asyncio
+import json
+import time
+
+from django.core.management.base import BaseCommand
+
+from chat import metrics
+from chat.layers import ShardedRedisChannelLayer
+
+
+class Command(BaseCommand):
+    help = (
+        "Measure channel layer throughput: group sends to users' groups "
+        "spread over 1 and then 4 Redis shards. Start a redis-server for "
+        "each host first, e.g. on ports 6379 to 6382."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--hosts",
+            nargs="+",
+            default=[f"redis://127.0.0.1:{port}" for port in range(6379, 6383)],
+            help="Redis servers, the first N are used for N shards.",
+        )
+        parser.add_argument(
+            "--shards",
+            type=int,
+            nargs="+",
+            default=[1, 4],
+            help="Shard counts to step through.",
+        )
+        parser.add_argument(
+            "--users", type=int, default=1000, help="Users' groups, one socket each."
+        )
+        parser.add_argument(
+            "--processes",
+            type=int,
+            default=8,
+            help="Simulated server processes holding the sockets.",
+        )
+        parser.add_argument(
+            "--messages", type=int, default=20, help="Group sends per user."
+        )
+        parser.add_argument(
+            "--concurrency", type=int, default=64, help="Concurrent senders."
+        )
+        parser.add_argument("--json", action="store_true", help="Emit JSON only.")
+
+    def handle(self, *args, **options):
+        results = []
+        for shards in options["shards"]:
+            result = asyncio.run(self.run_step(options["hosts"][:shards], options))
+            results.append(result)
+            if not options["json"]:
+                self.report(result)
+        if options["json"]:
+            self.stdout.write(json.dumps({"steps": results}))
+
+    async def run_step(self, hosts, options):
+        metrics.reset()
+        # Each layer stands in for a process, with its own channel prefix
+        layers = [
+            ShardedRedisChannelLayer(
+                hosts=hosts, prefix="benchlayer", capacity=options["messages"]
+            )
+            for _ in range(options["processes"])
+        ]
+        # Left over from an interrupted run
+        await layers[0].flush()
+        sockets = []
+        for i in range(options["users"]):
+            layer = layers[i % len(layers)]
+            channel = await layer.new_channel()
+            await layer.group_add(f"benchlayer{i}", channel)
+            sockets.append((layer, channel))
+
+        groups = [f"benchlayer{i}" for i in range(options["users"])]
+        sends = [group for _ in range(options["messages"]) for group in groups]
+        message = {"type": "broadcast_group", "source": "bench", "text": "{}"}
+
+        async def sender(publisher, share):
+            for group in share:
+                await publisher.group_send(group, message)
+
+        async def socket(layer, channel):
+            for _ in range(options["messages"]):
+                await layer.receive(channel)
+
+        concurrency = options["concurrency"]
+        start = time.perf_counter()
+        await asyncio.gather(
+            *(
+                sender(layers[i % len(layers)], sends[i::concurrency])
+                for i in range(concurrency)
+            ),
+            *(socket(layer, channel) for layer, channel in sockets),
+        )
+        elapsed = time.perf_counter() - start
+
+        snapshot = metrics.snapshot()
+        for layer in layers:
+            await layer.flush()
+        return {
+            "shards": len(hosts),
+            "sends": len(sends),
+            "seconds": round(elapsed, 3),
+            "per_second": round(len(sends) / elapsed),
+            "per_shard": snapshot["counters"]["layer.shard.group_sends"],
+        }
+
+    def report(self, result):
+        self.stdout.write(
+            "shards={shards:<3} sends={sends:<8} seconds={seconds:<8} "
+            "per_second={per_second}".format(**result)
+        )
+        self.stdout.write(f"      per shard {result['per_shard']}")
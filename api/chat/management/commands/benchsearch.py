@@ -0,0 +1,161 @@
+import itertools
+import json
+import random
+import string
+import time
+
+from django.core.management.base import BaseCommand, CommandError
+from django.db import connection, transaction
+
+from chat import search
+from chat.benchmark import bench_environment, summarize
+from chat.models import User, Connection, Message
+
+
+def vocabulary(size=10_000, seed=1):
+    """Made-up words; used with Zipf weights, the first are the most common."""
+    rng = random.Random(seed)
+    words = {}
+    while len(words) < size:
+        word = "".join(rng.choices(string.ascii_lowercase, k=rng.randint(3, 9)))
+        words.setdefault(word, None)
+    return list(words)
+
+
+VOCABULARY = vocabulary()
+CUM_WEIGHTS = list(
+    itertools.accumulate(1 / (rank + 1) for rank in range(len(VOCABULARY)))
+)
+
+QUERIES = {
+    "common": VOCABULARY[1],
+    "medium": VOCABULARY[100],
+    "rare": VOCABULARY[5000],
+    "prefix": VOCABULARY[100][:3],
+    "two words": f"{VOCABULARY[2]} {VOCABULARY[30]}",
+}
+
+
+class Command(BaseCommand):
+    help = (
+        "Load a test database with generated messages and compare "
+        "message.search on FTS5 with an icontains scan over the same "
+        "conversations, reporting insert rate and query latency."
+    )
+
+    def add_arguments(self, parser):
+        parser.add_argument(
+            "--messages",
+            type=int,
+            default=100_000,
+            help="Messages to generate; use 10000000 for the full-size run.",
+        )
+        parser.add_argument("--connections", type=int, default=1_000)
+        parser.add_argument(
+            "--friends",
+            type=int,
+            default=20,
+            help="Connections the searching user is part of.",
+        )
+        parser.add_argument("--repeat", type=int, default=20)
+        parser.add_argument(
+            "--database",
+            choices=["memory", "file"],
+            default="file",
+            help="Where the SQLite test database lives.",
+        )
+        parser.add_argument("--seed", type=int, default=0)
+        parser.add_argument("--json", action="store_true", help="Emit JSON only.")
+
+    def handle(self, *args, **options):
+        if not search.available():
+            raise CommandError("Message search needs SQLite FTS5.")
+        rng = random.Random(options["seed"])
+        with bench_environment(database=options["database"]):
+            searcher, connection_ids = self.populate(options)
+            inserted = self.load_messages(options, rng)
+            results = {"messages": options["messages"], "insert": inserted}
+            for name, query in QUERIES.items():
+                results[name] = {
+                    "fts": self.time(
+                        lambda: search.search_messages(query, connection_ids, 21),
+                        options["repeat"],
+                    ),
+                    "icontains": self.time(
+                        lambda: list(
+                            Message.objects.filter(
+                                connection_id__in=connection_ids,
+                                text__icontains=query.split()[0],
+                            )
+                            .order_by("-created")
+                            .values_list("id")[:21]
+                        ),
+                        options["repeat"],
+                    ),
+                }
+                if not options["json"]:
+                    self.stdout.write(
+                        f"{name:<10} fts p50={results[name]['fts']['p50']}ms "
+                        f"icontains p50={results[name]['icontains']['p50']}ms"
+                    )
+        if options["json"]:
+            self.stdout.write(json.dumps(results))
+        else:
+            self.stdout.write(
+                "insert {rows_per_second} rows/s ({seconds}s)".format(**inserted)
+            )
+
+    def populate(self, options):
+        count = options["connections"]
+        User.objects.bulk_create(User(username=f"search{i}") for i in range(count + 1))
+        users = list(User.objects.order_by("id"))
+        searcher = users[0]
+        Connection.objects.bulk_create(
+            Connection(
+                sender=searcher if i < options["friends"] else users[i],
+                receiver=users[i + 1],
+                accepted=True,
+            )
+            for i in range(count)
+        )
+        connection_ids = list(
+            Connection.objects.filter(sender=searcher).values_list("id", flat=True)
+        )
+        return searcher, connection_ids
+
+    def load_messages(self, options, rng, batch_size=50_000):
+        """Insert with executemany; only the inserts (and FTS triggers) are timed."""
+        connection_ids = list(Connection.objects.values_list("id", "sender_id"))
+        created = "2024-01-01 00:00:00"
+        sql = (
+            "INSERT INTO chat_message (connection_id, user_id, text, created) "
+            "VALUES (%s, %s, %s, %s)"
+        )
+        seconds = 0
+        remaining = options["messages"]
+        while remaining:
+            size = min(batch_size, remaining)
+            rows = []
+            for _ in range(size):
+                connection_id, user_id = rng.choice(connection_ids)
+                words = rng.choices(
+                    VOCABULARY, cum_weights=CUM_WEIGHTS, k=rng.randint(3, 12)
+                )
+                rows.append((connection_id, user_id, " ".join(words), created))
+            started = time.perf_counter()
+            with transaction.atomic(), connection.cursor() as cursor:
+                cursor.executemany(sql, rows)
+            seconds += time.perf_counter() - started
+            remaining -= size
+        return {
+            "seconds": round(seconds, 3),
+            "rows_per_second": round(options["messages"] / seconds),
+        }
+
+    def time(self, fn, repeat):
+        samples = []
+        for _ in range(repeat):
+            start = time.perf_counter()
+            fn()
+            samples.append(time.perf_counter() - start)
+        return summarize(samples)
@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand
+
+from chat import outbox
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete outbox events older than CHAT_OUTBOX_TTL, including those of "
+        "users who never reconnect, and cap every outbox at "
+        "CHAT_OUTBOX_MAX_EVENTS. Run periodically."
+    )
+
+    def handle(self, *args, **options):
+        deleted, _ = outbox.expired().delete()
+        self.stdout.write(f"Deleted {deleted} expired outbox events.")
+        trimmed = outbox.trim()
+        self.stdout.write(f"Deleted {trimmed} outbox events over the cap.")
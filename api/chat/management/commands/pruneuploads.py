@@ -0,0 +1,15 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat import uploads
+
+
+class Command(BaseCommand):
+    help = (
+        "Delete partial thumbnail uploads nobody has written to for "
+        "CHAT_UPLOAD_EXPIRY seconds. Run periodically."
+    )
+
+    def handle(self, *args, **options):
+        pruned = uploads.prune(settings.CHAT_UPLOAD_EXPIRY)
+        self.stdout.write(f"Deleted {pruned} abandoned uploads.")
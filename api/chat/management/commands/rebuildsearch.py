@@ -0,0 +1,17 @@
+from django.core.management.base import BaseCommand, CommandError
+
+from chat import search
+from chat.models import Message
+
+
+class Command(BaseCommand):
+    help = (
+        "Recreate the message full-text index and its triggers, then reindex "
+        "every message."
+    )
+
+    def handle(self, *args, **options):
+        if not search.available():
+            raise CommandError("Message search needs SQLite FTS5.")
+        search.rebuild()
+        self.stdout.write(f"Indexed {Message.objects.count()} messages.")
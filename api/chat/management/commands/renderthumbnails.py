@@ -0,0 +1,36 @@
+from django.conf import settings
+from django.core.management.base import BaseCommand
+
+from chat import thumbnails
+from chat.cache import invalidate_friend_lists
+from chat.models import User
+from chat.uploads import InvalidUpload, check_image
+
+
+class Command(BaseCommand):
+    help = (
+        "Move thumbnails that aren't content-addressed yet (sign ups, the "
+        "admin, older uploads) to content-hash names and render their "
+        "variants."
+    )
+
+    def handle(self, *args, **options):
+        users = User.objects.exclude(thumbnail="").exclude(thumbnail=None)
+        moved = 0
+        for user in users.iterator():
+            if thumbnails.ORIGINAL.fullmatch(user.thumbnail.name):
+                continue
+            try:
+                with user.thumbnail.open("rb") as image:
+                    extension = check_image(image, settings.CHAT_THUMBNAIL_MAX_PIXELS)
+                    name = thumbnails.store(image, extension)
+            except (InvalidUpload, FileNotFoundError) as error:
+                self.stderr.write(f"Skipped {user.username}: {error}")
+                continue
+            User.objects.filter(pk=user.pk).update(thumbnail=name)
+            moved += 1
+
+        # Friend lists show the old URLs
+        if moved:
+            invalidate_friend_lists(*User.objects.values_list("id", flat=True))
+        self.stdout.write(f"Rendered thumbnails for {moved} users.")
@@ -0,0 +1,121 @@
+"""
+In-process counters and histograms for the chat consumers.
+
+Each worker process keeps its own numbers; they are served by the
+``metrics/`` endpoint so they can be scraped per process. Metrics may be
+labelled with the websocket ``source`` they belong to.
+"""
+
+import bisect
+import threading
+import time
+from collections import defaultdict
+from contextlib import contextmanager
+
+from django.db import connection
+
+_lock = threading.Lock()
+_counters = defaultdict(int)
+_histograms = {}
+
+# Upper bounds, shared by every histogram: seconds, query counts and bytes
+# all land somewhere useful on a 1-2.5-5 ladder
+BUCKETS = tuple(
+    round(base * 10.0**exponent, 6)
+    for exponent in range(-4, 8)
+    for base in (1, 2.5, 5)
+)
+
+
+class Histogram:
+    def __init__(self):
+        self.counts = [0] * (len(BUCKETS) + 1)
+        self.count = 0
+        self.sum = 0
+
+    def observe(self, value):
+        self.counts[bisect.bisect_left(BUCKETS, value)] += 1
+        self.count += 1
+        self.sum += value
+
+    def quantile(self, q):
+        """Upper bound of the bucket holding the q-th quantile."""
+        if not self.count:
+            return None
+        rank = q * self.count
+        seen = 0
+        for bound, count in zip(BUCKETS, self.counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def snapshot(self):
+        return {
+            "count": self.count,
+            "sum": self.sum,
+            "p50": self.quantile(0.5),
+            "p95": self.quantile(0.95),
+            "p99": self.quantile(0.99),
+            "buckets": {
+                str(bound): count
+                for bound, count in zip(BUCKETS + ("+Inf",), self.counts)
+                if count
+            },
+        }
+
+
+def increment(name, value=1, source=None):
+    with _lock:
+        _counters[name, source] += value
+
+
+def observe(name, value, source=None):
+    with _lock:
+        histogram = _histograms.get((name, source))
+        if histogram is None:
+            histogram = _histograms[name, source] = Histogram()
+        histogram.observe(value)
+
+
+def snapshot():
+    with _lock:
+        counters = defaultdict(dict)
+        for (name, source), value in _counters.items():
+            counters[name][source or "all"] = value
+        histograms = defaultdict(dict)
+        for (name, source), histogram in _histograms.items():
+            histograms[name][source or "all"] = histogram.snapshot()
+    return {"counters": counters, "histograms": histograms}
+
+
+def reset():
+    with _lock:
+        _counters.clear()
+        _histograms.clear()
+
+
+class QueryStats:
+    """``execute_wrapper`` that counts and times database queries."""
+
+    def __init__(self):
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, execute, sql, params, many, context):
+        start = time.perf_counter()
+        try:
+            return execute(sql, params, many, context)
+        finally:
+            self.count += 1
+            self.seconds += time.perf_counter() - start
+
+
+@contextmanager
+def track_queries(source):
+    """Record query count and time for the block under ``source``."""
+    stats = QueryStats()
+    with connection.execute_wrapper(stats):
+        yield stats
+    observe("db.queries", stats.count, source)
+    observe("db.seconds", stats.seconds, source)
@@ -0,0 +1,38 @@
+# Generated by Django 5.0.1 on 2026-10-17 15:34
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0001_initial'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connection',
+            name='activity',
+            field=models.DateTimeField(default=django.utils.timezone.now),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='latest_message',
+            field=models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, related_name='+', to='chat.message'),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='latest_text',
+            field=models.TextField(blank=True, default=''),
+        ),
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(fields=['sender', 'accepted', '-activity'], name='chat_conn_sender_activity'),
+        ),
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(fields=['receiver', 'accepted', '-activity'], name='chat_conn_receiver_activity'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations
+
+
+def backfill_summary(apps, schema_editor):
+    Connection = apps.get_model("chat", "Connection")
+    Message = apps.get_model("chat", "Message")
+
+    for connection in Connection.objects.iterator():
+        latest = (
+            Message.objects.filter(connection=connection)
+            .order_by("-created", "-id")
+            .first()
+        )
+        Connection.objects.filter(pk=connection.pk).update(
+            latest_message=latest,
+            latest_text=latest.text if latest else "",
+            activity=latest.created if latest else connection.updated,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0002_connection_summary"),
+    ]
+
+    operations = [
+        migrations.RunPython(backfill_summary, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,71 @@
+# Generated by Django 5.0.1 on 2026-10-17 15:36
+
+from django.db import migrations, models
+from django.db.models import Count
+
+
+def merge_duplicate_connections(apps, schema_editor):
+    """Fold duplicate (sender, receiver) rows into one before the constraint."""
+    Connection = apps.get_model("chat", "Connection")
+    Message = apps.get_model("chat", "Message")
+
+    duplicates = (
+        Connection.objects.values("sender", "receiver")
+        .annotate(count=Count("id"))
+        .filter(count__gt=1)
+    )
+    for pair in duplicates:
+        # Keep an accepted row if there is one, then the oldest
+        keep, *others = Connection.objects.filter(
+            sender=pair["sender"], receiver=pair["receiver"]
+        ).order_by("-accepted", "id")
+        Message.objects.filter(connection__in=others).update(connection=keep)
+        Connection.objects.filter(pk__in=[other.pk for other in others]).delete()
+
+        latest = (
+            Message.objects.filter(connection=keep).order_by("-created", "-id").first()
+        )
+        Connection.objects.filter(pk=keep.pk).update(
+            latest_message=latest,
+            latest_text=latest.text if latest else "",
+            activity=latest.created if latest else keep.updated,
+        )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0003_backfill_connection_summary'),
+    ]
+
+    operations = [
+        migrations.RunPython(merge_duplicate_connections, migrations.RunPython.noop),
+        migrations.RemoveIndex(
+            model_name='connection',
+            name='chat_conn_sender_activity',
+        ),
+        migrations.RemoveIndex(
+            model_name='connection',
+            name='chat_conn_receiver_activity',
+        ),
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(condition=models.Q(('accepted', True)), fields=['sender', '-activity'], name='chat_conn_sender_friends'),
+        ),
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(condition=models.Q(('accepted', True)), fields=['receiver', '-activity'], name='chat_conn_receiver_friends'),
+        ),
+        migrations.AddIndex(
+            model_name='connection',
+            index=models.Index(condition=models.Q(('accepted', False)), fields=['receiver', 'created'], name='chat_conn_pending'),
+        ),
+        migrations.AddIndex(
+            model_name='message',
+            index=models.Index(fields=['connection', '-created', '-id'], name='chat_msg_conn_created'),
+        ),
+        migrations.AddConstraint(
+            model_name='connection',
+            constraint=models.UniqueConstraint(fields=('sender', 'receiver'), name='chat_conn_unique_pair'),
+        ),
+    ]
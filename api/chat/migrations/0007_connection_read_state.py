@@ -0,0 +1,33 @@
+# Generated by Django 5.0.1 on 2026-10-17 15:50
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0006_message_write_behind'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='connection',
+            name='receiver_read_up_to',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='receiver_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='sender_read_up_to',
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.AddField(
+            model_name='connection',
+            name='sender_unread',
+            field=models.PositiveIntegerField(default=0),
+        ),
+    ]
@@ -0,0 +1,29 @@
+from django.db import migrations
+
+from chat import search
+
+
+def create_index(apps, schema_editor):
+    if search.available(schema_editor.connection):
+        with schema_editor.connection.cursor() as cursor:
+            for statement in search.CREATE:
+                cursor.execute(statement)
+            cursor.execute(search.REBUILD)
+
+
+def drop_index(apps, schema_editor):
+    if search.available(schema_editor.connection):
+        with schema_editor.connection.cursor() as cursor:
+            for statement in search.DROP:
+                cursor.execute(statement)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0007_connection_read_state"),
+    ]
+
+    operations = [
+        migrations.RunPython(create_index, drop_index),
+    ]
@@ -0,0 +1,27 @@
+# Generated by Django 5.0.1 on 2026-10-17 18:10
+
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('chat', '0010_user_last_seen'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='OutboxEvent',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('username', models.CharField(max_length=150)),
+                ('source', models.CharField(max_length=50)),
+                ('data', models.JSONField()),
+                ('created', models.DateTimeField(default=django.utils.timezone.now)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['username', 'id'], name='chat_outbox_user'), models.Index(fields=['created'], name='chat_outbox_created')],
+            },
+        ),
+    ]
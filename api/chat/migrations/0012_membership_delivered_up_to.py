@@ -0,0 +1,31 @@
+from django.db import migrations, models
+from django.db.models import OuterRef, Subquery
+from django.db.models.functions import Coalesce
+
+
+def mark_delivered(apps, schema_editor):
+    # Existing members have had their groups' messages delivered live
+    GroupMessage = apps.get_model("chat", "GroupMessage")
+    Membership = apps.get_model("chat", "Membership")
+    latest = (
+        GroupMessage.objects.filter(conversation_id=OuterRef("conversation_id"))
+        .order_by("-id")
+        .values("id")[:1]
+    )
+    Membership.objects.update(delivered_up_to=Coalesce(Subquery(latest), 0))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ("chat", "0011_outboxevent"),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name="membership",
+            name="delivered_up_to",
+            field=models.BigIntegerField(default=0),
+        ),
+        migrations.RunPython(mark_delivered, migrations.RunPython.noop),
+    ]
@@ -1,5 +1,8 @@
 from django.contrib.auth.models import AbstractUser
 from django.db import models
+from django.db.models.functions import Lower
+from django.db.models.lookups import GreaterThanOrEqual, LessThan
+from django.utils import timezone
 
 # Create your models here.
 
@@ -13,8 +16,36 @@ def upload_thumbnail(instance, filename):
     return path
 
 
+# Fields user.search matches by prefix
+SEARCH_FIELDS = ("username", "first_name", "last_name")
+
+
 class User(AbstractUser):
     thumbnail = models.ImageField(upload_to=upload_thumbnail, null=True, blank=True)
+    # When the user's last socket closed, see chat.presence
+    last_seen = models.DateTimeField(null=True, blank=True)
+
+    class Meta(AbstractUser.Meta):
+        indexes = [
+            models.Index(Lower(field), name=f"chat_user_{field}_lower")
+            for field in SEARCH_FIELDS
+        ]
+
+
+def search_prefix(prefix):
+    """
+    Case-insensitive prefix match on the search fields, written as ranges
+    over LOWER(field) so the expression indexes can serve it (LIKE can't).
+    """
+    prefix = prefix.lower()
+    match = models.Q()
+    for field in SEARCH_FIELDS:
+        lowered = Lower(field)
+        match |= models.Q(
+            GreaterThanOrEqual(lowered, prefix),
+            LessThan(lowered, prefix + "\U0010ffff"),
+        )
+    return match
 
 
 class Connection(models.Model):
@@ -27,10 +58,66 @@ class Connection(models.Model):
     accepted = models.BooleanField(default=False)
     created = models.DateTimeField(auto_now_add=True)
     updated = models.DateTimeField(auto_now=True)
+    # Conversation summary, maintained on every new message
+    latest_message = models.ForeignKey(
+        "Message",
+        related_name="+",
+        null=True,
+        blank=True,
+        on_delete=models.SET_NULL,
+    )
+    latest_text = models.TextField(blank=True, default="")
+    # Latest message time, or when the connection last changed without one
+    activity = models.DateTimeField(default=timezone.now)
+    # Read state per side: messages not yet read, and the latest message
+    # id marked as read
+    sender_unread = models.PositiveIntegerField(default=0)
+    receiver_unread = models.PositiveIntegerField(default=0)
+    sender_read_up_to = models.BigIntegerField(default=0)
+    receiver_read_up_to = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["sender", "receiver"], name="chat_conn_unique_pair"
+            ),
+        ]
+        indexes = [
+            # friend.list, one index per side of the connection
+            models.Index(
+                fields=["sender", "-activity"],
+                condition=models.Q(accepted=True),
+                name="chat_conn_sender_friends",
+            ),
+            models.Index(
+                fields=["receiver", "-activity"],
+                condition=models.Q(accepted=True),
+                name="chat_conn_receiver_friends",
+            ),
+            # request.list
+            models.Index(
+                fields=["receiver", "created"],
+                condition=models.Q(accepted=False),
+                name="chat_conn_pending",
+            ),
+        ]
 
     def __str__(self):
         return self.sender.username + " --> " + self.receiver.username
 
+    def refresh_latest(self):
+        """Recompute the conversation summary from the message table."""
+        latest = self.messages.order_by("-created", "-id").first()
+        summary = {
+            "latest_message": latest,
+            "latest_text": latest.text if latest else "",
+            "activity": latest.created if latest else self.updated,
+        }
+        # Queryset update so "updated" isn't bumped
+        Connection.objects.filter(pk=self.pk).update(**summary)
+        for field, value in summary.items():
+            setattr(self, field, value)
+
 
 class Message(models.Model):
     connection = models.ForeignKey(
@@ -38,7 +125,121 @@ class Message(models.Model):
     )
     user = models.ForeignKey(User, related_name="my_messages", on_delete=models.CASCADE)
     text = models.TextField()
+    # Not auto_now_add: write-behind messages are stamped when sent, not
+    # when their batch is committed
+    created = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            # message.list pages, newest first
+            models.Index(
+                fields=["connection", "-created", "-id"],
+                name="chat_msg_conn_created",
+            ),
+        ]
+
+    def __str__(self):
+        return self.user.username + ": " + self.text
+
+
+class IdBlock(models.Model):
+    """
+    High-water mark for ids handed out before their rows are inserted,
+    so write-behind messages can be pushed to clients with their final id.
+    """
+
+    name = models.CharField(max_length=100, primary_key=True)
+    next_id = models.BigIntegerField()
+
+    def __str__(self):
+        return f"{self.name}: {self.next_id}"
+
+
+class Conversation(models.Model):
+    """A group conversation between any number of members."""
+
+    name = models.CharField(max_length=100)
+    created_by = models.ForeignKey(
+        User,
+        related_name="created_conversations",
+        null=True,
+        on_delete=models.SET_NULL,
+    )
     created = models.DateTimeField(auto_now_add=True)
+    # Conversation summary, maintained on every new message
+    latest_text = models.TextField(blank=True, default="")
+    activity = models.DateTimeField(default=timezone.now)
+
+    def __str__(self):
+        return self.name
+
+    @property
+    def group_name(self):
+        """Channel layer group every member's sockets join."""
+        return f"conversation.{self.pk}"
+
+
+class Membership(models.Model):
+    conversation = models.ForeignKey(
+        Conversation, related_name="memberships", on_delete=models.CASCADE
+    )
+    user = models.ForeignKey(User, related_name="memberships", on_delete=models.CASCADE)
+    joined = models.DateTimeField(auto_now_add=True)
+    # Newest group message the user acknowledged, see chat.outbox
+    delivered_up_to = models.BigIntegerField(default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(
+                fields=["conversation", "user"], name="chat_member_unique"
+            ),
+        ]
+
+    def __str__(self):
+        return f"{self.user.username} in {self.conversation.name}"
+
+
+class GroupMessage(models.Model):
+    conversation = models.ForeignKey(
+        Conversation, related_name="messages", on_delete=models.CASCADE
+    )
+    user = models.ForeignKey(
+        User, related_name="group_messages", on_delete=models.CASCADE
+    )
+    text = models.TextField()
+    created = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            # group.message.list pages, newest first
+            models.Index(
+                fields=["conversation", "-created", "-id"],
+                name="chat_gmsg_conv_created",
+            ),
+        ]
 
     def __str__(self):
         return self.user.username + ": " + self.text
+
+
+class OutboxEvent(models.Model):
+    """
+    An event for a user, kept until one of their sockets acknowledges it,
+    see chat.outbox.
+    """
+
+    # Users are addressed by username on the channel layer too
+    username = models.CharField(max_length=150)
+    source = models.CharField(max_length=50)
+    data = models.JSONField()
+    created = models.DateTimeField(default=timezone.now)
+
+    class Meta:
+        indexes = [
+            models.Index(fields=["username", "id"], name="chat_outbox_user"),
+            # Expiry
+            models.Index(fields=["created"], name="chat_outbox_created"),
+        ]
+
+    def __str__(self):
+        return f"{self.username}: {self.source}"
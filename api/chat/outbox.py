@@ -0,0 +1,231 @@
+"""
+Per-user outbox for events that must survive the recipient being offline.
+
+The channel layer drops events for users without sockets, so events of
+``SOURCES`` addressed to another user are also stored here and carry
+their ``outboxId``. Clients acknowledge with ``outbox.ack`` up to the
+highest id they have seen, which deletes everything up to it: what is
+left is what hasn't been delivered.
+
+Group messages reach a conversation group with a single frame and are
+not stored again: each ``Membership`` keeps the newest message id its
+user acknowledged, per conversation, and what came after it is read
+from ``GroupMessage``.
+
+A socket's first frame after connecting is an ``outbox`` batch of the
+events still waiting, compacted: messages are grouped per friend or
+group, other events keep only their newest copy. Events older than
+``CHAT_OUTBOX_TTL`` and anything beyond the newest
+``CHAT_OUTBOX_MAX_EVENTS`` are dropped; the batch then says "truncated"
+and the client should ``sync``.
+
+With ``CHAT_MESSAGE_WRITE_BEHIND`` on, rows get pre-allocated ids and
+are inserted by the message writer along with the messages.
+"""
+
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import (
+    BigIntegerField,
+    Case,
+    F,
+    OuterRef,
+    Subquery,
+    Value,
+    When,
+    Window,
+)
+from django.db.models.functions import Coalesce, Greatest, Least, RowNumber
+from django.utils import timezone
+
+from . import encoders
+from .encoders import MESSAGE_FIELDS
+from .models import GroupMessage, Membership, OutboxEvent
+
+SOURCES = {
+    "friend.new",
+    "group.new",
+    "message.send",
+    "request.accept",
+    "request.connect",
+}
+
+
+def record(events, sender):
+    """
+    Store the events other users must get; returns the events with their
+    ``outboxId`` added.
+    """
+    stored = [
+        OutboxEvent(username=group, source=source, data=data)
+        for group, source, data in events
+        if source in SOURCES and group != sender
+    ]
+    if not stored:
+        return events
+
+    if settings.CHAT_MESSAGE_WRITE_BEHIND:
+        # The writer imports this module
+        from .writer import get_writer
+
+        writer = get_writer()
+        for event in stored:
+            writer.submit(event)
+    else:
+        save(stored)
+
+    ids = (event.id for event in stored)
+    tagged = []
+    for group, source, data in events:
+        if source in SOURCES and group != sender:
+            data = {**data, "outboxId": next(ids)}
+        tagged.append((group, source, data))
+    return tagged
+
+
+def save(events):
+    OutboxEvent.objects.bulk_create(events)
+
+
+def trim():
+    """
+    Delete every user's events beyond their newest
+    ``CHAT_OUTBOX_MAX_EVENTS``, keeping one more so ``batch`` still
+    reports the outbox truncated.
+    """
+    ranked = OutboxEvent.objects.annotate(
+        rank=Window(RowNumber(), partition_by=F("username"), order_by=F("id").desc())
+    )
+    overflow = ranked.filter(rank__gt=settings.CHAT_OUTBOX_MAX_EVENTS + 1)
+    return OutboxEvent.objects.filter(id__in=overflow.values("id")).delete()[0]
+
+
+def expired():
+    cutoff = timezone.now() - timedelta(seconds=settings.CHAT_OUTBOX_TTL)
+    return OutboxEvent.objects.filter(created__lt=cutoff)
+
+
+def compact(rows):
+    """``outbox`` frame data for ``(id, source, data)`` rows, oldest first."""
+    conversations = {}
+    latest = {}
+    for _, source, data in rows:
+        if source == "message.send":
+            friend = data["friend"]
+            conversation = conversations.setdefault(
+                friend["username"], {"friend": friend, "messages": []}
+            )
+            # The newest copy of the friend, e.g. after a thumbnail change
+            conversation["friend"] = friend
+            conversation["messages"].append(data["message"])
+        else:
+            # Keep only the newest event per source and object, in the
+            # order of their newest copies
+            key = (source, data.get("id"))
+            latest.pop(key, None)
+            latest[key] = data
+
+    return {
+        "messages": list(conversations.values()),
+        "events": [
+            {"source": source, "data": data} for (source, _), data in latest.items()
+        ],
+    }
+
+
+def group_messages(user):
+    """
+    Messages from the user's groups they haven't acknowledged, as
+    ``(conversation_id, *MESSAGE_FIELDS)`` rows, oldest first.
+    """
+    # One membership join, so each message is compared with its own
+    return (
+        GroupMessage.objects.filter(
+            conversation__memberships__user=user,
+            id__gt=F("conversation__memberships__delivered_up_to"),
+            created__gte=F("conversation__memberships__joined"),
+        )
+        .exclude(user=user)
+        .order_by("id")
+        .values_list("conversation_id", *MESSAGE_FIELDS)
+    )
+
+
+def compact_groups(rows):
+    """The "groups" of an ``outbox`` frame for ``group_messages`` rows."""
+    groups = {}
+    for conversation_id, *row in rows:
+        group = groups.setdefault(
+            conversation_id, {"id": conversation_id, "messages": []}
+        )
+        group["messages"].append(encoders.group_message_row(row))
+        # What to acknowledge for the conversation
+        group["upTo"] = row[0]
+    return list(groups.values())
+
+
+def batch(user):
+    """
+    The ``outbox`` frame data for a user whose socket just connected, or
+    None if nothing is waiting.
+    """
+    username = user.username
+    events = OutboxEvent.objects.filter(username=username)
+
+    # Bound the outbox before reading it
+    truncated = expired().filter(username=username).delete()[0] > 0
+    limit = settings.CHAT_OUTBOX_MAX_EVENTS
+    overflow = list(
+        events.order_by("-id").values_list("id", flat=True)[limit : limit + 1]
+    )
+    if overflow:
+        events.filter(id__lte=overflow[0]).delete()
+        truncated = True
+
+    # Fetch one extra row to know if there is more
+    size = settings.CHAT_OUTBOX_BATCH_SIZE
+    rows = list(events.order_by("id").values_list("id", "source", "data")[: size + 1])
+    groups = list(group_messages(user)[: size + 1])
+    if not rows and not groups and not truncated:
+        return None
+    more = len(rows) > size or len(groups) > size
+    rows = rows[:size]
+    groups = groups[:size]
+    return {
+        **compact(rows),
+        "groups": compact_groups(groups),
+        "upTo": rows[-1][0] if rows else None,
+        "more": more,
+        "truncated": truncated,
+    }
+
+
+def ack(username, up_to):
+    """Advance the user's delivery watermark to ``up_to``."""
+    OutboxEvent.objects.filter(username=username, id__lte=up_to).delete()
+
+
+def ack_groups(user, up_to):
+    """
+    Advance the user's watermarks in the groups of ``up_to``, a message id
+    per conversation id. Watermarks never move back, nor past the
+    conversation's newest message.
+    """
+    latest = (
+        GroupMessage.objects.filter(conversation_id=OuterRef("conversation_id"))
+        .order_by("-id")
+        .values("id")[:1]
+    )
+    acked = Case(
+        *(
+            When(conversation_id=conversation_id, then=Value(message_id))
+            for conversation_id, message_id in up_to.items()
+        ),
+        output_field=BigIntegerField(),
+    )
+    Membership.objects.filter(user=user, conversation_id__in=up_to).update(
+        delivered_up_to=Greatest(
+            F("delivered_up_to"), Least(acked, Coalesce(Subquery(latest), 0))
+        )
+    )
@@ -0,0 +1,43 @@
+import base64
+import json
+import binascii
+
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(*values):
+    """Pack a keyset position into an opaque, url-safe string."""
+    raw = json.dumps(
+        [value.isoformat() if hasattr(value, "isoformat") else value for value in values],
+        separators=(",", ":"),
+    )
+    return base64.urlsafe_b64encode(raw.encode()).decode().rstrip("=")
+
+
+def decode_cursor(cursor):
+    """Reverse of ``encode_cursor``; raises ``InvalidCursor`` on bad input."""
+    try:
+        padded = cursor + "=" * (-len(cursor) % 4)
+        values = json.loads(base64.urlsafe_b64decode(padded.encode()))
+    except (AttributeError, TypeError, ValueError, binascii.Error):
+        raise InvalidCursor(cursor)
+    if not isinstance(values, list):
+        raise InvalidCursor(cursor)
+    return values
+
+
+def decode_message_cursor(cursor):
+    """Decode a ``(created, id)`` cursor from ``message.list``."""
+    values = decode_cursor(cursor)
+    try:
+        created, pk = values
+        created = parse_datetime(created)
+    except (TypeError, ValueError):
+        raise InvalidCursor(cursor)
+    if created is None or not isinstance(pk, int):
+        raise InvalidCursor(cursor)
+    return created, pk
@@ -0,0 +1,246 @@
+"""
+Online presence for friends.
+
+Each process counts its own sockets per user. A user's entry in the
+``CACHES["default"]`` backend counts the processes that have at least one
+socket for them, so with Redis configured presence is shared by every
+server, and the local memory backend stands in for a single process.
+
+All cache and database work happens on a background ``PresenceTracker``
+thread, every ``CHAT_PRESENCE_INTERVAL`` seconds:
+
+* users whose first socket in this process connected are counted in;
+* users whose last socket closed more than ``CHAT_PRESENCE_GRACE`` seconds
+  ago are counted out, so reconnects inside the grace period never show
+  as offline;
+* users whose online state changed are pushed to their online friends as
+  one ``presence.diff`` per friend, however many friends changed.
+
+Entries expire after ``CHAT_PRESENCE_TTL`` seconds unless a process with
+sockets for the user keeps refreshing them, so a crashed process can only
+keep its users online that long.
+"""
+
+import atexit
+import logging
+import threading
+import time
+from collections import defaultdict
+
+from asgiref.sync import async_to_sync
+from channels.layers import get_channel_layer
+from django.conf import settings
+from django.core.cache import cache
+from django.db import close_old_connections, connection
+from django.db.models import Q
+from django.utils import timezone
+
+from . import encoders, metrics
+from .models import Connection, User
+
+logger = logging.getLogger(__name__)
+
+
+def presence_key(user_id):
+    return f"chat:presence:{user_id}"
+
+
+def online_ids(user_ids):
+    """The given users that have a socket open on any process."""
+    counts = cache.get_many([presence_key(user_id) for user_id in user_ids])
+    return {user_id for user_id in user_ids if counts.get(presence_key(user_id), 0) > 0}
+
+
+def presence_row(username, last_seen, online):
+    return {
+        "username": username,
+        "online": online,
+        "lastSeen": None if online else encoders.datetime(last_seen),
+    }
+
+
+def friend_presence(user_ids):
+    """
+    ``(user_id, friend_id, friend_username, friend_last_seen)`` for every
+    accepted connection of the given users.
+    """
+    connections = Connection.objects.filter(
+        Q(sender_id__in=user_ids) | Q(receiver_id__in=user_ids), accepted=True
+    ).values_list(
+        "sender_id",
+        "sender__username",
+        "sender__last_seen",
+        "receiver_id",
+        "receiver__username",
+        "receiver__last_seen",
+    )
+    for row in connections:
+        if row[0] in user_ids:
+            yield row[0], row[3], row[4], row[5]
+        if row[3] in user_ids:
+            yield row[3], row[0], row[1], row[2]
+
+
+class PresenceTracker:
+    """Socket counts for this process and the thread that publishes them."""
+
+    def __init__(self, interval, grace, ttl):
+        self.interval = interval
+        self.grace = grace
+        self.ttl = ttl
+        self.lock = threading.Lock()
+        # Sockets per user in this process
+        self.local = defaultdict(int)
+        # Users to count in, and users to count out once their grace ends
+        self.arriving = set()
+        self.leaving = {}
+        self.touched_at = 0
+        self.stopping = threading.Event()
+        self.thread = None
+
+    def start(self):
+        self.thread = threading.Thread(
+            target=self.run, name="chat-presence", daemon=True
+        )
+        self.thread.start()
+
+    def connect(self, user_id):
+        with self.lock:
+            self.local[user_id] += 1
+            if self.local[user_id] == 1:
+                # Back inside the grace period: still counted in
+                if self.leaving.pop(user_id, None) is None:
+                    self.arriving.add(user_id)
+
+    def disconnect(self, user_id):
+        with self.lock:
+            self.local[user_id] -= 1
+            if self.local[user_id] > 0:
+                return
+            del self.local[user_id]
+            if user_id in self.arriving:
+                # Never counted in
+                self.arriving.discard(user_id)
+            else:
+                self.leaving[user_id] = time.monotonic()
+
+    def run(self):
+        try:
+            while not self.stopping.wait(self.interval):
+                close_old_connections()
+                try:
+                    self.publish(self.flush())
+                except Exception:
+                    logger.exception("Failed to publish presence")
+            # Shutting down: count every user out now
+            with self.lock:
+                self.leaving = dict.fromkeys(
+                    [*self.leaving, *self.local], float("-inf")
+                )
+                self.local.clear()
+                self.arriving.clear()
+            self.publish(self.flush())
+        finally:
+            connection.close()
+
+    def flush(self):
+        """
+        Apply arrivals and departures; returns the ``presence.diff`` data
+        for each online friend of a user whose state changed, by username.
+        """
+        now = time.monotonic()
+        with self.lock:
+            arriving, self.arriving = self.arriving, set()
+            departing = [
+                user_id
+                for user_id, left in self.leaving.items()
+                if now - left >= self.grace
+            ]
+            for user_id in departing:
+                del self.leaving[user_id]
+            local = list(self.local) if now - self.touched_at >= self.ttl / 3 else []
+
+        changed = set()
+        for user_id in arriving:
+            cache.add(presence_key(user_id), 0, self.ttl)
+            if cache.incr(presence_key(user_id)) == 1:
+                changed.add(user_id)
+        for user_id in departing:
+            try:
+                remaining = cache.decr(presence_key(user_id))
+            except ValueError:
+                # Expired already
+                remaining = 0
+            if remaining <= 0:
+                changed.add(user_id)
+        if local:
+            self.touched_at = now
+            for user_id in local:
+                # Re-counted if the entry was lost
+                if not cache.touch(presence_key(user_id), self.ttl):
+                    cache.add(presence_key(user_id), 1, self.ttl)
+        if not changed:
+            return {}
+
+        # The cache has the final word, other processes may have moved too
+        online = online_ids(changed)
+        offline = changed - online
+        if offline:
+            User.objects.filter(id__in=offline).update(last_seen=timezone.now())
+        users = User.objects.filter(id__in=changed).values_list(
+            "id", "username", "last_seen"
+        )
+        rows = {
+            id: presence_row(username, last_seen, id in online)
+            for id, username, last_seen in users
+        }
+
+        # Each online friend gets every change that concerns them at once
+        pairs = [
+            (user_id, friend_id, friend)
+            for user_id, friend_id, friend, _ in friend_presence(changed)
+        ]
+        listening = online_ids({friend_id for _, friend_id, _ in pairs})
+        diffs = defaultdict(list)
+        for user_id, friend_id, friend in pairs:
+            if friend_id in listening:
+                diffs[friend].append(rows[user_id])
+        metrics.increment("presence.changes", len(changed))
+        return diffs
+
+    def publish(self, diffs):
+        if not diffs:
+            return
+        # Imported here, the consumers import this module
+        from .consumers import layer_event
+
+        layer = get_channel_layer()
+        for username, users in diffs.items():
+            async_to_sync(layer.group_send)(
+                username, layer_event("presence.diff", {"users": users})
+            )
+        metrics.increment("presence.diffs", len(diffs))
+
+    def stop(self, timeout=None):
+        """Count this process's users out, then stop the thread."""
+        self.stopping.set()
+        if self.thread is not None:
+            self.thread.join(timeout)
+
+
+_tracker = None
+_tracker_lock = threading.Lock()
+
+
+def get_tracker():
+    global _tracker
+    with _tracker_lock:
+        if _tracker is None:
+            _tracker = PresenceTracker(
+                interval=settings.CHAT_PRESENCE_INTERVAL,
+                grace=settings.CHAT_PRESENCE_GRACE,
+                ttl=settings.CHAT_PRESENCE_TTL,
+            )
+            _tracker.start()
+            atexit.register(_tracker.stop)
+        return _tracker
@@ -3,5 +3,7 @@ from django.urls import path
 from . import consumers
 
 websocket_urlpatterns = [
-    path("chat/", consumers.ChatConsumer.as_asgi()),
+    path("chat/", consumers.AsyncChatConsumer.as_asgi()),
+    # Thread-per-frame consumer, same protocol
+    path("chat/sync/", consumers.ChatConsumer.as_asgi()),
 ]
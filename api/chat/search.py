@@ -0,0 +1,166 @@
+"""
+Full-text message search on SQLite FTS5.
+
+``chat_message_fts`` is an external-content FTS5 table over
+``chat_message.text``: triggers keep it in step with every insert, update
+and delete (``bulk_create`` and cascades included), and ``rebuild()``
+reindexes existing rows. Other database backends have no index and
+``message.search`` is disabled there.
+
+Each row also indexes its conversation as a ``c<connection id>`` token,
+so restricting a search to the caller's conversations is a doclist
+intersection inside FTS5 rather than a filter over every match in the
+table.
+"""
+
+import html
+
+from django.db import connection as default_connection
+
+TABLE = "chat_message_fts"
+
+CREATE = [
+    # The content the index reads back for snippets and rebuilds
+    f"""
+    CREATE VIEW IF NOT EXISTS {TABLE}_content AS
+    SELECT id, text, 'c' || connection_id AS conversation FROM chat_message
+    """,
+    f"""
+    CREATE VIRTUAL TABLE IF NOT EXISTS {TABLE} USING fts5(
+        text, conversation, content='{TABLE}_content', content_rowid='id',
+        prefix='2 3'
+    )
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {TABLE}_insert AFTER INSERT ON chat_message
+    BEGIN
+        INSERT INTO {TABLE}(rowid, text, conversation)
+        VALUES (new.id, new.text, 'c' || new.connection_id);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {TABLE}_delete AFTER DELETE ON chat_message
+    BEGIN
+        INSERT INTO {TABLE}({TABLE}, rowid, text, conversation)
+        VALUES ('delete', old.id, old.text, 'c' || old.connection_id);
+    END
+    """,
+    f"""
+    CREATE TRIGGER IF NOT EXISTS {TABLE}_update
+    AFTER UPDATE OF text, connection_id ON chat_message
+    BEGIN
+        INSERT INTO {TABLE}({TABLE}, rowid, text, conversation)
+        VALUES ('delete', old.id, old.text, 'c' || old.connection_id);
+        INSERT INTO {TABLE}(rowid, text, conversation)
+        VALUES (new.id, new.text, 'c' || new.connection_id);
+    END
+    """,
+]
+
+DROP = [
+    f"DROP TRIGGER IF EXISTS {TABLE}_insert",
+    f"DROP TRIGGER IF EXISTS {TABLE}_delete",
+    f"DROP TRIGGER IF EXISTS {TABLE}_update",
+    f"DROP TABLE IF EXISTS {TABLE}",
+    f"DROP VIEW IF EXISTS {TABLE}_content",
+]
+
+REBUILD = f"INSERT INTO {TABLE}({TABLE}) VALUES ('rebuild')"
+
+# Keyset pagination on (rank, id); bm25() is lower for better matches.
+# The conversation column doesn't count towards the rank.
+RANKED = f"""
+    SELECT rowid, rank FROM (
+        SELECT rowid, bm25({TABLE}, 1.0, 0.0) AS rank FROM {TABLE}
+        WHERE {TABLE} MATCH %s
+    )
+    WHERE rank > %s OR (rank = %s AND rowid > %s)
+    ORDER BY rank, rowid
+    LIMIT %s
+"""
+
+# Snippets cost far more than ranking, so only the page gets them
+PAGE = f"""
+    SELECT
+        m.id, m.user_id, m.text, m.created, m.connection_id,
+        snippet({TABLE}, 0, %s, %s, '…', %s)
+    FROM {TABLE}
+    JOIN chat_message m ON m.id = {TABLE}.rowid
+    WHERE {TABLE} MATCH %s AND {TABLE}.rowid IN ({{ids}})
+"""
+
+
+# Placeholders FTS5 puts around matches, swapped for the highlight markers
+# once the text around them is escaped (Unicode private use characters)
+MATCH_START = "\ue000"
+MATCH_END = "\ue001"
+
+
+def highlight_snippet(snippet, highlight):
+    """
+    HTML for a snippet: the message text escaped, matches wrapped in the
+    ``highlight`` markers.
+    """
+    start, end = highlight
+    return html.escape(snippet).replace(MATCH_START, start).replace(MATCH_END, end)
+
+
+def available(connection=default_connection):
+    return connection.vendor == "sqlite"
+
+
+def match_expression(query, connection_ids):
+    """
+    Turn free text into an FTS5 query: every word must match, the last
+    one as a prefix, in one of the given conversations. Words are quoted
+    so FTS5 syntax in user input is searched for literally.
+    """
+    words = ['"' + word.replace('"', '""') + '"' for word in query.split()]
+    if not words or not connection_ids:
+        return None
+    words[-1] += "*"
+    conversations = " OR ".join(f"c{int(pk)}" for pk in connection_ids)
+    return f"text : ({' '.join(words)}) AND conversation : ({conversations})"
+
+
+def search_messages(
+    query, connection_ids, limit, after=None, highlight=("<mark>", "</mark>"), tokens=10
+):
+    """
+    Messages matching ``query`` in the given connections, best first.
+
+    Returns ``(id, user_id, text, created, connection_id, snippet, rank)``
+    rows, starting after the ``(rank, id)`` position ``after``. Snippets
+    are HTML, see ``highlight_snippet``.
+    """
+    expression = match_expression(query, connection_ids)
+    if expression is None:
+        return []
+    rank, pk = after or (float("-inf"), 0)
+    with default_connection.cursor() as cursor:
+        cursor.execute(RANKED, [expression, rank, rank, pk, limit])
+        ranks = dict(cursor.fetchall())
+        if not ranks:
+            return []
+        cursor.execute(
+            PAGE.format(ids=", ".join(["%s"] * len(ranks))),
+            [MATCH_START, MATCH_END, tokens, expression, *ranks],
+        )
+        rows = cursor.fetchall()
+    # Datetimes come back as text from a raw cursor
+    field = default_connection.ops.convert_datetimefield_value
+    rows = [
+        row[:3]
+        + (field(row[3], None, default_connection), row[4])
+        + (highlight_snippet(row[5], highlight), ranks[row[0]])
+        for row in rows
+    ]
+    return sorted(rows, key=lambda row: (row[-1], row[0]))
+
+
+def rebuild():
+    """Reindex every message."""
+    with default_connection.cursor() as cursor:
+        for statement in CREATE:
+            cursor.execute(statement)
+        cursor.execute(REBUILD)
@@ -1,5 +1,6 @@
 from rest_framework import serializers
 from .models import User, Connection, Message
+from .thumbnails import variant_urls
 
 
 class SignUpSerializer(serializers.ModelSerializer):
@@ -24,23 +25,28 @@ class SignUpSerializer(serializers.ModelSerializer):
 
 class UserSerializer(serializers.ModelSerializer):
     name = serializers.SerializerMethodField()
+    thumbnails = serializers.SerializerMethodField()
 
     class Meta:
         model = User
-        fields = ["id", "username", "name", "thumbnail"]
+        fields = ["id", "username", "name", "thumbnail", "thumbnails"]
 
     def get_name(self, obj):
         fname = obj.first_name.capitalize()
         lname = obj.last_name.capitalize()
         return f"{fname} {lname}"
 
+    def get_thumbnails(self, obj):
+        # Resized variants by size and format, see chat.thumbnails
+        return variant_urls(obj.thumbnail.name)
+
 
 class SearchSerializer(UserSerializer):
     status = serializers.SerializerMethodField()
 
     class Meta:
         model = User
-        fields = ["id", "username", "name", "thumbnail", "status"]
+        fields = ["id", "username", "name", "thumbnail", "thumbnails", "status"]
 
     def get_status(self, obj):
         if obj.pending_them:
@@ -53,6 +59,10 @@ class SearchSerializer(UserSerializer):
         return "no-connection"
 
 
+# Connections serialized below need select_related("sender", "receiver"),
+# otherwise each one loads its users with two more queries
+
+
 class RequestSerializer(serializers.ModelSerializer):
     sender = UserSerializer()
     receiver = UserSerializer()
@@ -66,33 +76,33 @@ class FriendSerializer(serializers.ModelSerializer):
     friend = serializers.SerializerMethodField()
     preview = serializers.SerializerMethodField()
     updated = serializers.SerializerMethodField()
+    unread = serializers.SerializerMethodField()
 
     class Meta:
         model = Connection
-        fields = ["id", "friend", "preview", "updated"]
+        fields = ["id", "friend", "preview", "updated", "unread"]
 
     def get_friend(self, obj):
+        # Compare ids, so only the friend is read
         # If the current user is the sender
-        if self.context["user"] == obj.sender:
+        if self.context["user"].id == obj.sender_id:
             return UserSerializer(obj.receiver).data
         # If the current user is the receiver
-        elif self.context["user"] == obj.receiver:
+        elif self.context["user"].id == obj.receiver_id:
             return UserSerializer(obj.sender).data
         else:
             print("Error: User is not part of the connection")
 
     def get_preview(self, obj):
-        default = "New connection"
-        if not hasattr(obj, "latest_text"):
-            return default
-        return obj.latest_text or default
+        return obj.latest_text or "New connection"
 
     def get_updated(self, obj):
-        if not hasattr(obj, "latest_created"):
-            date = obj.updated
-        else:
-            date = obj.latest_created or obj.updated
-        return date.isoformat()
+        return obj.activity.isoformat()
+
+    def get_unread(self, obj):
+        if self.context["user"].id == obj.sender_id:
+            return obj.sender_unread
+        return obj.receiver_unread
 
 
 class MessageSerializer(serializers.ModelSerializer):
@@ -103,4 +113,4 @@ class MessageSerializer(serializers.ModelSerializer):
         fields = ["id", "is_me", "text", "created"]
 
     def get_is_me(self, obj):
-        return obj.user == self.context["user"]
+        return obj.user_id == self.context["user"].id
@@ -0,0 +1,47 @@
+import weakref
+
+from django.contrib.auth import get_user_model
+from django.db import transaction
+from django.db.models import QuerySet
+from django.db.models.signals import post_delete
+from django.dispatch import receiver
+
+from .cache import invalidate_friend_lists
+from .models import Connection, Message
+
+# Connections whose messages a delete() removed, keyed by what was deleted
+_pending = weakref.WeakKeyDictionary()
+
+
+def deletes_connections(origin):
+    model = origin.model if isinstance(origin, QuerySet) else type(origin)
+    # Deleting a user or connection cascades to the whole conversation
+    return issubclass(model, (Connection, get_user_model()))
+
+
+def refresh_summaries(connection_ids):
+    # SET_NULL has cleared latest_message where the latest one went
+    stale = Connection.objects.filter(pk__in=connection_ids, latest_message=None)
+    for connection in stale:
+        connection.refresh_latest()
+
+
+@receiver(post_delete, sender=Message)
+def refresh_connection_summary(sender, instance, using, origin=None, **kwargs):
+    origin = instance if origin is None else origin
+    if deletes_connections(origin):
+        return
+    # Checked once per connection after the delete, not once per row
+    connection_ids = _pending.get(origin)
+    if connection_ids is None:
+        connection_ids = _pending[origin] = set()
+        transaction.on_commit(
+            lambda: refresh_summaries(connection_ids), using=using
+        )
+    connection_ids.add(instance.connection_id)
+
+
+@receiver(post_delete, sender=Connection)
+def invalidate_connection_friend_lists(sender, instance, **kwargs):
+    if instance.accepted:
+        invalidate_friend_lists(instance.sender_id, instance.receiver_id)
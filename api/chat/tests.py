@@ -1,3 +1,1635 @@
-from django.test import TestCase
+import asyncio
+import base64
+import hashlib
+import io
+import json
+import os
+import tempfile
+import time
+from datetime import timedelta
+from unittest import mock
 
-# Create your tests here.
+from channels.db import database_sync_to_async
+from channels.layers import channel_layers, get_channel_layer
+from channels.testing import WebsocketCommunicator
+from django.conf import settings
+from django.core.cache import cache
+from django.core.management import call_command
+from django.core.files.storage import default_storage
+from django.db import OperationalError, connection
+from django.db.models import Value
+from django.test import (
+    RequestFactory,
+    TestCase,
+    TransactionTestCase,
+    override_settings,
+)
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+from PIL import Image
+
+from . import encoders, metrics, presence, writer
+from .benchmark import IN_MEMORY_CHANNEL_LAYERS, Client, close_all, create_friends
+from .cache import invalidate_friend_lists
+from .consumers import (
+    RESYNC_CLOSE_CODE,
+    AsyncChatConsumer,
+    frame,
+    friend_changes,
+    layer_event,
+)
+from .handlers import ChatHandlers
+from .layers import shard_for
+from .models import (
+    User,
+    Connection,
+    Conversation,
+    GroupMessage,
+    Membership,
+    Message,
+    OutboxEvent,
+)
+from .presence import PresenceTracker
+from .throttle import OutboundQueue, TypingCoalescer
+from .serializers import (
+    UserSerializer,
+    SearchSerializer,
+    RequestSerializer,
+    FriendSerializer,
+    MessageSerializer,
+)
+from .views import media
+
+
+class Handlers(ChatHandlers):
+    """Run consumer handlers without a websocket."""
+
+    def __init__(self, user):
+        self.scope = {"user": user}
+        self.username = user.username
+
+
+def query_plan(sql):
+    with connection.cursor() as cursor:
+        cursor.execute("EXPLAIN QUERY PLAN " + sql)
+        return [row[-1] for row in cursor.fetchall()]
+
+
+class QueryPlanTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice", first_name="alice")
+        cls.bob = User.objects.create_user("bob", first_name="bob")
+        cls.carol = User.objects.create_user("carol", first_name="carol")
+        cls.friends = Connection.objects.create(
+            sender=cls.alice, receiver=cls.bob, accepted=True
+        )
+        Connection.objects.create(sender=cls.carol, receiver=cls.alice)
+        Message.objects.bulk_create(
+            Message(connection=cls.friends, user=cls.alice, text=str(i))
+            for i in range(30)
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def assertIndexed(self, source, data, scannable=()):
+        """Fail if any query run by the handler scans a table."""
+        handlers = Handlers(self.alice)
+        with CaptureQueriesContext(connection) as queries:
+            handlers.handle(source, data)
+
+        selects = [q["sql"] for q in queries if q["sql"].startswith("SELECT")]
+        self.assertTrue(selects, f"{source} ran no queries")
+        for sql in selects:
+            for step in query_plan(sql):
+                if step.startswith("SCAN ") and step.split()[1] not in scannable:
+                    self.fail(f"{source}: {step}\n{sql}")
+
+    def test_friend_list(self):
+        self.assertIndexed("friend.list", {})
+
+    def test_message_list_page(self):
+        self.assertIndexed(
+            "message.list", {"connectionId": self.friends.id, "page": 1}
+        )
+
+    def test_message_list_cursor(self):
+        handlers = Handlers(self.alice)
+        data = {"connectionId": self.friends.id, "before": None}
+        [(_, _, page)] = handlers.handle("message.list", data)
+        self.assertIndexed("message.list", {**data, "before": page["next"]})
+
+    def test_message_send(self):
+        self.assertIndexed(
+            "message.send", {"connectionId": self.friends.id, "message": "hi"}
+        )
+
+    def test_request_list(self):
+        self.assertIndexed("request.list", {})
+
+    def test_request_connect(self):
+        self.assertIndexed("request.connect", {"username": "carol"})
+
+    def test_request_accept(self):
+        self.assertIndexed("request.accept", {"username": "carol"})
+
+    def test_search(self):
+        self.assertIndexed("user.search", {"query": "c"})
+
+    def test_message_read(self):
+        self.assertIndexed("message.read", {"connectionId": self.friends.id})
+
+    def test_sync(self):
+        self.assertIndexed("sync", {"since": "2000-01-01T00:00:00Z"})
+
+
+class EncoderTests(TestCase):
+    """The fast encoders must match the DRF serializers byte for byte."""
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user(
+            "alice", first_name="alice", last_name="liddell"
+        )
+        cls.alice.thumbnail.name = "thumbnails/alice.png"
+        cls.alice.save()
+        cls.bob = User.objects.create_user("bob")
+        # Content-addressed, with variants
+        cls.carol = User.objects.create_user("carol")
+        cls.carol.thumbnail.name = f"thumbnails/{'0' * 32}.png"
+        cls.carol.save()
+        cls.connection = Connection.objects.create(
+            sender=cls.alice, receiver=cls.bob, latest_text="hi"
+        )
+        cls.message = Message.objects.create(
+            connection=cls.connection, user=cls.alice, text="hi"
+        )
+
+    def assertSameJSON(self, serialized, encoded):
+        self.assertEqual(json.dumps(serialized), json.dumps(encoded))
+
+    def test_user(self):
+        for user in (self.alice, self.bob, self.carol):
+            self.assertSameJSON(UserSerializer(user).data, encoders.user(user))
+            row = User.objects.values_list(*encoders.USER_FIELDS).get(pk=user.pk)
+            self.assertSameJSON(UserSerializer(user).data, encoders.user_row(*row))
+
+    def test_search(self):
+        user = User.objects.annotate(
+            pending_them=Value(False), pending_me=Value(True), connected=Value(False)
+        ).get(pk=self.alice.pk)
+        row = User.objects.values_list(*encoders.USER_FIELDS).get(pk=user.pk)
+        self.assertSameJSON(
+            SearchSerializer(user).data,
+            encoders.search_row(row, encoders.search_status(False, True, False)),
+        )
+
+    def test_message(self):
+        for user in (self.alice, self.bob):
+            serialized = MessageSerializer(self.message, context={"user": user}).data
+            self.assertSameJSON(serialized, encoders.message(self.message, user.id))
+            row = Message.objects.values_list(*encoders.MESSAGE_FIELDS).get()
+            self.assertSameJSON(serialized, encoders.message_row(row, user.id))
+
+    def test_friend(self):
+        row = Connection.objects.values_list(*encoders.friend_fields("sender")).get()
+        serialized = FriendSerializer(self.connection, context={"user": self.alice})
+        self.assertSameJSON(serialized.data, encoders.friend_row(row))
+        self.assertSameJSON(
+            serialized.data, encoders.friend(self.connection, self.alice.id)
+        )
+
+    def test_request(self):
+        row = Connection.objects.values_list(
+            *encoders.REQUEST_FIELDS,
+            *encoders.related("sender"),
+            *encoders.related("receiver"),
+        ).get()
+        serialized = RequestSerializer(self.connection).data
+        self.assertSameJSON(serialized, encoders.request_row(row))
+        self.assertSameJSON(serialized, encoders.request(self.connection))
+
+
+class MessageListTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        cls.bob = User.objects.create_user("bob")
+        cls.connection = Connection.objects.create(
+            sender=cls.alice, receiver=cls.bob, accepted=True
+        )
+        # 45 messages, every three sharing a timestamp
+        start = timezone.now() - timedelta(days=1)
+        Message.objects.bulk_create(
+            Message(
+                connection=cls.connection,
+                user=cls.bob,
+                text=str(i),
+                created=start + timedelta(seconds=i // 3),
+            )
+            for i in range(45)
+        )
+
+    def page(self, **data):
+        data = {"connectionId": self.connection.id, **data}
+        [(_, _, page)] = Handlers(self.alice).handle("message.list", data)
+        return page
+
+    def texts(self, page):
+        return [message["text"] for message in page["messages"]]
+
+    def test_cursor_pages(self):
+        texts = []
+        page = self.page(before=None)
+        sizes = []
+        while True:
+            sizes.append(len(page["messages"]))
+            texts += self.texts(page)
+            if page["next"] is None:
+                break
+            page = self.page(before=page["next"])
+        # Newest first, nothing skipped or repeated at page boundaries,
+        # even where a boundary splits messages sharing a timestamp
+        self.assertEqual(texts, [str(i) for i in reversed(range(45))])
+        self.assertEqual(sizes, [20, 20, 5])
+
+    def test_same_timestamp_boundary(self):
+        first = self.page(before=None)
+        # The 20th newest shares its timestamp with the next two
+        self.assertEqual(self.texts(first)[-1], "25")
+        second = self.page(before=first["next"])
+        self.assertEqual(self.texts(second)[:2], ["24", "23"])
+
+    def test_page_offset(self):
+        first = self.page(page=0)
+        self.assertEqual(self.texts(first), [str(i) for i in range(44, 24, -1)])
+        last = self.page(page=2)
+        self.assertEqual(self.texts(last), [str(i) for i in range(4, -1, -1)])
+        self.assertIsNone(last["next"])
+
+    def test_invalid_cursor(self):
+        data = {"connectionId": self.connection.id, "before": "x"}
+        self.assertEqual(Handlers(self.alice).handle("message.list", data), [])
+
+
+class UserSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        User.objects.bulk_create(User(username=f"user{i:02}") for i in range(30))
+
+    def search(self, **data):
+        [(_, _, results)] = Handlers(self.alice).handle("user.search", data)
+        return results
+
+    @override_settings(CHAT_SEARCH_MIN_LENGTH=2)
+    def test_min_length(self):
+        self.assertEqual(self.search(query="u"), [])
+        self.assertEqual(self.search(query=" u ", cursor=None)["results"], [])
+        self.assertEqual(len(self.search(query="us")), 20)
+
+    def test_default_page_size(self):
+        results = self.search(query="user")
+        self.assertEqual(
+            [user["username"] for user in results],
+            [f"user{i:02}" for i in range(20)],
+        )
+
+    @override_settings(CHAT_SEARCH_MAX_PAGE_SIZE=25)
+    def test_page_size_capped(self):
+        page = self.search(query="user", cursor=None, limit=1000)
+        self.assertEqual(len(page["results"]), 25)
+        rest = self.search(query="user", cursor=page["next"], limit=1000)
+        self.assertEqual(len(rest["results"]), 5)
+        self.assertIsNone(rest["next"])
+
+
+class FriendCacheTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        cls.bob = User.objects.create_user("bob")
+        cls.connection = Connection.objects.create(
+            sender=cls.alice, receiver=cls.bob, accepted=True
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def friend_list(self, user):
+        [(_, _, friends)] = Handlers(user).handle("friend.list", {})
+        return friends
+
+    def test_cached(self):
+        friends = self.friend_list(self.alice)
+        with self.assertNumQueries(0):
+            self.assertEqual(self.friend_list(self.alice), friends)
+
+    def test_invalidated_while_querying(self):
+        friend_rows = Handlers.friend_rows
+
+        def invalidated(handlers, user):
+            rows = list(friend_rows(handlers, user))
+            # A message lands after the rows were read
+            Connection.objects.filter(pk=self.connection.pk).update(
+                latest_text="hi"
+            )
+            invalidate_friend_lists(self.alice.id)
+            return rows
+
+        with mock.patch.object(Handlers, "friend_rows", invalidated):
+            self.assertEqual(
+                self.friend_list(self.alice)[0]["preview"], "New connection"
+            )
+        # The list read before the invalidation isn't served after it
+        self.assertEqual(self.friend_list(self.alice)[0]["preview"], "hi")
+
+    def test_message_send_invalidates(self):
+        self.friend_list(self.alice)
+        self.friend_list(self.bob)
+        with self.captureOnCommitCallbacks(execute=True):
+            events = Handlers(self.bob).handle(
+                "message.send", {"connectionId": self.connection.id, "message": "hi"}
+            )
+        updates = {
+            group: data for group, source, data in events if source == "friend.update"
+        }
+        for user in (self.alice, self.bob):
+            [friend] = self.friend_list(user)
+            self.assertEqual(friend["preview"], "hi")
+            self.assertEqual(updates[user.username], friend)
+
+
+class SyncTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        cls.bob = User.objects.create_user("bob")
+        cls.carol = User.objects.create_user("carol")
+        cls.dave = User.objects.create_user("dave")
+        friends = Connection.objects.create(
+            sender=cls.alice, receiver=cls.bob, accepted=True
+        )
+        others = Connection.objects.create(
+            sender=cls.carol, receiver=cls.dave, accepted=True
+        )
+        Connection.objects.create(sender=cls.carol, receiver=cls.alice)
+        cls.messages = [
+            Message.objects.create(connection=friends, user=cls.bob, text=str(i))
+            for i in range(5)
+        ]
+        Message.objects.create(connection=others, user=cls.carol, text="private")
+
+    def sync(self, **data):
+        [(_, _, page)] = Handlers(self.alice).handle("sync", data)
+        return page
+
+    def texts(self, page):
+        return [item["message"]["text"] for item in page["messages"]]
+
+    def test_since(self):
+        page = self.sync(since="2000-01-01T00:00:00Z")
+        self.assertEqual(self.texts(page), ["0", "1", "2", "3", "4"])
+        self.assertEqual(len(page["friends"]), 1)
+        self.assertEqual(len(page["requests"]), 1)
+        self.assertFalse(page["more"])
+
+    def test_after(self):
+        page = self.sync(after=self.messages[2].id)
+        self.assertEqual(self.texts(page), ["3", "4"])
+
+    @override_settings(CHAT_SYNC_MAX_MESSAGES=2)
+    def test_continuation(self):
+        texts = []
+        page = self.sync(since="2000-01-01T00:00:00Z")
+        while True:
+            texts += self.texts(page)
+            if not page["more"]:
+                break
+            page = self.sync(cursor=page["cursor"])
+        self.assertEqual(texts, ["0", "1", "2", "3", "4"])
+        self.assertEqual(self.sync(cursor=page["cursor"])["messages"], [])
+
+    def test_invalid_watermark(self):
+        self.assertEqual(Handlers(self.alice).handle("sync", {}), [])
+        self.assertEqual(Handlers(self.alice).handle("sync", {"cursor": "x"}), [])
+
+
+class UnreadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        cls.bob = User.objects.create_user("bob")
+        cls.connection = Connection.objects.create(
+            sender=cls.alice, receiver=cls.bob, accepted=True
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def send(self, user, text):
+        data = {"connectionId": self.connection.id, "message": text}
+        events = Handlers(user).handle("message.send", data)
+        return events[0][2]["message"]["id"]
+
+    def unread(self, user):
+        [(_, _, [friend])] = Handlers(user).handle("friend.list", {})
+        return friend["unread"]
+
+    def test_counts(self):
+        self.send(self.alice, "a")
+        self.send(self.bob, "b")
+        self.send(self.bob, "c")
+        self.assertEqual(self.unread(self.alice), 2)
+        self.assertEqual(self.unread(self.bob), 1)
+
+    def test_read(self):
+        first = self.send(self.bob, "a")
+        self.send(self.bob, "b")
+        handlers = Handlers(self.alice)
+        data = {"connectionId": self.connection.id, "messageId": first}
+        events = handlers.handle("message.read", data)
+        self.assertEqual(
+            [(group, source) for group, source, _ in events],
+            [("alice", "message.read"), ("bob", "message.read")],
+        )
+        self.assertEqual(events[0][2]["messageId"], first)
+        # A newer message is still unread
+        self.assertEqual(self.unread(self.alice), 2)
+
+        handlers.handle("message.read", {"connectionId": self.connection.id})
+        self.assertEqual(self.unread(self.alice), 0)
+        self.connection.refresh_from_db()
+        self.assertEqual(
+            self.connection.sender_read_up_to, self.connection.latest_message_id
+        )
+
+    def test_invalid_message_id(self):
+        carol = User.objects.create_user("carol")
+        others = Connection.objects.create(sender=self.bob, receiver=carol)
+        elsewhere = Message.objects.create(connection=others, user=carol, text="x")
+        self.send(self.bob, "a")
+        for message_id in (True, elsewhere.id, elsewhere.id + 100):
+            with self.subTest(message_id=message_id):
+                data = {"connectionId": self.connection.id, "messageId": message_id}
+                self.assertEqual(Handlers(self.alice).handle("message.read", data), [])
+        self.connection.refresh_from_db()
+        self.assertEqual(self.connection.sender_read_up_to, 0)
+        # Later messages still count once the earlier ones are read
+        self.send(self.bob, "b")
+        self.assertEqual(self.unread(self.alice), 2)
+
+
+class ConnectionSummaryTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        cls.bob = User.objects.create_user("bob")
+        cls.connection = Connection.objects.create(
+            sender=cls.alice, receiver=cls.bob, accepted=True
+        )
+        Message.objects.bulk_create(
+            Message(connection=cls.connection, user=cls.alice, text=str(i))
+            for i in range(200)
+        )
+        cls.connection.refresh_latest()
+
+    def test_delete_latest(self):
+        latest = self.connection.latest_message
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.filter(pk__gte=latest.pk - 1).delete()
+        self.connection.refresh_from_db()
+        self.assertEqual(self.connection.latest_text, "197")
+
+    def test_delete_older(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            Message.objects.filter(text__in=["0", "1"]).delete()
+        self.connection.refresh_from_db()
+        self.assertEqual(self.connection.latest_text, "199")
+
+    def test_delete_connection(self):
+        # No summary refresh per message for a conversation going away
+        with CaptureQueriesContext(connection) as queries:
+            with self.captureOnCommitCallbacks(execute=True):
+                self.connection.delete()
+        self.assertLess(len(queries), 10)
+        self.assertFalse(Message.objects.exists())
+
+
+class MessageSearchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        cls.bob = User.objects.create_user("bob")
+        cls.carol = User.objects.create_user("carol")
+        cls.friends = Connection.objects.create(
+            sender=cls.alice, receiver=cls.bob, accepted=True
+        )
+        others = Connection.objects.create(
+            sender=cls.bob, receiver=cls.carol, accepted=True
+        )
+        Message.objects.bulk_create(
+            [
+                Message(connection=cls.friends, user=cls.bob, text="lunch at noon?"),
+                Message(connection=cls.friends, user=cls.alice, text="lunch lunch!"),
+                Message(connection=cls.friends, user=cls.alice, text="see you"),
+                Message(connection=others, user=cls.carol, text="secret lunch"),
+            ]
+        )
+
+    def search(self, **data):
+        [(_, _, page)] = Handlers(self.alice).handle("message.search", data)
+        return page
+
+    def texts(self, page):
+        return [result["message"]["text"] for result in page["results"]]
+
+    def test_ranked_and_restricted(self):
+        page = self.search(query="lunch")
+        self.assertEqual(self.texts(page), ["lunch lunch!", "lunch at noon?"])
+        self.assertEqual(page["results"][1]["snippet"], "<mark>lunch</mark> at noon?")
+        self.assertIsNone(page["next"])
+
+    def test_snippet_escaped(self):
+        Message.objects.create(
+            connection=self.friends, user=self.bob, text="<img src=x> & lunch"
+        )
+        [result] = self.search(query="img")["results"]
+        self.assertEqual(
+            result["snippet"], "&lt;<mark>img</mark> src=x&gt; &amp; lunch"
+        )
+
+    def test_prefix_and_syntax(self):
+        self.assertEqual(
+            self.texts(self.search(query="lun")), ["lunch lunch!", "lunch at noon?"]
+        )
+        self.assertEqual(self.texts(self.search(query='lunch" OR "see')), [])
+
+    @override_settings(CHAT_MESSAGE_SEARCH_PAGE_SIZE=1)
+    def test_pages(self):
+        first = self.search(query="lunch")
+        second = self.search(query="lunch", cursor=first["next"])
+        self.assertEqual(
+            self.texts(first) + self.texts(second), ["lunch lunch!", "lunch at noon?"]
+        )
+        self.assertIsNone(second["next"])
+
+    def test_delete(self):
+        Message.objects.filter(text="see you").delete()
+        self.assertEqual(self.search(query="see")["results"], [])
+
+
+class ThumbnailUploadTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        cls.bob = User.objects.create_user("bob")
+        Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+
+    def setUp(self):
+        directory = tempfile.TemporaryDirectory()
+        self.addCleanup(directory.cleanup)
+        media = os.path.join(directory.name, "media")
+        uploads = os.path.join(directory.name, "uploads")
+        settings = override_settings(MEDIA_ROOT=media, CHAT_UPLOAD_DIR=uploads)
+        settings.enable()
+        self.addCleanup(settings.disable)
+
+        image = io.BytesIO()
+        Image.new("RGB", (40, 40), "red").save(image, "PNG")
+        self.image = image.getvalue()
+        self.handlers = Handlers(self.alice)
+
+    def test_base64(self):
+        data = {"base64": base64.b64encode(self.image).decode()}
+        # The image work needs no database, so it can leave the ORM thread
+        with self.assertNumQueries(0):
+            name = self.handlers.store_base64_thumbnail(data)
+        digest = hashlib.sha256(self.image).hexdigest()[:32]
+        self.assertEqual(name, f"thumbnails/{digest}.png")
+        events = self.handlers.handle("user.thumbnail", data)
+        self.assertEqual(
+            [(group, source) for group, source, _ in events],
+            [("alice", "user.thumbnail"), ("bob", "friend.update")],
+        )
+        self.assertEqual(self.handlers.handle("user.thumbnail", {"base64": "x"}), [])
+
+    def begin(self, **data):
+        data = {"filename": "me.jpeg", "size": len(self.image), **data}
+        events = self.handlers.handle("thumbnail.begin", data)
+        return events[0][2] if events else None
+
+    def test_upload(self):
+        self.begin()
+        self.assertEqual(self.handlers.receive_thumbnail_chunk(self.image[:100]), [])
+        events = self.handlers.receive_thumbnail_chunk(self.image[100:])
+        self.assertEqual(
+            [(group, source) for group, source, _ in events],
+            [("alice", "user.thumbnail"), ("bob", "friend.update")],
+        )
+        self.alice.refresh_from_db()
+        # Stored under its content hash and detected format
+        digest = hashlib.sha256(self.image).hexdigest()[:32]
+        self.assertEqual(self.alice.thumbnail.name, f"thumbnails/{digest}.png")
+        self.assertEqual(self.alice.thumbnail.read(), self.image)
+        self.assertEqual(
+            events[0][2]["thumbnails"]["40"]["webp"],
+            f"/media/thumbnails/{digest}-40.webp",
+        )
+        with default_storage.open(f"thumbnails/{digest}-80.jpg") as variant:
+            self.assertEqual(Image.open(variant).size, (80, 80))
+
+    def test_same_content_same_name(self):
+        self.begin()
+        self.handlers.receive_thumbnail_chunk(self.image)
+        first = User.objects.get(pk=self.alice.pk).thumbnail.name
+        self.begin()
+        self.handlers.receive_thumbnail_chunk(self.image)
+        self.assertEqual(User.objects.get(pk=self.alice.pk).thumbnail.name, first)
+
+    def test_media_caching(self):
+        self.begin()
+        self.handlers.receive_thumbnail_chunk(self.image)
+        name = User.objects.get(pk=self.alice.pk).thumbnail.name
+        response = media(RequestFactory().get("/media/" + name), name)
+        self.assertIn("immutable", response["Cache-Control"])
+        request = RequestFactory().get(
+            "/media/" + name, HTTP_IF_NONE_MATCH=response["ETag"]
+        )
+        self.assertEqual(media(request, name).status_code, 304)
+
+    def test_resume(self):
+        started = self.begin()
+        self.handlers.receive_thumbnail_chunk(self.image[:100])
+        # A new socket picks up where the old one stopped
+        self.handlers = Handlers(self.alice)
+        resumed = self.begin(uploadId=started["uploadId"])
+        self.assertEqual(resumed["offset"], 100)
+        events = self.handlers.receive_thumbnail_chunk(self.image[100:])
+        self.assertEqual(events[0][1], "user.thumbnail")
+
+    def part_files(self):
+        directory = os.path.join(settings.CHAT_UPLOAD_DIR, str(self.alice.id))
+        return os.listdir(directory)
+
+    def test_one_part_file(self):
+        first = self.begin()
+        self.handlers.receive_thumbnail_chunk(self.image[:100])
+        resumed = self.begin(uploadId=first["uploadId"])
+        self.assertEqual(resumed["offset"], 100)
+        self.assertEqual(self.part_files(), [f"{first['uploadId']}.part"])
+        # Another socket starting over replaces the upload in progress
+        other = Handlers(self.alice)
+        other.handle("thumbnail.begin", {"filename": "me.png", "size": 10})
+        [part] = self.part_files()
+        self.assertNotEqual(part, f"{first['uploadId']}.part")
+        self.assertEqual(self.handlers.receive_thumbnail_chunk(self.image[100:]), [])
+
+    def test_prune(self):
+        started = self.begin()
+        self.handlers.receive_thumbnail_chunk(self.image[:100])
+        call_command("pruneuploads", stdout=io.StringIO())
+        self.assertEqual(len(self.part_files()), 1)
+        path = os.path.join(
+            settings.CHAT_UPLOAD_DIR, str(self.alice.id), f"{started['uploadId']}.part"
+        )
+        stale = time.time() - settings.CHAT_UPLOAD_EXPIRY - 1
+        os.utime(path, (stale, stale))
+        call_command("pruneuploads", stdout=io.StringIO())
+        self.assertEqual(os.listdir(settings.CHAT_UPLOAD_DIR), [])
+
+    @override_settings(CHAT_THUMBNAIL_MAX_BYTES=10)
+    def test_declared_size_limit(self):
+        self.assertIsNone(self.begin())
+        self.assertEqual(self.handlers.receive_thumbnail_chunk(self.image), [])
+
+    def test_overrun(self):
+        self.begin(size=10)
+        self.assertEqual(self.handlers.receive_thumbnail_chunk(self.image), [])
+        self.assertIsNone(self.handlers.upload)
+
+    def test_not_an_image(self):
+        self.begin(size=5)
+        self.assertEqual(self.handlers.receive_thumbnail_chunk(b"hello"), [])
+        self.alice.refresh_from_db()
+        self.assertFalse(self.alice.thumbnail)
+
+
+class GroupTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        cls.bob = User.objects.create_user("bob")
+        cls.carol = User.objects.create_user("carol")
+        cls.dave = User.objects.create_user("dave")
+        Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+        Connection.objects.create(sender=cls.carol, receiver=cls.alice, accepted=True)
+        # Not a friend of alice's
+        Connection.objects.create(sender=cls.alice, receiver=cls.dave)
+
+    def create(self):
+        events = Handlers(self.alice).handle(
+            "group.create", {"name": "trip", "usernames": ["bob", "dave"]}
+        )
+        return events[0][2]["id"], events
+
+    def test_create(self):
+        _, events = self.create()
+        self.assertEqual(
+            [(group, source) for group, source, _ in events],
+            [("alice", "group.new"), ("bob", "group.new")],
+        )
+        self.assertEqual(events[0][2]["size"], 2)
+
+    def test_add_and_leave(self):
+        group_id, _ = self.create()
+        added = Handlers(self.alice).handle(
+            "group.add", {"groupId": group_id, "usernames": ["carol", "bob"]}
+        )
+        self.assertEqual(
+            [(group, source) for group, source, _ in added],
+            [(f"conversation.{group_id}", "group.update"), ("carol", "group.new")],
+        )
+        left = Handlers(self.bob).handle("group.leave", {"groupId": group_id})
+        self.assertEqual(left[0], ("bob", "group.remove", {"id": group_id}))
+        self.assertEqual(left[1][2]["removed"], ["bob"])
+        [(_, _, groups)] = Handlers(self.alice).handle("group.list", {})
+        self.assertEqual([group["size"] for group in groups], [2])
+
+    def test_message_fan_out(self):
+        group_id, _ = self.create()
+        [(group, source, data)] = Handlers(self.bob).handle(
+            "group.message.send", {"groupId": group_id, "message": "hi all"}
+        )
+        self.assertEqual(group, f"conversation.{group_id}")
+        self.assertEqual(data["message"]["user"], self.bob.id)
+        self.assertNotIn("is_me", data["message"])
+
+        [(_, _, page)] = Handlers(self.alice).handle(
+            "group.message.list", {"groupId": group_id}
+        )
+        self.assertEqual([m["text"] for m in page["messages"]], ["hi all"])
+
+    def test_not_a_member(self):
+        group_id, _ = self.create()
+        self.assertEqual(
+            Handlers(self.carol).handle(
+                "group.message.send", {"groupId": group_id, "message": "hi"}
+            ),
+            [],
+        )
+
+    def test_layer_event(self):
+        # The frame is serialized once and matches what sockets sent before
+        event = layer_event("group.new", {"id": 7})
+        self.assertEqual(
+            event["text"],
+            json.dumps(
+                {"type": "broadcast_group", "source": "group.new", "data": {"id": 7}}
+            ),
+        )
+        self.assertEqual(event["memberships"], [["join", "conversation.7"]])
+
+
+class LocalReplyTests(TestCase):
+    def setUp(self):
+        self.handlers = Handlers(User(username="alice"))
+
+    def test_replies(self):
+        self.assertTrue(self.handlers.is_reply("alice", "friend.list"))
+        self.assertTrue(self.handlers.is_reply("alice", "message.list"))
+        # The user's other sockets see their own sends
+        self.assertFalse(self.handlers.is_reply("alice", "message.send"))
+        self.assertFalse(self.handlers.is_reply("bob", "friend.list"))
+
+    @override_settings(CHAT_LOCAL_REPLIES=False)
+    def test_disabled(self):
+        self.assertFalse(self.handlers.is_reply("alice", "friend.list"))
+
+
+class PresenceTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        cls.bob = User.objects.create_user("bob")
+        cls.carol = User.objects.create_user("carol")
+        Connection.objects.create(sender=cls.alice, receiver=cls.bob, accepted=True)
+        Connection.objects.create(sender=cls.carol, receiver=cls.alice, accepted=True)
+
+    def setUp(self):
+        cache.clear()
+        self.tracker = PresenceTracker(interval=1, grace=0, ttl=60)
+        self.tracker.connect(self.bob.id)
+        # Nobody online to tell
+        self.assertEqual(self.tracker.flush(), {})
+
+    def test_batched_diffs(self):
+        self.tracker.connect(self.alice.id)
+        self.tracker.connect(self.carol.id)
+        diffs = self.tracker.flush()
+        # Only online friends hear about it, all changes in one diff
+        self.assertEqual(sorted(row["username"] for row in diffs["bob"]), ["alice"])
+        self.assertEqual(sorted(row["username"] for row in diffs["alice"]), ["carol"])
+
+        self.tracker.disconnect(self.alice.id)
+        [row] = self.tracker.flush()["bob"]
+        self.assertFalse(row["online"])
+        self.assertIsNotNone(row["lastSeen"])
+
+    def test_reconnect_inside_grace(self):
+        self.tracker.grace = 60
+        self.tracker.connect(self.alice.id)
+        self.tracker.flush()
+        self.tracker.disconnect(self.alice.id)
+        self.tracker.connect(self.alice.id)
+        self.assertEqual(self.tracker.flush(), {})
+
+    def test_other_sockets_keep_user_online(self):
+        self.tracker.connect(self.alice.id)
+        self.tracker.connect(self.alice.id)
+        self.tracker.flush()
+        self.tracker.disconnect(self.alice.id)
+        self.assertEqual(self.tracker.flush(), {})
+
+    def test_query(self):
+        [(_, _, data)] = Handlers(self.alice).handle("presence.query", {})
+        states = {row["username"]: row["online"] for row in data["users"]}
+        self.assertEqual(states, {"bob": True, "carol": False})
+
+
+class OutboxTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        cls.bob = User.objects.create_user("bob")
+        cls.carol = User.objects.create_user("carol")
+        cls.connection = Connection.objects.create(
+            sender=cls.alice, receiver=cls.bob, accepted=True
+        )
+
+    def send(self, text):
+        data = {"connectionId": self.connection.id, "message": text}
+        return Handlers(self.alice).handle("message.send", data)
+
+    def batch(self, user):
+        _, events = Handlers(user).connect_state(user)
+        return events[0][2] if events else None
+
+    def test_recorded_for_recipient(self):
+        events = self.send("hi")
+        by_group = {(group, source): data for group, source, data in events}
+        self.assertIn("outboxId", by_group["bob", "message.send"])
+        # The sender's own copy isn't kept
+        self.assertNotIn("outboxId", by_group["alice", "message.send"])
+        self.assertIsNone(self.batch(self.alice))
+
+    def test_compacted_batch_and_ack(self):
+        self.send("one")
+        self.send("two")
+        Handlers(self.carol).handle("request.connect", {"username": "bob"})
+        batch = self.batch(self.bob)
+        [conversation] = batch["messages"]
+        self.assertEqual(conversation["friend"]["username"], "alice")
+        self.assertEqual([m["text"] for m in conversation["messages"]], ["one", "two"])
+        self.assertEqual([e["source"] for e in batch["events"]], ["request.connect"])
+        self.assertFalse(batch["more"])
+
+        Handlers(self.bob).handle("outbox.ack", {"upTo": batch["upTo"]})
+        self.assertIsNone(self.batch(self.bob))
+
+    def test_deduplicated(self):
+        Handlers(self.carol).handle("request.connect", {"username": "bob"})
+        Handlers(self.carol).handle("request.connect", {"username": "bob"})
+        Handlers(self.bob).handle("request.accept", {"username": "carol"})
+        self.assertEqual(
+            [e["source"] for e in self.batch(self.bob)["events"]], ["request.connect"]
+        )
+        self.assertEqual(
+            [e["source"] for e in self.batch(self.carol)["events"]],
+            ["request.accept", "friend.new"],
+        )
+
+    def test_group_message(self):
+        conversation = Conversation.objects.create(name="trip", created_by=self.alice)
+        Membership.objects.bulk_create(
+            Membership(conversation=conversation, user=user)
+            for user in (self.alice, self.bob, self.carol)
+        )
+        data = {"groupId": conversation.id, "message": "hi"}
+        Handlers(self.alice).handle("group.message.send", data)
+        # Read from the group's messages, nothing stored per member
+        self.assertFalse(OutboxEvent.objects.exists())
+        for user in (self.bob, self.carol):
+            [group] = self.batch(user)["groups"]
+            self.assertEqual(group["id"], conversation.id)
+            self.assertEqual([m["text"] for m in group["messages"]], ["hi"])
+        self.assertIsNone(self.batch(self.alice))
+
+        # Acknowledged per conversation, not past its newest message
+        ack = {"groups": [{"id": conversation.id, "upTo": group["upTo"] + 100}]}
+        Handlers(self.bob).handle("outbox.ack", ack)
+        self.assertIsNone(self.batch(self.bob))
+        self.assertEqual(len(self.batch(self.carol)["groups"]), 1)
+        Handlers(self.alice).handle("group.message.send", data)
+        [group] = self.batch(self.bob)["groups"]
+        self.assertEqual(len(group["messages"]), 1)
+
+    def test_invalid_ack(self):
+        for data in ({}, {"upTo": True}, {"groups": [{"id": 1}]}, {"groups": "x"}):
+            with self.subTest(data=data):
+                self.assertEqual(Handlers(self.bob).handle("outbox.ack", data), [])
+
+    @override_settings(CHAT_OUTBOX_MAX_EVENTS=2)
+    def test_pruned(self):
+        for i in range(5):
+            self.send(str(i))
+        call_command("pruneoutbox", stdout=io.StringIO())
+        # One past the cap, so the next batch knows it's truncated
+        self.assertEqual(OutboxEvent.objects.filter(username="bob").count(), 3)
+        batch = self.batch(self.bob)
+        self.assertTrue(batch["truncated"])
+        texts = [m["text"] for m in batch["messages"][0]["messages"]]
+        self.assertEqual(texts, ["3", "4"])
+
+    @override_settings(CHAT_OUTBOX_MAX_EVENTS=1)
+    def test_bounded(self):
+        self.send("one")
+        self.send("two")
+        batch = self.batch(self.bob)
+        self.assertTrue(batch["truncated"])
+        self.assertEqual([m["text"] for m in batch["messages"][0]["messages"]], ["two"])
+
+
+class QueryBudgetTests(TestCase):
+    """Handlers stay within their query budget however many rows they touch."""
+
+    def seed(self, count):
+        """
+        A user with ``count`` of everything: friends with a message each,
+        pending requests, members and messages in a group, outbox events.
+        """
+        User.objects.bulk_create(
+            [User(username="alice"), User(username="stranger")]
+            + [User(username=f"friend{i}") for i in range(count)]
+            + [User(username=f"requester{i}") for i in range(count)]
+        )
+        alice = User.objects.get(username="alice")
+        friends = list(User.objects.filter(username__startswith="friend"))
+        requesters = User.objects.filter(username__startswith="requester")
+        Connection.objects.bulk_create(
+            [Connection(sender=alice, receiver=user, accepted=True) for user in friends]
+            + [Connection(sender=user, receiver=alice) for user in requesters]
+        )
+        connections = list(Connection.objects.filter(sender=alice))
+        Message.objects.bulk_create(
+            Message(connection=connection, user_id=connection.receiver_id, text="hello")
+            for connection in connections
+        )
+        first, second = connections[0].id, connections[-1].id
+        Connection.objects.filter(pk=first).update(
+            latest_message=Message.objects.get(connection_id=first)
+        )
+        group = Conversation.objects.create(name="group", created_by=alice)
+        empty = Conversation.objects.create(name="empty", created_by=alice)
+        Membership.objects.bulk_create(
+            Membership(conversation=conversation, user=user)
+            for conversation, user in [(group, alice), (empty, alice)]
+            + [(group, user) for user in friends]
+        )
+        GroupMessage.objects.bulk_create(
+            GroupMessage(conversation=group, user=user, text="hello")
+            for user in friends
+        )
+        OutboxEvent.objects.bulk_create(
+            OutboxEvent(username="alice", source="request.connect", data={"id": i})
+            for i in range(count)
+        )
+        usernames = [user.username for user in friends]
+
+        def send(connection_id, text):
+            return {
+                "source": "message.send",
+                "connectionId": connection_id,
+                "message": text,
+            }
+
+        return alice, [
+            ("friend.list", {}),
+            ("group.list", {}),
+            ("group.members", {"groupId": group.id}),
+            ("group.message.list", {"groupId": group.id}),
+            ("group.message.send", {"groupId": group.id, "message": "hi"}),
+            ("message.list", {"connectionId": first, "before": None}),
+            ("message.read", {"connectionId": first}),
+            ("message.search", {"query": "hello"}),
+            ("message.send", {"connectionId": first, "message": "hi"}),
+            ("message.type", {"username": "friend0"}),
+            ("presence.query", {}),
+            ("request.list", {}),
+            ("sync", {"since": "2000-01-01T00:00:00Z"}),
+            ("user.search", {"query": "friend"}),
+            (
+                "outbox.ack",
+                {"upTo": 0, "groups": [{"id": group.id, "upTo": 0}], "next": True},
+            ),
+            ("group.add", {"groupId": empty.id, "usernames": usernames}),
+            ("group.create", {"name": "new", "usernames": usernames}),
+            ("request.accept", {"username": "requester0"}),
+            ("request.connect", {"username": "stranger"}),
+            ("group.leave", {"groupId": group.id}),
+            (
+                "batch",
+                {
+                    "ops": [
+                        send(first, "a"),
+                        send(second, "b"),
+                        {"source": "friend.list"},
+                    ]
+                },
+            ),
+        ]
+
+    def assertWithinBudgets(self, count):
+        cache.clear()
+        alice, frames = self.seed(count)
+        for source, data in frames:
+            with self.subTest(source=source, count=count):
+                # A socket's first frame, before the friend map is loaded
+                handlers = Handlers(alice)
+                with CaptureQueriesContext(connection) as queries:
+                    self.assertTrue(handlers.handle(source, data))
+                self.assertLessEqual(
+                    len(queries),
+                    handlers.query_budget(source, data),
+                    "\n".join(q["sql"] for q in queries),
+                )
+
+    def test_every_source_budgeted(self):
+        self.assertEqual(set(ChatHandlers.query_budgets), set(ChatHandlers.sources))
+
+    def test_one_row(self):
+        self.assertWithinBudgets(1)
+
+    def test_50_rows(self):
+        self.assertWithinBudgets(50)
+
+    def test_500_rows(self):
+        self.assertWithinBudgets(500)
+
+
+class FriendMapTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        cls.bob = User.objects.create_user("bob")
+        cls.carol = User.objects.create_user("carol")
+        cls.connection = Connection.objects.create(
+            sender=cls.alice, receiver=cls.bob, accepted=True
+        )
+        cls.pending = Connection.objects.create(sender=cls.carol, receiver=cls.alice)
+        cls.others = Connection.objects.create(
+            sender=cls.bob, receiver=cls.carol, accepted=True
+        )
+
+    def setUp(self):
+        cache.clear()
+        self.handlers = Handlers(self.alice)
+        self.handlers.connect_state(self.alice)
+
+    def send(self, connection):
+        data = {"connectionId": connection.id, "message": "hi"}
+        return self.handlers.handle("message.send", data)
+
+    def test_message_send_queries(self):
+        with CaptureQueriesContext(connection) as queries:
+            events = self.send(self.connection)
+        selects = [q["sql"] for q in queries if q["sql"].startswith("SELECT")]
+        # Only the unread counts, the parties come from the map
+        self.assertEqual(len(selects), 1)
+        self.assertNotIn("chat_user", selects[0])
+        self.assertEqual(events[0][2]["friend"], encoders.user(self.bob))
+
+    def test_members_only(self):
+        self.assertEqual(self.send(self.pending), [])
+        self.assertEqual(self.send(self.others), [])
+        data = {"connectionId": self.others.id, "page": 0}
+        self.assertEqual(self.handlers.handle("message.list", data), [])
+        self.assertEqual(Message.objects.count(), 0)
+
+    def test_accept_reloads(self):
+        Handlers(self.alice).handle("request.accept", {"username": "carol"})
+        # Until the socket hears about the new friend
+        self.assertEqual(self.send(self.pending), [])
+        self.handlers.update_friends(friend_changes("friend.new", {}))
+        self.assertTrue(self.send(self.pending))
+
+    def test_friend_update(self):
+        renamed = {**encoders.user(self.bob), "name": "Robert"}
+        data = {"id": self.connection.id, "friend": renamed}
+        self.handlers.update_friends(friend_changes("friend.update", data))
+        events = self.send(self.connection)
+        self.assertEqual(events[0][2]["friend"]["name"], "Robert")
+        self.assertIs(friend_changes("message.type", {}), False)
+
+
+class BatchTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.alice = User.objects.create_user("alice")
+        cls.bob = User.objects.create_user("bob")
+        cls.carol = User.objects.create_user("carol")
+        cls.connection = Connection.objects.create(
+            sender=cls.alice, receiver=cls.bob, accepted=True
+        )
+        cls.strangers = Connection.objects.create(
+            sender=cls.bob, receiver=cls.carol, accepted=True
+        )
+
+    def setUp(self):
+        cache.clear()
+
+    def send(self, id, connection, text):
+        return {
+            "id": id,
+            "source": "message.send",
+            "connectionId": connection.id,
+            "message": text,
+        }
+
+    def test_bulk_send(self):
+        ops = [self.send(i, self.connection, str(i)) for i in range(5)]
+        with CaptureQueriesContext(connection) as queries:
+            events = Handlers(self.alice).handle("batch", {"ops": ops})
+        inserts = [q for q in queries if 'INSERT INTO "chat_message"' in q["sql"]]
+        self.assertEqual(len(inserts), 1)
+        self.assertEqual(Message.objects.count(), 5)
+
+        by_group = {(group, source): data for group, source, data in events}
+        data = by_group["alice", "batch"]
+        self.assertEqual([r["id"] for r in data["results"]], list(range(5)))
+        self.assertTrue(all(r["ok"] for r in data["results"]))
+        # The sender's own copies go to all of their sockets
+        self.assertIn(("alice", "batch.events"), by_group)
+
+        # One frame for bob, the conversation summary only once
+        data = by_group["bob", "batch.events"]
+        sources = [event["source"] for event in data["events"]]
+        self.assertEqual(sources, ["message.send"] * 5 + ["friend.update"])
+        self.assertEqual(data["events"][-1]["data"]["unread"], 5)
+
+    def test_per_op_results(self):
+        ops = [
+            self.send("a", self.connection, "hi"),
+            self.send("b", self.strangers, "not mine"),
+            {"id": "c", "source": "batch", "ops": []},
+            {"id": "d", "source": "friend.list"},
+        ]
+        [(group, source, data)] = [
+            event
+            for event in Handlers(self.alice).handle("batch", {"ops": ops})
+            if event[1] == "batch"
+        ]
+        results = {r["id"]: r for r in data["results"]}
+        self.assertTrue(results["a"]["ok"])
+        self.assertFalse(results["b"]["ok"])
+        self.assertFalse(results["c"]["ok"])
+        self.assertEqual(results["d"]["events"][0]["source"], "friend.list")
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_empty_outcomes(self):
+        ops = [
+            # Nothing to mark read yet, which succeeds without events
+            {"id": "a", "source": "message.read", "connectionId": self.connection.id},
+            # Typing is throttled on the consumer's event loop, not in batches
+            {"id": "b", "source": "message.type", "username": "bob"},
+        ]
+        events = Handlers(self.alice).handle("batch", {"ops": ops})
+        self.assertEqual(
+            [(group, source) for group, source, _ in events], [("alice", "batch")]
+        )
+        results = {r["id"]: r for r in events[0][2]["results"]}
+        self.assertTrue(results["a"]["ok"])
+        self.assertFalse(results["b"]["ok"])
+
+    def test_merged_membership(self):
+        ops = [
+            {"id": "a", "source": "group.create", "name": "trip", "usernames": ["bob"]},
+            self.send("b", self.connection, "hi"),
+        ]
+        events = Handlers(self.alice).handle("batch", {"ops": ops})
+        by_group = {(group, source): data for group, source, data in events}
+        data = by_group["bob", "batch.events"]
+        group_id = data["events"][0]["data"]["id"]
+        # Bob's sockets join the new group from the merged frame
+        event = layer_event("batch.events", data)
+        self.assertEqual(event["memberships"], [["join", f"conversation.{group_id}"]])
+
+    @override_settings(CHAT_BATCH_MAX_OPS=2)
+    def test_too_many_ops(self):
+        ops = [self.send(i, self.connection, str(i)) for i in range(3)]
+        self.assertEqual(Handlers(self.alice).handle("batch", {"ops": ops}), [])
+        self.assertEqual(Message.objects.count(), 0)
+
+
+class WriterTests(TransactionTestCase):
+    # The writer thread needs the rows committed to see them
+    def setUp(self):
+        self.alice = User.objects.create_user("alice")
+        self.bob = User.objects.create_user("bob")
+        self.connection = Connection.objects.create(
+            sender=self.alice, receiver=self.bob, accepted=True
+        )
+        # One id block covers every test, so only the writer thread
+        # writes while it runs
+        self.writer = writer.MessageWriter(
+            max_queue=100, flush_interval=0.01, batch_size=50
+        )
+        metrics.reset()
+
+    def tearDown(self):
+        self.writer.stop()
+
+    def message(self, text):
+        message = Message(connection=self.connection, user=self.alice, text=text)
+        message.id = self.writer.ids[Message].allocate()
+        return message
+
+    def test_flush(self):
+        for i in range(25):
+            self.writer.submit(
+                Message(connection=self.connection, user=self.alice, text=str(i))
+            )
+        self.writer.stop()
+        self.assertEqual(Message.objects.count(), 25)
+        self.connection.refresh_from_db()
+        self.assertEqual(self.connection.receiver_unread, 25)
+        self.assertEqual(self.connection.latest_text, "24")
+
+    def test_retry(self):
+        save_messages = writer.save_messages
+        calls = []
+
+        def flaky(messages):
+            calls.append(len(messages))
+            if len(calls) == 1:
+                raise OperationalError("database is locked")
+            save_messages(messages)
+
+        with mock.patch.object(writer, "save_messages", flaky):
+            self.writer.commit([self.message("a"), self.message("b")])
+        self.assertEqual(calls, [2, 2])
+        self.assertEqual(Message.objects.count(), 2)
+
+    def test_drop_bad_row(self):
+        batch = [self.message("a"), self.message(None), self.message("c")]
+        self.writer.commit(batch)
+        # Only the message that can't be stored is lost
+        self.assertEqual(
+            sorted(Message.objects.values_list("text", flat=True)), ["a", "c"]
+        )
+        self.connection.refresh_from_db()
+        self.assertEqual(self.connection.receiver_unread, 2)
+        counters = metrics.snapshot()["counters"]
+        self.assertEqual(counters["writer.lost"], {"all": 1})
+
+    @override_settings(CHAT_MESSAGE_WRITE_BEHIND=True)
+    def test_outbox_rows(self):
+        data = {"connectionId": self.connection.id, "message": "hi"}
+        with mock.patch.object(writer, "get_writer", lambda: self.writer):
+            with mock.patch("chat.handlers.get_writer", lambda: self.writer):
+                events = Handlers(self.alice).handle("message.send", data)
+        by_group = {(group, source): data for group, source, data in events}
+        self.writer.stop()
+        # Written along with the message, under the id it was sent with
+        [row] = OutboxEvent.objects.values_list("id", "username")
+        self.assertEqual(row, (by_group["bob", "message.send"]["outboxId"], "bob"))
+        self.assertEqual(Message.objects.count(), 1)
+
+    def test_invalid_text(self):
+        data = {"connectionId": self.connection.id, "message": None}
+        self.assertEqual(Handlers(self.alice).handle("message.send", data), [])
+        self.assertEqual(Message.objects.count(), 0)
+
+
+class AsyncConsumerTests(TransactionTestCase):
+    """The default ``chat/`` route, through the JWT middleware and a layer."""
+
+    def setUp(self):
+        cache.clear()
+        layers = override_settings(CHANNEL_LAYERS=IN_MEMORY_CHANNEL_LAYERS)
+        layers.enable()
+        self.addCleanup(channel_layers.backends.clear)
+        self.addCleanup(layers.disable)
+        channel_layers.backends.clear()
+        # Counted without the publishing thread
+        self.tracker = PresenceTracker(interval=60, grace=0, ttl=60)
+        tracker = mock.patch.object(presence, "_tracker", self.tracker)
+        tracker.start()
+        self.addCleanup(tracker.stop)
+
+        # Imported late, like the benchmarks, once Django is set up
+        from core.asgi import application
+
+        self.application = application
+        self.alice, self.bob = create_friends(2)
+
+    async def connect(self, user):
+        client = Client(self.application, "/chat/", user)
+        self.assertTrue(await client.connect())
+        return client
+
+    async def test_anonymous_rejected(self):
+        communicator = WebsocketCommunicator(self.application, "/chat/")
+        connected, _ = await communicator.connect()
+        self.assertFalse(connected)
+
+    async def test_message_send(self):
+        alice = await self.connect(self.alice)
+        bob = await self.connect(self.bob)
+        frame, _ = await alice.request("friend.list")
+        connection_id = frame["data"][0]["id"]
+
+        await alice.send("message.send", connectionId=connection_id, message="hi")
+        # Both parties' sockets get it through the layer
+        sent = await alice.receive("message.send")
+        received = await bob.receive("message.send")
+        self.assertTrue(sent["data"]["message"]["is_me"])
+        self.assertEqual(received["data"]["message"]["text"], "hi")
+        self.assertFalse(received["data"]["message"]["is_me"])
+        self.assertEqual(received["data"]["friend"]["username"], self.alice.username)
+        self.assertEqual(await database_sync_to_async(Message.objects.count)(), 1)
+        await close_all([alice, bob])
+
+    async def test_inbound_bytes(self):
+        alice = await self.connect(self.alice)
+        metrics.reset()
+        # Clients needn't escape non-ASCII text
+        frame = {"source": "user.search", "query": "zoë"}
+        text_data = json.dumps(frame, ensure_ascii=False)
+        await alice.communicator.send_to(text_data=text_data)
+        await alice.receive("user.search")
+        # Frames are handled in order, so the search has been recorded
+        await alice.request("friend.list")
+        histograms = metrics.snapshot()["histograms"]
+        self.assertEqual(
+            histograms["frame.inbound_bytes"]["user.search"]["sum"],
+            len(text_data) + 1,
+        )
+        await alice.close()
+
+    async def test_disconnect(self):
+        alice = await self.connect(self.alice)
+        layer = get_channel_layer()
+        self.assertEqual(len(layer.groups[self.alice.username]), 1)
+        self.assertEqual(self.tracker.local[self.alice.id], 1)
+
+        await alice.close()
+        # Out of its groups, counted out of presence
+        self.assertFalse(layer.groups.get(self.alice.username))
+        self.assertNotIn(self.alice.id, self.tracker.local)
+
+    async def slow_reader(self, count):
+        """
+        Run the consumer under a server whose send waits for a client that
+        never reads, as uvicorn's does; broadcasts ``count`` messages to it
+        and returns the code it closes with.
+        """
+        scope = {
+            "type": "websocket",
+            "path": "/chat/",
+            "query_string": b"",
+            "headers": [],
+            "subprotocols": [],
+            "user": self.alice,
+        }
+        inbound = asyncio.Queue()
+        accepted = asyncio.Event()
+        closed = asyncio.get_running_loop().create_future()
+
+        async def send(message):
+            if message["type"] == "websocket.accept":
+                accepted.set()
+            elif message["type"] == "websocket.close":
+                closed.set_result(message.get("code"))
+            else:
+                await asyncio.Event().wait()
+
+        application = AsyncChatConsumer.as_asgi()
+        task = asyncio.ensure_future(application(scope, inbound.get, send))
+        await inbound.put({"type": "websocket.connect"})
+        await asyncio.wait_for(accepted.wait(), 5)
+        layer = get_channel_layer()
+        for i in range(count):
+            event = layer_event("message.send", {"text": str(i)})
+            await layer.group_send(self.alice.username, event)
+        code = await asyncio.wait_for(closed, 5)
+        await inbound.put({"type": "websocket.disconnect", "code": code})
+        await asyncio.wait_for(task, 5)
+        return code
+
+    @override_settings(CHAT_OUTBOUND_QUEUE_SIZE=2, CHAT_OUTBOUND_MAX_FRAMES=5)
+    async def test_slow_reader_max_frames(self):
+        self.assertEqual(await self.slow_reader(10), RESYNC_CLOSE_CODE)
+
+    @override_settings(CHAT_OUTBOUND_QUEUE_SIZE=2, CHAT_OUTBOUND_DEADLINE=0.05)
+    async def test_slow_reader_deadline(self):
+        # Over the limit, then nothing more to send
+        self.assertEqual(await self.slow_reader(4), RESYNC_CLOSE_CODE)
+
+
+class LayerShardTests(TestCase):
+    usernames = [f"user{i}" for i in range(10_000)]
+
+    def test_spread(self):
+        counts = [0] * 4
+        for username in self.usernames:
+            counts[shard_for(username, 4)] += 1
+        for count in counts:
+            self.assertAlmostEqual(count, 2500, delta=250)
+
+    def test_adding_shard(self):
+        moved = [
+            shard_for(username, 5)
+            for username in self.usernames
+            if shard_for(username, 4) != shard_for(username, 5)
+        ]
+        # Only about a fifth moves, all of it onto the new shard
+        self.assertAlmostEqual(len(moved) / len(self.usernames), 0.2, delta=0.03)
+        self.assertEqual(set(moved), {4})
+
+
+class TypingCoalescerTests(TestCase):
+    def run_typing(self, frames, window=0.05, timeout=0.1):
+        """
+        Typing frames as ``(delay, recipient)``; returns what was forwarded
+        and the stop events, each with its time since the start.
+        """
+
+        async def run():
+            loop = asyncio.get_running_loop()
+            start = loop.time()
+            forwarded = []
+            stopped = []
+
+            async def stop(recipient):
+                stopped.append((recipient, loop.time() - start))
+
+            coalescer = TypingCoalescer(stop, window=window, timeout=timeout)
+            for delay, recipient in frames:
+                await asyncio.sleep(delay)
+                if coalescer.typing(recipient):
+                    forwarded.append((recipient, loop.time() - start))
+            await asyncio.sleep(timeout * 2)
+            await coalescer.close()
+            return forwarded, stopped
+
+        return asyncio.run(run())
+
+    def test_suppressed(self):
+        forwarded, _ = self.run_typing([(0, "bob"), (0, "bob"), (0, "carol")])
+        # One per recipient inside the window
+        self.assertEqual([recipient for recipient, _ in forwarded], ["bob", "carol"])
+
+    def test_forwarded_after_window(self):
+        forwarded, _ = self.run_typing([(0, "bob"), (0.02, "bob"), (0.05, "bob")])
+        self.assertEqual(len(forwarded), 2)
+        self.assertGreaterEqual(forwarded[1][1], 0.05)
+
+    def test_stop_after_timeout(self):
+        forwarded, stopped = self.run_typing([(0, "bob"), (0.03, "bob")])
+        self.assertEqual(len(forwarded), 1)
+        # Once, a timeout after the last frame, even a suppressed one
+        [(recipient, at)] = stopped
+        self.assertEqual(recipient, "bob")
+        self.assertGreaterEqual(at, 0.13)
+
+    def test_stop_on_close(self):
+        async def run():
+            stopped = []
+
+            async def stop(recipient):
+                stopped.append(recipient)
+
+            coalescer = TypingCoalescer(stop, window=60, timeout=60)
+            coalescer.typing("bob")
+            await coalescer.close()
+            return stopped
+
+        self.assertEqual(asyncio.run(run()), ["bob"])
+
+
+class OutboundQueueTests(TestCase):
+    """A client that reads nothing until every frame is queued."""
+
+    def run_queue(self, frames, wait=0, **limits):
+        """
+        Queue the frames, wait ``wait`` seconds, then read; returns the
+        overflow calls and what was sent.
+        """
+
+        async def run():
+            sent = []
+            overflowed = []
+            reading = asyncio.Event()
+
+            async def send(text):
+                await reading.wait()
+                sent.append(json.loads(text))
+
+            async def overflow():
+                overflowed.append(True)
+
+            queue = OutboundQueue(
+                send, overflow, **{"deadline": 60, "max_frames": 100, **limits}
+            )
+            for source, data in frames:
+                queue.put(source, frame(source, data))
+            await asyncio.sleep(wait)
+            reading.set()
+            while queue.frames:
+                await asyncio.sleep(0)
+            await asyncio.sleep(0)
+            await queue.close()
+            return overflowed, sent
+
+        return asyncio.run(run())
+
+    def typing(self, username):
+        return "message.type", {"username": username}
+
+    def presence(self, username, online):
+        return "presence.diff", {"users": [{"username": username, "online": online}]}
+
+    def test_merged(self):
+        _, sent = self.run_queue(
+            [
+                ("message.send", {"text": "first"}),
+                self.typing("bob"),
+                self.presence("bob", True),
+                self.typing("bob"),
+                self.presence("carol", True),
+                self.presence("bob", False),
+            ],
+            limit=10,
+        )
+        self.assertEqual(
+            [frame["source"] for frame in sent],
+            ["message.send", "presence.diff", "message.type"],
+        )
+        self.assertEqual(
+            sent[1]["data"]["users"],
+            [
+                {"username": "bob", "online": False},
+                {"username": "carol", "online": True},
+            ],
+        )
+
+    def test_messages_kept(self):
+        messages = [("message.send", {"text": str(i)}) for i in range(5)]
+        _, sent = self.run_queue(
+            [messages[0], self.typing("bob"), self.presence("bob", True)]
+            + messages[1:],
+            limit=3,
+        )
+        self.assertEqual([frame["source"] for frame in sent], ["message.send"] * 5)
+
+    def test_overflow(self):
+        overflowed, sent = self.run_queue(
+            [("message.send", {"text": str(i)}) for i in range(6)],
+            limit=2,
+            max_frames=4,
+        )
+        self.assertEqual(overflowed, [True])
+        # Nothing is queued once the socket is to be closed
+        self.assertEqual(len(sent), 4)
+
+    def test_deadline(self):
+        # Over the limit with no more frames coming, the timer notices
+        overflowed, _ = self.run_queue(
+            [("message.send", {"text": str(i)}) for i in range(4)],
+            wait=0.1,
+            limit=2,
+            deadline=0.05,
+        )
+        self.assertEqual(overflowed, [True])
+
+    def test_caught_up(self):
+        async def run():
+            overflowed = []
+
+            async def send(text):
+                await asyncio.sleep(0.01)
+
+            async def overflow():
+                overflowed.append(True)
+
+            queue = OutboundQueue(send, overflow, limit=2, deadline=0.1, max_frames=100)
+            for i in range(4):
+                queue.put("message.send", frame("message.send", {"text": str(i)}))
+            # Back under the limit before the deadline
+            await asyncio.sleep(0.2)
+            await queue.close()
+            return overflowed
+
+        self.assertEqual(asyncio.run(run()), [])
@@ -0,0 +1,210 @@
+import asyncio
+import itertools
+import json
+from collections import OrderedDict
+
+from . import metrics
+
+
+class TypingCoalescer:
+    """
+    Per-socket coalescing of ``message.type`` frames.
+
+    Forwards at most one typing event per recipient per ``window`` seconds
+    and calls ``stop(recipient)`` once no frame for that recipient has
+    arrived for ``timeout`` seconds. Must be used from the event loop.
+    """
+
+    def __init__(self, stop, window, timeout):
+        self.stop = stop
+        self.window = window
+        self.timeout = timeout
+        self.forwarded_at = {}
+        self.stop_timers = {}
+        self.tasks = set()
+
+    def typing(self, recipient):
+        """Record a typing frame; returns True if it should be forwarded."""
+        loop = asyncio.get_running_loop()
+        now = loop.time()
+
+        # Any frame, forwarded or not, pushes back the stop event
+        timer = self.stop_timers.pop(recipient, None)
+        if timer is not None:
+            timer.cancel()
+        self.stop_timers[recipient] = loop.call_later(
+            self.timeout, self.expire, recipient
+        )
+
+        last = self.forwarded_at.get(recipient)
+        if last is not None and now - last < self.window:
+            metrics.increment("typing.suppressed")
+            return False
+
+        self.forwarded_at[recipient] = now
+        metrics.increment("typing.forwarded")
+        return True
+
+    def expire(self, recipient):
+        self.stop_timers.pop(recipient, None)
+        self.forwarded_at.pop(recipient, None)
+        metrics.increment("typing.stopped")
+        # Keep a reference so the task isn't garbage collected mid-send
+        task = asyncio.ensure_future(self.stop(recipient))
+        self.tasks.add(task)
+        task.add_done_callback(self.tasks.discard)
+
+    async def close(self):
+        """Cancel pending timers, telling recipients typing has stopped."""
+        recipients = list(self.stop_timers)
+        for timer in self.stop_timers.values():
+            timer.cancel()
+        self.stop_timers.clear()
+        self.forwarded_at.clear()
+        for recipient in recipients:
+            metrics.increment("typing.stopped")
+            await self.stop(recipient)
+
+
+class OutboundQueue:
+    """
+    Per-socket queue of outbound text frames, written to the socket by
+    one task, so a client that stops reading backs frames up here where
+    they can be counted, merged and dropped.
+
+    Frames still waiting are merged: a user's newer typing frame replaces
+    their older one, presence diffs are folded into the one queued.
+    Past ``limit`` waiting frames, typing frames and presence diffs are
+    dropped, oldest first; messages, requests and every other source are
+    kept. ``overflow()`` is called, once, when the socket has stayed over
+    ``limit`` for ``deadline`` seconds or reaches ``max_frames``; nothing
+    is queued after that. Must be used from the event loop.
+
+    Frames only back up here if ``send`` waits for the client to read
+    them, as it does under uvicorn, whose websocket send waits for the
+    transport to drain. Daphne's returns once the frame is handed to
+    Twisted, which buffers it without bound: under daphne a client that
+    stops reading is never noticed, which is why production runs on
+    uvicorn (see core.asgi).
+    """
+
+    # Dropped first when over the limit; the client catches up with the
+    # next one, or with presence.query
+    DROPPABLE = {"message.type", "message.type.stop", "presence.diff"}
+
+    def __init__(self, send, overflow, limit, deadline, max_frames):
+        self.send = send
+        self.overflow = overflow
+        self.limit = limit
+        self.deadline = deadline
+        self.max_frames = max_frames
+        # Waiting frames by sequence number, as (source, text, merge key)
+        self.frames = OrderedDict()
+        self.sequence = itertools.count()
+        # Sequence numbers of the waiting droppable frames, oldest first,
+        # and by merge key
+        self.droppable = OrderedDict()
+        self.merge_keys = {}
+        # Fires once the socket has stayed over the limit for the deadline
+        self.deadline_timer = None
+        self.overflowed = False
+        self.overflow_task = None
+        self.ready = asyncio.Event()
+        self.task = asyncio.ensure_future(self.run())
+
+    def put(self, source, text):
+        """Queue a frame."""
+        if self.overflowed:
+            metrics.increment("outbound.dropped", 1, source)
+            return
+
+        merge_key = None
+        if source in self.DROPPABLE:
+            frame = json.loads(text)
+            merge_key = self.merge_key(source, frame["data"])
+            waiting = self.merge_keys.get(merge_key)
+            if waiting is not None:
+                metrics.increment("outbound.coalesced", 1, source)
+                if source == "presence.diff":
+                    self.merge_presence(waiting, frame)
+                    return
+                # Typing: the newest state goes last
+                self.forget(waiting)
+
+        if len(self.frames) >= self.limit:
+            if self.droppable:
+                self.drop(next(iter(self.droppable)))
+            elif merge_key is not None:
+                metrics.increment("outbound.dropped", 1, source)
+                return
+
+        key = next(self.sequence)
+        self.frames[key] = (source, text, merge_key)
+        if merge_key is not None:
+            self.droppable[key] = None
+            self.merge_keys[merge_key] = key
+        self.ready.set()
+        metrics.observe("outbound.depth", len(self.frames), source)
+
+        if len(self.frames) >= self.max_frames:
+            self.fall_behind()
+        elif len(self.frames) > self.limit and self.deadline_timer is None:
+            self.deadline_timer = asyncio.get_running_loop().call_later(
+                self.deadline, self.fall_behind
+            )
+
+    def fall_behind(self):
+        self.cancel_deadline()
+        self.overflowed = True
+        metrics.increment("outbound.overflows")
+        self.overflow_task = asyncio.ensure_future(self.overflow())
+
+    def cancel_deadline(self):
+        if self.deadline_timer is not None:
+            self.deadline_timer.cancel()
+            self.deadline_timer = None
+
+    def merge_key(self, source, data):
+        if source == "presence.diff":
+            return "presence"
+        return "typing", data["username"]
+
+    def merge_presence(self, key, frame):
+        source, text, merge_key = self.frames[key]
+        merged = json.loads(text)
+        users = {user["username"]: user for user in merged["data"]["users"]}
+        users.update((user["username"], user) for user in frame["data"]["users"])
+        merged["data"]["users"] = list(users.values())
+        self.frames[key] = (source, json.dumps(merged), merge_key)
+
+    def forget(self, key):
+        """Remove a waiting frame; returns its (source, text)."""
+        source, text, merge_key = self.frames.pop(key)
+        if merge_key is not None:
+            del self.droppable[key]
+            del self.merge_keys[merge_key]
+        return source, text
+
+    def drop(self, key):
+        source, _ = self.forget(key)
+        metrics.increment("outbound.dropped", 1, source)
+
+    async def run(self):
+        while True:
+            await self.ready.wait()
+            _, text = self.forget(next(iter(self.frames)))
+            if not self.frames:
+                self.ready.clear()
+            if len(self.frames) <= self.limit:
+                # Caught up in time
+                self.cancel_deadline()
+            await self.send(text)
+
+    async def close(self):
+        """Stop writing; frames still waiting are dropped."""
+        self.cancel_deadline()
+        self.task.cancel()
+        try:
+            await self.task
+        except asyncio.CancelledError:
+            pass
@@ -0,0 +1,107 @@
+"""
+Content-addressed thumbnails and their pre-rendered variants.
+
+An uploaded image is stored as ``thumbnails/<hash>.<ext>``, where
+``<hash>`` is taken from its bytes, next to square variants named
+``thumbnails/<hash>-<size>.<ext>`` for every size in
+``CHAT_THUMBNAIL_SIZES`` and every format in ``VARIANT_FORMATS``. Names
+never get reused for different content, so their URLs can be cached
+forever, and the variant URLs follow from the stored name alone.
+
+Thumbnails saved some other way (sign up, the admin, before variants
+existed) have no variants until ``renderthumbnails`` is run.
+"""
+
+import hashlib
+import io
+import re
+
+from django.conf import settings
+from django.core.files.base import ContentFile
+from PIL import Image, ImageOps
+
+from .models import User
+
+# Variant extension, Pillow format and save options
+VARIANT_FORMATS = {
+    "webp": ("WEBP", {"quality": 80, "method": 4}),
+    "jpg": ("JPEG", {"quality": 85, "optimize": True, "progressive": True}),
+}
+
+# Names derived from content: originals and variants
+CONTENT_ADDRESSED = re.compile(r"thumbnails/([0-9a-f]{32})(?:-\d+)?\.\w+")
+ORIGINAL = re.compile(r"thumbnails/([0-9a-f]{32})\.\w+")
+
+_storage = User._meta.get_field("thumbnail").storage
+
+
+def content_hash(file, chunk_size=64 * 1024):
+    digest = hashlib.sha256()
+    file.seek(0)
+    for chunk in iter(lambda: file.read(chunk_size), b""):
+        digest.update(chunk)
+    file.seek(0)
+    return digest.hexdigest()[:32]
+
+
+def variant_name(digest, size, extension):
+    return f"thumbnails/{digest}-{size}.{extension}"
+
+
+def variant_urls(name):
+    """
+    URLs of a stored thumbnail's variants, by size and then extension, or
+    None if it has none.
+    """
+    match = ORIGINAL.fullmatch(name or "")
+    if match is None:
+        return None
+    return {
+        str(size): {
+            extension: _storage.url(variant_name(match[1], size, extension))
+            for extension in VARIANT_FORMATS
+        }
+        for size in settings.CHAT_THUMBNAIL_SIZES
+    }
+
+
+def render(image, size, extension):
+    """Encode a square ``size`` crop of ``image`` as ``extension``."""
+    format, options = VARIANT_FORMATS[extension]
+    variant = ImageOps.fit(image, (size, size), Image.Resampling.LANCZOS)
+    if format == "JPEG" and variant.mode != "RGB":
+        # No alpha in JPEG, flatten onto white
+        background = Image.new("RGB", variant.size, "white")
+        background.paste(variant, mask=variant.getchannel("A"))
+        variant = background
+    output = io.BytesIO()
+    variant.save(output, format, **options)
+    return output.getvalue()
+
+
+def store(file, extension):
+    """
+    Store a checked image and its variants; returns the name to set on
+    ``user.thumbnail``. Content already stored isn't written again.
+    """
+    digest = content_hash(file)
+    name = f"thumbnails/{digest}.{extension}"
+    if _storage.exists(name):
+        return name
+
+    with Image.open(file) as image:
+        # Orientation is applied once here, variants don't carry EXIF
+        image = ImageOps.exif_transpose(image)
+        image = image.convert("RGBA" if "A" in image.getbands() else "RGB")
+        for size in settings.CHAT_THUMBNAIL_SIZES:
+            for variant_extension in VARIANT_FORMATS:
+                variant = variant_name(digest, size, variant_extension)
+                # Left over from an interrupted store, same content
+                if _storage.exists(variant):
+                    continue
+                content = render(image, size, variant_extension)
+                _storage.save(variant, ContentFile(content))
+    # The original last: its presence means the variants are all there
+    file.seek(0)
+    _storage.save(name, file)
+    return name
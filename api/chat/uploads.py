@@ -0,0 +1,175 @@
+"""
+Chunked thumbnail uploads over binary websocket frames.
+
+A client opens an upload with a ``thumbnail.begin`` text frame declaring
+the filename and size in bytes, then sends the image as binary frames,
+which are appended to a part file under ``CHAT_UPLOAD_DIR``. A client that
+reconnects sends ``thumbnail.begin`` again with the ``uploadId`` it was
+given and carries on from the returned ``offset``. A user has at most one
+part file: any other begin removes the previous one. Abandoned part files
+are removed by the ``pruneuploads`` command.
+
+Once the declared size has arrived, Pillow decodes and checks the image on
+a worker thread, away from the event loop and the thread the ORM work runs
+on, where its variants are rendered too (see ``chat.thumbnails``), and
+only then is it saved to ``user.thumbnail``.
+"""
+
+import asyncio
+import os
+import re
+import secrets
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from PIL import Image
+
+# Formats accepted as thumbnails, with the extension they are stored under
+FORMATS = {"JPEG": "jpg", "PNG": "png", "GIF": "gif", "WEBP": "webp"}
+
+UPLOAD_ID = re.compile(r"[0-9a-f]{32}")
+
+
+class InvalidUpload(Exception):
+    pass
+
+
+class ThumbnailUpload:
+    """An upload in progress, received into ``path``."""
+
+    def __init__(self, user_id, upload_id, filename, size):
+        self.upload_id = upload_id
+        self.filename = filename
+        self.size = size
+        self.directory = os.path.join(settings.CHAT_UPLOAD_DIR, str(user_id))
+        self.path = os.path.join(self.directory, f"{upload_id}.part")
+        self.offset = 0
+
+    @classmethod
+    def open(cls, user_id, filename, size, upload_id=None):
+        """
+        Start an upload, or resume ``upload_id`` from the bytes already
+        received. Removes the user's other part file, if any.
+        """
+        if not isinstance(filename, str) or not filename:
+            raise InvalidUpload("missing filename")
+        if not isinstance(size, int) or isinstance(size, bool) or size < 1:
+            raise InvalidUpload("invalid size")
+        if size > settings.CHAT_THUMBNAIL_MAX_BYTES:
+            raise InvalidUpload(f"{size} bytes is over the limit")
+        if upload_id is None:
+            upload_id = secrets.token_hex(16)
+        elif not isinstance(upload_id, str) or not UPLOAD_ID.fullmatch(upload_id):
+            raise InvalidUpload("invalid upload id")
+
+        upload = cls(user_id, upload_id, filename, size)
+        os.makedirs(upload.directory, exist_ok=True)
+        with os.scandir(upload.directory) as entries:
+            replaced = [entry.path for entry in entries if entry.path != upload.path]
+        for path in replaced:
+            remove(path)
+        with open(upload.path, "ab") as part:
+            upload.offset = part.tell()
+        if upload.offset > size:
+            # Resumed with a different size, start over
+            upload.discard()
+            open(upload.path, "wb").close()
+            upload.offset = 0
+        return upload
+
+    @property
+    def complete(self):
+        return self.offset == self.size
+
+    def write(self, chunk):
+        """Append a chunk; returns True once the declared size has arrived."""
+        if self.offset + len(chunk) > self.size:
+            raise InvalidUpload("more data than declared")
+        try:
+            part = open(self.path, "r+b")
+        except FileNotFoundError:
+            # Another begin replaced this upload
+            raise InvalidUpload("upload was replaced") from None
+        with part:
+            part.seek(self.offset)
+            part.write(chunk)
+        self.offset += len(chunk)
+        return self.complete
+
+    def discard(self):
+        remove(self.path)
+
+
+def remove(path):
+    try:
+        os.remove(path)
+    except FileNotFoundError:
+        pass
+
+
+def prune(max_age):
+    """
+    Remove part files nobody has written to for ``max_age`` seconds;
+    returns how many.
+    """
+    cutoff = time.time() - max_age
+    pruned = 0
+    try:
+        users = [entry.path for entry in os.scandir(settings.CHAT_UPLOAD_DIR)]
+    except FileNotFoundError:
+        return 0
+    for directory in users:
+        with os.scandir(directory) as entries:
+            stale = [entry.path for entry in entries if entry.stat().st_mtime < cutoff]
+        for path in stale:
+            remove(path)
+        pruned += len(stale)
+        try:
+            # Only succeeds once the user has no upload left
+            os.rmdir(directory)
+        except OSError:
+            pass
+    return pruned
+
+
+def check_image(file, max_pixels):
+    """
+    Fully decode the image in ``file``; returns the extension to store it
+    under. Raises ``InvalidUpload`` for anything that isn't a usable image.
+    """
+    try:
+        with Image.open(file) as image:
+            if image.format not in FORMATS:
+                raise InvalidUpload(f"unsupported format {image.format}")
+            if image.width * image.height > max_pixels:
+                raise InvalidUpload("image too large")
+            image.verify()
+        # verify() leaves the image unusable, decode from a fresh open
+        file.seek(0)
+        with Image.open(file) as image:
+            image.load()
+            return FORMATS[image.format]
+    except (OSError, SyntaxError, ValueError, Image.DecompressionBombError) as error:
+        raise InvalidUpload(str(error)) from error
+
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    # Pillow releases the GIL while decoding, so threads are enough
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                settings.CHAT_THUMBNAIL_WORKERS, thread_name_prefix="chat-upload"
+            )
+        return _executor
+
+
+def run(fn, *args):
+    """Await ``fn(*args)`` on the upload pool."""
+    return asyncio.get_running_loop().run_in_executor(get_executor(), fn, *args)
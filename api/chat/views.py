@@ -1,10 +1,16 @@
+from django.conf import settings
 from django.contrib.auth import authenticate
 from django.shortcuts import render
-from rest_framework.permissions import AllowAny
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+from django.views.static import serve
+from rest_framework.permissions import AllowAny, IsAdminUser
 from rest_framework.views import APIView
 from rest_framework.response import Response
 from rest_framework import status
 from rest_framework_simplejwt.tokens import RefreshToken
+from . import metrics
+from .thumbnails import CONTENT_ADDRESSED
 from .serializers import UserSerializer, SignUpSerializer
 
 # Create your views here.
@@ -59,3 +65,29 @@ class SignUpView(APIView):
         user_data = get_auth_for_user(user)
 
         return Response(user_data, status=status.HTTP_200_OK)
+
+
+class MetricsView(APIView):
+    permission_classes = [IsAdminUser]
+
+    def get(self, request):
+        # Counters for this worker process only
+        return Response(metrics.snapshot(), status=status.HTTP_200_OK)
+
+
+def media_etag(request, path):
+    # Content-addressed names are their own validators
+    match = CONTENT_ADDRESSED.fullmatch(path)
+    return match[0] if match else None
+
+
+@condition(etag_func=media_etag)
+def media(request, path):
+    """
+    Media files, with content-addressed thumbnails cached for good and
+    answered with 304 when the client already has them.
+    """
+    response = serve(request, path, document_root=settings.MEDIA_ROOT)
+    if media_etag(request, path):
+        patch_cache_control(response, public=True, max_age=31536000, immutable=True)
+    return response
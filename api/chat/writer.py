@@ -0,0 +1,255 @@
+"""
+Message persistence, synchronous or write-behind.
+
+With ``CHAT_MESSAGE_WRITE_BEHIND`` on, ``message.send`` takes a
+pre-allocated id, pushes the message to both parties straight away and
+hands it to a background ``MessageWriter`` that inserts queued messages,
+and the outbox rows recorded for them, with ``bulk_create`` in group
+commits. Every process serving messages
+must use the same mode: ids handed out ahead of time are only safe from
+collisions with other pre-allocated ids.
+"""
+
+import atexit
+import logging
+import queue
+import threading
+import time
+
+from django.conf import settings
+from django.db import (
+    DataError,
+    IntegrityError,
+    close_old_connections,
+    connection,
+    transaction,
+)
+from django.db.models import F, Max, Subquery
+from django.db.models.functions import Coalesce, Greatest
+
+from . import metrics, outbox
+from .cache import invalidate_friend_lists
+from .models import Connection, IdBlock, Message, OutboxEvent
+
+logger = logging.getLogger(__name__)
+
+
+def save_messages(messages):
+    """
+    Insert messages, move each conversation summary to its latest and
+    count them as unread for the other party.
+    """
+    latest = {}
+    # Unread increments per connection side, applied with F() so
+    # concurrent writers never lose a count
+    unread = {}
+    for message in messages:
+        side = (
+            "receiver_unread"
+            if message.user_id == message.connection.sender_id
+            else "sender_unread"
+        )
+        counts = unread.setdefault(message.connection_id, {})
+        counts[side] = counts.get(side, 0) + 1
+
+        current = latest.get(message.connection_id)
+        if current is None or (message.created, message.id or 0) >= (
+            current.created,
+            current.id or 0,
+        ):
+            latest[message.connection_id] = message
+
+    with transaction.atomic():
+        Message.objects.bulk_create(messages)
+        for connection_id, message in latest.items():
+            # Queryset update so "updated" isn't bumped
+            Connection.objects.filter(pk=connection_id).update(
+                latest_message=message,
+                latest_text=message.text,
+                activity=message.created,
+                **{
+                    side: F(side) + count
+                    for side, count in unread[connection_id].items()
+                },
+            )
+        # Friend lists are ordered by activity, both parties' are stale
+        parties = {
+            user_id
+            for message in latest.values()
+            for user_id in (message.connection.sender_id, message.connection.receiver_id)
+        }
+        transaction.on_commit(lambda: invalidate_friend_lists(*parties))
+
+
+class IdAllocator:
+    """Hands out ids from blocks reserved in ``IdBlock``, one row per model."""
+
+    def __init__(self, model, block_size):
+        self.model = model
+        self.name = model._meta.label_lower
+        self.block_size = block_size
+        self.lock = threading.Lock()
+        self.next_id = 0
+        self.end = 0
+
+    def allocate(self):
+        with self.lock:
+            if self.next_id >= self.end:
+                self.next_id, self.end = self.reserve()
+            allocated = self.next_id
+            self.next_id += 1
+            return allocated
+
+    def reserve(self):
+        # Never below rows inserted without the allocator
+        highest = Coalesce(
+            Subquery(self.model.objects.order_by("-id").values("id")[:1]) + 1, 1
+        )
+        try:
+            with transaction.atomic():
+                # Write first so concurrent processes serialize on the row lock
+                reserved = IdBlock.objects.filter(name=self.name).update(
+                    next_id=Greatest(F("next_id"), highest) + self.block_size
+                )
+                if not reserved:
+                    start = (
+                        self.model.objects.aggregate(highest=Max("id"))["highest"]
+                        or 0
+                    ) + 1
+                    IdBlock.objects.create(
+                        name=self.name, next_id=start + self.block_size
+                    )
+                end = IdBlock.objects.get(name=self.name).next_id
+        except IntegrityError:
+            # Another process created the row first
+            return self.reserve()
+        return end - self.block_size, end
+
+
+class MessageWriter:
+    """
+    Background thread that commits queued messages and outbox events in
+    batches.
+    """
+
+    def __init__(self, max_queue, flush_interval, batch_size):
+        self.queue = queue.Queue(max_queue)
+        self.flush_interval = flush_interval
+        self.batch_size = batch_size
+        self.ids = {
+            model: IdAllocator(model, batch_size) for model in (Message, OutboxEvent)
+        }
+        self.stopping = threading.Event()
+        self.thread = threading.Thread(
+            target=self.run, name="chat-message-writer", daemon=True
+        )
+        self.thread.start()
+
+    def submit(self, row):
+        """
+        Queue a message or outbox event with an allocated id. When the
+        queue stays full the row is written synchronously instead, so
+        nothing is dropped.
+        """
+        row.id = self.ids[type(row)].allocate()
+        try:
+            self.queue.put(row, timeout=self.flush_interval)
+        except queue.Full:
+            metrics.increment("writer.overflow")
+            self.save([row])
+        return row
+
+    def run(self):
+        try:
+            while not (self.stopping.is_set() and self.queue.empty()):
+                batch = self.take()
+                if batch:
+                    self.commit(batch)
+        finally:
+            connection.close()
+
+    def take(self):
+        """Wait up to one flush interval for a batch of rows."""
+        batch = []
+        deadline = time.monotonic() + self.flush_interval
+        while len(batch) < self.batch_size:
+            timeout = deadline - time.monotonic()
+            try:
+                if timeout > 0:
+                    batch.append(self.queue.get(timeout=timeout))
+                else:
+                    batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        return batch
+
+    def save(self, batch):
+        messages = [row for row in batch if isinstance(row, Message)]
+        events = [row for row in batch if isinstance(row, OutboxEvent)]
+        with transaction.atomic():
+            if messages:
+                save_messages(messages)
+            if events:
+                outbox.save(events)
+
+    def commit(self, batch, attempts=5):
+        """
+        Save a batch, retrying errors that may go away. A batch that still
+        fails is saved a row at a time, so only the bad rows are lost.
+        """
+        close_old_connections()
+        for attempt in range(1, attempts + 1):
+            try:
+                self.save(batch)
+            except (DataError, IntegrityError):
+                # The same rows fail the same way however often they're tried
+                logger.exception("Failed to commit %d rows", len(batch))
+                break
+            except Exception:
+                logger.exception(
+                    "Failed to commit %d rows (attempt %d)", len(batch), attempt
+                )
+                if attempt < attempts:
+                    time.sleep(min(2**attempt * self.flush_interval, 5))
+                continue
+            metrics.observe("writer.batch_size", len(batch))
+            return
+        if len(batch) > 1:
+            for message in batch:
+                self.commit([message], attempts=1)
+            return
+        metrics.increment("writer.lost")
+        logger.error("Dropped %s %s", batch[0]._meta.model_name, batch[0].id)
+
+    def stop(self, timeout=None):
+        """Commit everything still queued, then stop the thread."""
+        self.stopping.set()
+        self.thread.join(timeout)
+
+
+_writer = None
+_writer_lock = threading.Lock()
+
+
+def get_writer():
+    global _writer
+    with _writer_lock:
+        if _writer is None:
+            _writer = MessageWriter(
+                max_queue=settings.CHAT_WRITE_BEHIND_QUEUE_SIZE,
+                flush_interval=settings.CHAT_WRITE_BEHIND_FLUSH_INTERVAL,
+                batch_size=settings.CHAT_WRITE_BEHIND_BATCH_SIZE,
+            )
+            # Drain the queue on a clean interpreter exit
+            atexit.register(_writer.stop)
+        return _writer
+
+
+def stop_writer():
+    """Flush and stop the process writer, if one was started."""
+    global _writer
+    with _writer_lock:
+        writer, _writer = _writer, None
+    if writer is not None:
+        atexit.unregister(writer.stop)
+        writer.stop()
@@ -3,6 +3,14 @@ ASGI config for core project.
 
 It exposes the ASGI callable as a module-level variable named ``application``.
 
+Serve it with uvicorn, whose websocket send waits for the client to read,
+so chat.throttle can notice sockets that fall behind:
+
+    uvicorn core.asgi:application --ws websockets
+
+``manage.py runserver`` (daphne) is fine for development, but daphne buffers
+every frame for a client that stops reading.
+
 For more information on this file, see
 https://docs.djangoproject.com/en/5.0/howto/deployment/asgi/
 """
@@ -10,6 +10,8 @@ For the full list of settings and their values, see
 https://docs.djangoproject.com/en/5.0/ref/settings/
 """
 
+import os
+import tempfile
 from pathlib import Path
 
 # Build paths inside the project like this: BASE_DIR / 'subdir'.
@@ -58,19 +60,139 @@ REST_FRAMEWORK = {
 MEDIA_ROOT = BASE_DIR / "media"
 MEDIA_URL = "/media/"
 
-# Daphne
+# Daphne serves runserver; deploy with uvicorn, see core.asgi
 ASGI_APPLICATION = "core.asgi.application"
 
 # Channels
+# Users' groups are spread over every Redis in CHAT_LAYER_SHARDS (comma
+# separated redis:// URLs). Only ever append to the list, see chat.layers
+CHAT_LAYER_SHARDS = os.environ.get(
+    "CHAT_LAYER_SHARDS", "redis://127.0.0.1:6379"
+).split(",")
+
 CHANNEL_LAYERS = {
     "default": {
-        "BACKEND": "channels_redis.core.RedisChannelLayer",
+        "BACKEND": "chat.layers.ShardedRedisChannelLayer",
         "CONFIG": {
-            "hosts": [("127.0.0.1", 6379)],
+            "hosts": CHAT_LAYER_SHARDS,
         },
     },
 }
 
+# Logging
+# Set CHAT_LOG_LEVEL=DEBUG to log every websocket frame
+
+LOGGING = {
+    "version": 1,
+    "disable_existing_loggers": False,
+    "handlers": {
+        "console": {"class": "logging.StreamHandler"},
+    },
+    "loggers": {
+        "chat": {
+            "handlers": ["console"],
+            "level": os.environ.get("CHAT_LOG_LEVEL", "INFO"),
+        },
+    },
+}
+
+# Chat
+
+# Write replies meant only for the requesting socket (friend.list,
+# message.list, ...) straight to it instead of through the channel layer
+CHAT_LOCAL_REPLIES = True
+
+# Frames queued for each socket of the event-loop consumer: over the first
+# number typing and presence frames are dropped or merged, and a socket
+# still over it after the deadline (seconds), or over the second number
+# at all, is closed with a resync hint. Frames only queue up under uvicorn,
+# whose websocket send waits for the client, not daphne (see core.asgi)
+CHAT_OUTBOUND_QUEUE_SIZE = 100
+CHAT_OUTBOUND_MAX_FRAMES = 1_000
+CHAT_OUTBOUND_DEADLINE = 10.0
+
+# batch: most operations in one frame
+CHAT_BATCH_MAX_OPS = 100
+
+# user.search: shortest query served, default and largest page size
+CHAT_SEARCH_MIN_LENGTH = 1
+CHAT_SEARCH_PAGE_SIZE = 20
+CHAT_SEARCH_MAX_PAGE_SIZE = 50
+
+# message.type: forward at most one typing event per recipient per window,
+# and send message.type.stop after this many seconds without one (seconds)
+CHAT_TYPING_WINDOW = 2.0
+CHAT_TYPING_TIMEOUT = 5.0
+
+# message.send: push messages before they are stored and commit them in
+# batches from a background writer (every process must use the same mode)
+CHAT_MESSAGE_WRITE_BEHIND = os.environ.get("CHAT_MESSAGE_WRITE_BEHIND") == "1"
+CHAT_WRITE_BEHIND_QUEUE_SIZE = 10_000
+CHAT_WRITE_BEHIND_FLUSH_INTERVAL = 0.05
+CHAT_WRITE_BEHIND_BATCH_SIZE = 500
+
+# message.search: results per page and the markers around matches in
+# snippets, which are HTML with the message text escaped
+CHAT_MESSAGE_SEARCH_PAGE_SIZE = 20
+CHAT_MESSAGE_SEARCH_HIGHLIGHT = ("<mark>", "</mark>")
+
+# thumbnail.begin: largest upload and image accepted, where partial
+# uploads are kept and how long they can be resumed (seconds, enforced by
+# pruneuploads), and the threads decoding finished uploads
+CHAT_THUMBNAIL_MAX_BYTES = 5 * 1024 * 1024
+CHAT_THUMBNAIL_MAX_PIXELS = 25_000_000
+CHAT_UPLOAD_DIR = os.path.join(tempfile.gettempdir(), "chat-uploads")
+CHAT_UPLOAD_EXPIRY = 24 * 60 * 60
+CHAT_THUMBNAIL_WORKERS = 2
+
+# Square thumbnail variants rendered for every upload (pixels)
+CHAT_THUMBNAIL_SIZES = (40, 80, 160)
+
+# group.create/group.add: most members in a group conversation
+CHAT_GROUP_MAX_MEMBERS = 1_000
+
+# presence: how often changes are published, how long a user stays online
+# after their last socket closes, and how long a crashed process can keep
+# its users online (seconds)
+CHAT_PRESENCE_INTERVAL = 1.0
+CHAT_PRESENCE_GRACE = 5.0
+CHAT_PRESENCE_TTL = 60
+
+# outbox: events kept for offline users, most sent per batch, most kept
+# per user and for how long (seconds)
+CHAT_OUTBOX_BATCH_SIZE = 500
+CHAT_OUTBOX_MAX_EVENTS = 2_000
+CHAT_OUTBOX_TTL = 7 * 24 * 60 * 60
+
+# sync: most messages returned per round trip
+CHAT_SYNC_MAX_MESSAGES = 200
+
+# Cache for friend lists and presence, shared by every process when
+# CHAT_CACHE_URL points at a Redis (e.g. redis://127.0.0.1:6379/1). Without
+# it each process has its own and never sees another's invalidations.
+CHAT_CACHE_URL = os.environ.get("CHAT_CACHE_URL")
+
+if CHAT_CACHE_URL:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.redis.RedisCache",
+            "LOCATION": CHAT_CACHE_URL,
+        }
+    }
+else:
+    CACHES = {
+        "default": {
+            "BACKEND": "django.core.cache.backends.locmem.LocMemCache",
+            "OPTIONS": {"MAX_ENTRIES": 10_000},
+        }
+    }
+
+# friend.list: cached per user until a message, accepted request or
+# thumbnail change invalidates it (seconds). With a shared cache this is a
+# safety net only; a process-local cache misses invalidations made by
+# other processes, so its entries can only be trusted for a few seconds.
+CHAT_FRIEND_CACHE_TIMEOUT = 60 * 60 if CHAT_CACHE_URL else 5
+
 
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",